@@ -0,0 +1,318 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import time
+import tracemalloc
+from concurrent.futures import Future
+
+from nl2sql_cache import normalize_question
+
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+QUESTIONS_PATH = os.path.join(BENCHMARK_DIR, "benchmark_questions.json")
+STAGES = ["connect", "introspect", "generate", "execute"]
+
+
+class StubGenerator:
+    """
+    Deterministic stand-in for the model with the same submit() interface as GenerationServer.
+
+    Answers each prompt with the gold SQL of its question (the last line of the prompt), so the
+    rest of the pipeline can be timed offline; unknown questions get "SELECT 1".
+    """
+
+    def __init__(self, answers, latency_ms=0.0):
+        self.answers = {normalize_question(question): sql for question, sql in answers.items()}
+        self.latency = latency_ms / 1000.0
+
+    def submit(self, prompt, **options):
+        if self.latency:
+            time.sleep(self.latency)
+        question = prompt.strip().splitlines()[-1].strip()
+        future = Future()
+        future.set_result(self.answers.get(normalize_question(question), "SELECT 1"))
+        return future
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+    return {"p50": rank(50), "p90": rank(90), "p99": rank(99), "mean": sum(ordered) / len(ordered),
+            "count": len(ordered)}
+
+
+def execution_match(conn, predicted, gold_sql):
+    """
+    True when the predicted rows (already fetched by the guarded execution) equal the rows of
+    gold_sql, run under the same time limit (in order if the gold query has ORDER BY).
+    """
+    from query_guard import time_limit
+
+    try:
+        with time_limit(conn):
+            gold = conn.execute(gold_sql).fetchall()
+    except Exception as e:
+        print(f"Gold query failed: {e}")
+        return False
+    if "ORDER BY" in gold_sql.upper():
+        return predicted == gold
+    return sorted(map(repr, predicted)) == sorted(map(repr, gold))
+
+
+def _peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None  # Not available on Windows
+    scale = 1 if platform.system() == "Darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def load_questions(path=QUESTIONS_PATH, databases=None):
+    with open(path, "r", encoding="utf-8") as f:
+        questions = json.load(f)
+    if databases:
+        questions = {db: items for db, items in questions.items() if db in databases}
+    return questions
+
+
+def make_generator(llm, questions, model_id):
+    """
+    Return (generator, lang_model, description) for the requested LLM mode.
+    """
+    if llm == "auto":
+        try:
+            import transformers  # noqa: F401
+            llm = "local"
+        except ImportError:
+            llm = "stub"
+    if llm == "local":
+        from generation_server import get_generation_server
+        from inference_backends import default_backend
+        from model_registry import default_registry
+        return (get_generation_server(model_id), default_registry.get(model_id),
+                f"local:{model_id}:{default_backend()}")
+
+    answers = {item["question"]: item["gold"] for items in questions.values() for item in items}
+    return StubGenerator(answers), None, "stub"
+
+
+class CountingGenerator:
+    """
+    Passes prompts on to a generator and counts them (first tries plus repairs), and how many
+    carried a schema prefix that an earlier prompt had already put in the prefix cache.
+    """
+
+    def __init__(self, generator):
+        self.generator = generator
+        self.submitted = 0
+        self.prefixed = 0
+        self.prefix_hits = 0
+        self._prefixes = set()
+
+    @property
+    def model(self):
+        return getattr(self.generator, "model", None)
+
+    def submit(self, prompt, **options):
+        self.submitted += 1
+        prefix = options.get("prefix")
+        if prefix:
+            self.prefixed += 1
+            self.prefix_hits += prefix in self._prefixes
+            self._prefixes.add(prefix)
+        return self.generator.submit(prompt, **options)
+
+    def prefix_stats(self):
+        return {"prompts": self.submitted, "prefixed": self.prefixed, "hits": self.prefix_hits,
+                "hit_rate": self.prefix_hits / self.submitted if self.submitted else 0.0}
+
+
+def run_benchmark(questions, generator, lang_model, use_pruning=True, top_k=4, verbose=False, examples=None):
+    """
+    Drive connect_db -> get_table_info -> llm_create_sql -> guarded execution for every question.
+
+    With an ExampleStore, prompts carry few-shot examples; build it with exclude_exact=True so a
+    question's own gold SQL is never shown to the model.
+    """
+    from example_store import examples_for_prompt
+    from nl2sql_cache import schema_fingerprint
+    from query_guard import guard_query, time_limit
+    from result_stream import MAX_RESULT_ROWS, stream_query
+    from schema_catalog import default_catalog
+    from schema_linking import count_tokens, get_schema_index
+    from sql_functions import (connect_db, format_sql_prompt, get_foreign_keys, get_table_info, llm_create_sql,
+                               prompt_schema, release_db)
+
+    timings = {stage: [] for stage in STAGES}
+    prompt_tokens = []
+    per_database = {}
+    tokenizer = getattr(getattr(lang_model, "pipeline", None), "tokenizer", None)
+    generator = CountingGenerator(generator)
+    quiet = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+
+    tracemalloc.start()
+    with quiet:
+        for db_name, items in questions.items():
+            db_path = os.path.join(BENCHMARK_DIR, db_name)
+            # Each database starts cold so the first question pays for introspection
+            default_catalog.invalidate(db_path)
+            records = []
+            for item in items:
+                record = {"question": item["question"], "gold": item["gold"], "level": item.get("level")}
+
+                start = time.perf_counter()
+                conn = connect_db(db_path)
+                timings["connect"].append(time.perf_counter() - start)
+                try:
+                    start = time.perf_counter()
+                    table_names, table_info = get_table_info(conn)
+                    schema_index = get_schema_index(table_info, get_foreign_keys(conn)) if use_pruning else None
+                    timings["introspect"].append(time.perf_counter() - start)
+
+                    tables_summary, _ = prompt_schema(table_info, item["question"], lang_model,
+                                                      schema_index=schema_index, top_k=top_k, generator=generator)
+                    examples_block = ""
+                    if examples is not None:
+                        examples_block = examples_for_prompt(examples, item["question"],
+                                                             schema_fingerprint(table_info), tokenizer)
+                    record["prompt_tokens"] = count_tokens(
+                        format_sql_prompt(tables_summary, item["question"], examples_block), tokenizer)
+                    prompt_tokens.append(record["prompt_tokens"])
+
+                    start = time.perf_counter()
+                    sql_query = llm_create_sql(table_info, item["question"], lang_model, schema_index=schema_index,
+                                               top_k=top_k, generator=generator, conn=conn, examples=examples)
+                    timings["generate"].append(time.perf_counter() - start)
+                    record["predicted"] = sql_query
+
+                    start = time.perf_counter()
+                    predicted = None
+                    try:
+                        guard = guard_query(conn, sql_query, table_names)
+                        if guard.rejected:
+                            record["error"] = guard.rejected
+                        else:
+                            # Keep every row so the match below compares this execution's result
+                            with time_limit(conn):
+                                result = stream_query(conn, guard.sql, preview_rows=MAX_RESULT_ROWS)
+                            record["rows"] = result.row_count
+                            if result.truncated:
+                                record["error"] = result.truncation_reason
+                            else:
+                                predicted = result.preview_rows
+                            result.close()
+                    except Exception as e:
+                        record["error"] = str(e)
+                    timings["execute"].append(time.perf_counter() - start)
+
+                    record["match"] = predicted is not None and execution_match(conn, predicted, item["gold"])
+                finally:
+                    release_db(conn)
+                records.append(record)
+
+            matched = sum(1 for record in records if record["match"])
+            per_database[db_name] = {"accuracy": matched / len(records) if records else 0.0,
+                                     "matched": matched, "questions": records}
+    _, python_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    total = sum(len(db["questions"]) for db in per_database.values())
+    matched = sum(db["matched"] for db in per_database.values())
+    return {
+        "accuracy": matched / total if total else 0.0,
+        "generations_per_question": generator.submitted / total if total else 0.0,
+        "prefix_cache": generator.prefix_stats(),
+        "stages": {stage: percentiles(values) for stage, values in timings.items()},
+        "prompt_tokens": percentiles(prompt_tokens),
+        "memory": {"python_peak_bytes": python_peak, "process_peak_rss_bytes": _peak_rss_bytes()},
+        "databases": per_database,
+    }
+
+
+def compare(previous, current, latency_tolerance=0.2):
+    """
+    Return human-readable regressions of current against a previous benchmark result.
+    """
+    regressions = []
+    if current["accuracy"] < previous["accuracy"]:
+        regressions.append(f"accuracy {previous['accuracy']:.3f} -> {current['accuracy']:.3f}")
+    for stage in STAGES:
+        before = previous["stages"].get(stage, {}).get("p50")
+        after = current["stages"].get(stage, {}).get("p50")
+        if before and after and after > before * (1 + latency_tolerance):
+            regressions.append(f"{stage} p50 {before * 1000:.2f}ms -> {after * 1000:.2f}ms")
+    before = previous["prompt_tokens"].get("mean")
+    after = current["prompt_tokens"].get("mean")
+    if before and after and after > before * (1 + latency_tolerance):
+        regressions.append(f"mean prompt tokens {before:.0f} -> {after:.0f}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Latency and execution-match benchmark over the bundled databases.")
+    parser.add_argument("--llm", choices=["auto", "stub", "local"], default="auto",
+                        help="stub answers with the gold SQL; local runs the real model; auto picks local if available")
+    parser.add_argument("--model", default="NumbersStation/nsql-350M")
+    parser.add_argument("--backend", help="Inference backend for --llm local (fp32, bf16, int8, onnx); "
+                                          "see inference_backends.py to compare them all")
+    parser.add_argument("--db", action="append", help="Only run this database file (repeatable)")
+    parser.add_argument("--questions", default=QUESTIONS_PATH)
+    parser.add_argument("--no-pruning", action="store_true", help="Send the full schema instead of the pruned one")
+    parser.add_argument("--top-k", type=int, default=4)
+    parser.add_argument("--few-shot", action="store_true",
+                        help="Add retrieved examples to prompts (each question's own gold SQL is held out)")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="Previous results JSON; exit non-zero on regressions")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if args.backend:
+        from inference_backends import set_default_backend
+        set_default_backend(args.backend)
+    questions = load_questions(args.questions, args.db)
+    generator, lang_model, description = make_generator(args.llm, questions, args.model)
+    examples = None
+    if args.few_shot:
+        from example_store import ExampleStore
+        examples = ExampleStore(path=None, exclude_exact=True)
+        examples.seed(args.questions)
+    results = run_benchmark(questions, generator, lang_model, use_pruning=not args.no_pruning,
+                            top_k=args.top_k, verbose=args.verbose, examples=examples)
+    results["run"] = {"llm": description, "pruning": not args.no_pruning, "top_k": args.top_k,
+                      "few_shot": args.few_shot,
+                      "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version()}
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, default=str)
+
+    print(f"LLM: {description}  accuracy: {results['accuracy']:.3f}")
+    for db_name, db in results["databases"].items():
+        print(f"  {db_name}: {db['matched']}/{len(db['questions'])}")
+    for stage, stats in results["stages"].items():
+        if stats:
+            print(f"  {stage:<10} p50 {stats['p50'] * 1000:8.2f}ms  p90 {stats['p90'] * 1000:8.2f}ms  "
+                  f"p99 {stats['p99'] * 1000:8.2f}ms")
+    print(f"  generations per question {results['generations_per_question']:.2f}  "
+          f"prompt tokens mean {results['prompt_tokens'].get('mean', 0):.0f}  "
+          f"python peak {results['memory']['python_peak_bytes'] / 2**20:.1f} MiB")
+    prefix_cache = results["prefix_cache"]
+    print(f"  prefix cache hit rate {prefix_cache['hit_rate']:.2f} "
+          f"({prefix_cache['hits']}/{prefix_cache['prompts']} prompts reused a cached schema prefix)")
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compare(json.load(f), results)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            raise SystemExit(1)
@@ -0,0 +1,207 @@
+import os
+import pathlib
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+POOL_SIZE = int(os.environ.get("SQL_POOL_SIZE", 4))
+MMAP_SIZE = int(os.environ.get("SQL_MMAP_SIZE", 256 * 2**20))
+CACHE_SIZE_KIB = int(os.environ.get("SQL_CACHE_SIZE_KIB", 64 * 1024))
+CHECKOUT_TIMEOUT = 30
+
+
+def read_only_uri(db_path, immutable=False):
+    """
+    SQLite URI that opens db_path read-only (and immutable, skipping locking, when requested).
+    """
+    uri = pathlib.Path(os.path.abspath(db_path)).as_uri() + "?mode=ro"
+    if immutable:
+        uri += "&immutable=1"
+    return uri
+
+
+class ConnectionPool:
+    """
+    Bounded pool of read-only, tuned connections to one database file.
+
+    Connections are created with check_same_thread=False so any Streamlit session thread can
+    use them; the pool guarantees each connection has one user at a time. Idle connections are
+    reused most-recently-released first (warmest page cache) and health-checked on checkout.
+    """
+
+    def __init__(self, db_path, max_size=POOL_SIZE, immutable=False):
+        self.db_path = os.path.abspath(db_path)
+        self.max_size = max_size
+        # Opt-in: immutable=1 skips locking and change detection, so it is only safe for files nobody writes
+        self.immutable = immutable
+        self._idle = []
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.checkouts = 0
+
+    def _open(self):
+        conn = sqlite3.connect(read_only_uri(self.db_path, self.immutable), uri=True, check_same_thread=False)
+        conn.execute(f"PRAGMA mmap_size={int(MMAP_SIZE)};")
+        conn.execute(f"PRAGMA cache_size=-{int(CACHE_SIZE_KIB)};")
+        conn.execute("PRAGMA query_only=1;")
+        self.opened += 1
+        return conn
+
+    @staticmethod
+    def _healthy(conn):
+        try:
+            conn.execute("SELECT 1;").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def checkout(self, timeout=CHECKOUT_TIMEOUT):
+        if not self._slots.acquire(timeout=timeout):
+            raise sqlite3.OperationalError(f"no free connection to {self.db_path} after {timeout}s")
+        try:
+            while True:
+                with self._lock:
+                    conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    conn = self._open()
+                    break
+                if self._healthy(conn):
+                    break
+                conn.close()
+            self.checkouts += 1
+            return conn
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.set_progress_handler(None, 0)
+            with self._lock:
+                self._idle.append(conn)
+        except sqlite3.Error:
+            conn.close()
+        finally:
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            idle = len(self._idle)
+        return {"db_path": self.db_path, "opened": self.opened, "checkouts": self.checkouts,
+                "idle": idle, "max_size": self.max_size, "immutable": self.immutable}
+
+
+class AttachedPool(ConnectionPool):
+    """
+    Pool of connections that each ATTACH several database files read-only, one schema per
+    file, so a single query can join tables across them (schema.table).
+
+    immutables names the schemas to attach with immutable=1 (the others use mode=ro only).
+    """
+
+    def __init__(self, key, databases, max_size=POOL_SIZE, immutables=()):
+        super().__init__(key, max_size=max_size, immutable=False)
+        self.db_path = key
+        self.databases = {schema: os.path.abspath(db_path) for schema, db_path in databases.items()}
+        self.immutables = {schema: schema in immutables for schema in self.databases}
+
+    def _open(self):
+        conn = sqlite3.connect(":memory:", uri=True, check_same_thread=False)
+        for schema, db_path in self.databases.items():
+            quoted = '"' + schema.replace('"', '""') + '"'
+            conn.execute(f"ATTACH DATABASE ? AS {quoted};", (read_only_uri(db_path, self.immutables[schema]),))
+            # Page cache and mmap limits are per attached database
+            conn.execute(f"PRAGMA {quoted}.mmap_size={int(MMAP_SIZE)};")
+            conn.execute(f"PRAGMA {quoted}.cache_size=-{int(CACHE_SIZE_KIB)};")
+        conn.execute("PRAGMA query_only=1;")
+        self.opened += 1
+        return conn
+
+
+class PoolManager:
+    """
+    One ConnectionPool per database path, shared by the whole process.
+    """
+
+    def __init__(self, max_size=POOL_SIZE):
+        self.max_size = max_size
+        self._pools = {}
+        self._owners = {}
+        self._lock = threading.Lock()
+
+    def pool(self, db_path):
+        with self._lock:
+            # Registered pools (e.g. AttachedPool) are looked up by their key as given
+            pool = self._pools.get(db_path)
+            if pool is not None:
+                return pool
+            db_path = os.path.abspath(db_path)
+            pool = self._pools.get(db_path)
+            if pool is None:
+                pool = ConnectionPool(db_path, max_size=self.max_size)
+                self._pools[db_path] = pool
+            return pool
+
+    def register(self, pool):
+        """
+        Serve pool under its db_path key (used for pools not backed by a single file).
+        """
+        with self._lock:
+            old = self._pools.get(pool.db_path)
+            self._pools[pool.db_path] = pool
+        if old is not None and old is not pool:
+            old.close()
+        return pool
+
+    def has_pool(self, db_path):
+        with self._lock:
+            return db_path in self._pools
+
+    def checkout(self, db_path, timeout=CHECKOUT_TIMEOUT):
+        pool = self.pool(db_path)
+        conn = pool.checkout(timeout=timeout)
+        with self._lock:
+            self._owners[id(conn)] = pool
+        return conn
+
+    def release(self, conn):
+        with self._lock:
+            pool = self._owners.pop(id(conn), None)
+        if pool is None:
+            # Not a pooled connection (e.g. opened directly by a caller)
+            conn.close()
+        else:
+            pool.release(conn)
+
+    @contextmanager
+    def connection(self, db_path):
+        conn = self.checkout(db_path)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self):
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for pool in pools:
+            pool.close()
+
+    def stats(self):
+        with self._lock:
+            pools = list(self._pools.values())
+        return [pool.stats() for pool in pools]
+
+
+default_pools = PoolManager()
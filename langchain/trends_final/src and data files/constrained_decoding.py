@@ -0,0 +1,206 @@
+import bisect
+import os
+import re
+
+
+# Applied on every path, including the batching GenerationServer (per prompt of a batch). Costs a
+# prefix check of the top candidates per step; set to 0 to trade validity for decoding speed.
+CONSTRAINED_DECODING = os.environ.get("SQL_CONSTRAINED_DECODING", "1") == "1"
+
+SQL_KEYWORDS = {
+    "select", "distinct", "all", "from", "where", "group", "by", "having", "order", "asc", "desc", "limit",
+    "offset", "join", "inner", "left", "right", "full", "outer", "cross", "natural", "on", "using", "as",
+    "and", "or", "not", "in", "is", "null", "like", "glob", "between", "exists", "case", "when", "then",
+    "else", "end", "union", "intersect", "except", "with", "recursive", "collate", "nocase", "escape",
+    "true", "false", "cast", "integer", "real", "text", "numeric", "current_date", "current_time",
+    "current_timestamp", "over", "partition", "rows", "range", "preceding", "following", "unbounded",
+    "current", "row", "filter", "nulls", "first", "last",
+}
+
+SQL_FUNCTIONS = {
+    "count", "sum", "avg", "min", "max", "total", "group_concat", "abs", "round", "lower", "upper", "length",
+    "substr", "substring", "trim", "ltrim", "rtrim", "replace", "instr", "coalesce", "ifnull", "nullif",
+    "date", "time", "datetime", "julianday", "strftime", "printf", "typeof", "random", "iif",
+    "row_number", "rank", "dense_rank", "ntile", "lag", "lead", "first_value", "last_value",
+}
+
+_TOKEN = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<number>\d+(?:\.\d*)?)
+  | (?P<string>'(?:[^']|'')*'?)
+  | (?P<quoted>"(?:[^"]|"")*"?|`[^`]*`?|\[[^\]]*\]?)
+  | (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<op><>|!=|<=|>=|==|\|\||[-+*/%<>=(),.;])
+""", re.X)
+
+
+# Short qualifiers such as t, il or T1 may be used before the FROM clause that defines them
+_ALIAS_LIKE = re.compile(r"^[a-z]{1,2}\d*$")
+
+
+class SQLPrefixValidator:
+    """
+    Decides whether text can still grow into a valid SQLite SELECT over the given schema.
+
+    This is a lexical grammar check rather than a full parser. The statement must start with
+    SELECT or WITH; every completed word must be a keyword, function, known table/column, or an
+    alias introduced after AS or a table name (short alias-like qualifiers are accepted before
+    their definition); a word after '.' must be a column (or a table after the schema of an
+    ATTACHed database, for tables named schema.table); parentheses
+    never close more than were opened; nothing but whitespace may follow the closing ';'.
+    """
+
+    def __init__(self, table_info):
+        self.tables = {table.lower().rpartition(".")[2] for table, _, _ in table_info}
+        self.schemas = {table.lower().rpartition(".")[0] for table, _, _ in table_info} - {""}
+        self.columns = {col[1].lower() for _, ddl, _ in table_info for col in ddl}
+        self.words = SQL_KEYWORDS | SQL_FUNCTIONS | self.tables | self.schemas | self.columns
+        self._sorted_words = sorted(self.words)
+
+    def _is_word_prefix(self, prefix):
+        index = bisect.bisect_left(self._sorted_words, prefix)
+        return index < len(self._sorted_words) and self._sorted_words[index].startswith(prefix)
+
+    def is_viable(self, text):
+        stripped = text.lstrip()
+        head = stripped[:6].upper()
+        if not ("SELECT".startswith(head) or "WITH".startswith(stripped[:4].upper())):
+            return False
+        if len(stripped) <= 6:
+            return True
+
+        aliases = set()
+        depth = 0
+        previous = []  # last significant tokens, lowercased
+        finished = False
+        position = 0
+        while position < len(stripped):
+            match = _TOKEN.match(stripped, position)
+            if match is None:
+                return False
+            kind, value = match.lastgroup, match.group()
+            at_end = match.end() == len(stripped)
+            position = match.end()
+            if kind == "space":
+                continue
+            if finished:
+                return False
+            if kind == "op":
+                if value == "(":
+                    depth += 1
+                elif value == ")":
+                    depth -= 1
+                    if depth < 0:
+                        return False
+                elif value == ";":
+                    if depth:
+                        return False
+                    finished = True
+            elif kind == "word":
+                word = value.lower()
+                # A word at the very end may still be growing
+                if at_end:
+                    return self._partial_word_ok(word, previous, aliases)
+                qualifier = stripped.startswith(".", position) and _ALIAS_LIKE.match(word)
+                if not qualifier and not self._word_ok(word, previous, aliases):
+                    return False
+                if previous and (previous[-1] == "as" or previous[-1] in self.tables) and word not in self.words:
+                    aliases.add(word)
+            previous.append(value.lower() if kind in ("word", "op") else kind)
+        return True
+
+    def _word_ok(self, word, previous, aliases):
+        last = previous[-1] if previous else None
+        if last == ".":
+            return word in self.columns or (previous[-2] in self.schemas and word in self.tables)
+        if word in self.words or word in aliases:
+            return True
+        # New alias: "AS x", or "FROM Track t" / "JOIN Album a"
+        return last == "as" or last in self.tables
+
+    def _partial_word_ok(self, word, previous, aliases):
+        last = previous[-1] if previous else None
+        if last == ".":
+            names = self.columns | self.tables if previous[-2] in self.schemas else self.columns
+            return any(name.startswith(word) for name in names)
+        if last == "as" or last in self.tables:
+            return True
+        return (self._is_word_prefix(word) or any(alias.startswith(word) for alias in aliases)
+                or bool(_ALIAS_LIKE.match(word)))
+
+    def is_complete(self, text):
+        """
+        True when text is a viable statement that may end here (balanced, not mid-literal).
+        """
+        stripped = text.strip()
+        if not stripped or not self.is_viable(stripped + " "):
+            return False
+        depth = 0
+        for match in _TOKEN.finditer(stripped):
+            if match.lastgroup == "op":
+                depth += {"(": 1, ")": -1}.get(match.group(), 0)
+            elif match.lastgroup in ("string", "quoted") and len(match.group()) > 1 \
+                    and match.group()[-1] != match.group()[0] and match.group()[0] != "[":
+                return False
+        return depth == 0 and len(stripped) > 6
+
+
+def sql_logits_processor(tokenizer, table_info, top_n=64, rows=None):
+    """
+    LogitsProcessor that masks every token which would make the output an invalid SQL prefix.
+
+    Only the top_n candidates are checked each step (the rest are masked). EOS is allowed only
+    when the statement is complete. If no candidate survives, the step is left unconstrained
+    rather than forcing a dead end. For a batch mixing schemas, rows gives each row's table_info
+    (None leaves that row unconstrained); otherwise every row is checked against table_info.
+    """
+    import torch
+    from transformers import LogitsProcessor, LogitsProcessorList
+
+    if rows is None:
+        validators = None
+        validator = SQLPrefixValidator(table_info)
+    else:
+        validators = [SQLPrefixValidator(row_info) if row_info is not None else None for row_info in rows]
+    pieces = {}
+
+    def piece(token_id):
+        if token_id not in pieces:
+            pieces[token_id] = tokenizer.decode([token_id], skip_special_tokens=False)
+        return pieces[token_id]
+
+    class SQLPrefixLogitsProcessor(LogitsProcessor):
+        def __init__(self):
+            self.masked_steps = 0
+            self.unconstrained_steps = 0
+            self.prompt_length = None
+
+        def __call__(self, input_ids, scores):
+            # Nothing is generated yet on the first call, so everything seen then is prompt
+            # (for encoder-decoder models, just the decoder start token)
+            if self.prompt_length is None:
+                self.prompt_length = input_ids.shape[1]
+            prompt_length = self.prompt_length
+            for row in range(input_ids.shape[0]):
+                row_validator = validator if validators is None else validators[row]
+                if row_validator is None:
+                    continue
+                generated = tokenizer.decode(input_ids[row, prompt_length:], skip_special_tokens=True)
+                candidates = torch.topk(scores[row], min(top_n, scores.shape[-1])).indices.tolist()
+                allowed = []
+                for token_id in candidates:
+                    if token_id == tokenizer.eos_token_id:
+                        if row_validator.is_complete(generated):
+                            allowed.append(token_id)
+                    elif row_validator.is_viable(generated + piece(token_id)):
+                        allowed.append(token_id)
+                if not allowed:
+                    self.unconstrained_steps += 1
+                    continue
+                mask = torch.full_like(scores[row], float("-inf"))
+                mask[allowed] = 0
+                scores[row] = scores[row] + mask
+                self.masked_steps += 1
+            return scores
+
+    return LogitsProcessorList([SQLPrefixLogitsProcessor()])
@@ -0,0 +1,236 @@
+import glob
+import json
+import os
+import re
+import threading
+
+from schema_catalog import file_stat
+
+
+REGISTRY_DIR = os.path.dirname(os.path.abspath(__file__))
+# JSON config of the databases to offer; without one, *.sqlite files in SQL_DATABASE_DIR are discovered
+DATABASES_CONFIG = os.environ.get("SQL_DATABASES_CONFIG", os.path.join(REGISTRY_DIR, "databases.json"))
+DATABASE_DIR = os.environ.get("SQL_DATABASE_DIR", REGISTRY_DIR)
+# Opt-in: also offer every database ATTACHed into one connection, for questions spanning them
+ATTACH_MODE = os.environ.get("SQL_ATTACH_DATABASES", "0") == "1"
+ATTACHED_NAME = "All databases (attached)"
+# SQLite's default SQLITE_MAX_ATTACHED
+MAX_ATTACHED = 10
+
+
+class DatabaseState:
+    """
+    What a database needs warm to answer questions: its schema, schema index and prompt prefix.
+    """
+
+    def __init__(self, table_names, table_info, foreign_keys, schema_index, tables_summary, file_version):
+        self.table_names = table_names
+        self.table_info = table_info
+        self.foreign_keys = foreign_keys
+        self.schema_index = schema_index
+        self.tables_summary = tables_summary
+        self.file_version = file_version
+
+    @property
+    def prompt_prefix(self):
+        """
+        The schema prefix requests build for this database when its whole schema is sent (see
+        sql_functions.prompt_schema), i.e. the prefix the prefix cache holds.
+        """
+        from sql_functions import SQL_PROMPT_TEMPLATE, schema_prefix
+
+        return schema_prefix(SQL_PROMPT_TEMPLATE, {"tables_summary": self.tables_summary, "question": ""})
+
+
+class Database:
+    """
+    One registered database: a name, where it lives and how the apps describe it.
+
+    Nothing is opened until warm() (or a job) first uses it; the state is then kept until the
+    file changes.
+    """
+
+    def __init__(self, name, path, erd=None, description=None, attached=None, immutable=False):
+        self.name = name
+        self.path = path
+        self.erd = erd
+        self.description = description
+        # {schema: path} for a database made of several ATTACHed files
+        self.attached = attached
+        # Opened with immutable=1 (no locking or change detection): only for files nothing ever writes
+        self.immutable = immutable
+        self._state = None
+        self._lock = threading.Lock()
+
+    @property
+    def exists(self):
+        if self.attached:
+            return all(os.path.isfile(path) for path in self.attached.values())
+        return os.path.isfile(self.path)
+
+    def _file_version(self):
+        paths = sorted(self.attached.values()) if self.attached else [self.path]
+        return tuple(file_stat(path) for path in paths)
+
+    def warm(self):
+        """
+        The DatabaseState, loading it on first use and again after the file changed.
+
+        Returns None if the database can't be opened or has no tables.
+        """
+        from schema_linking import get_schema_index
+        from sql_functions import connect_db, get_foreign_keys, get_table_info, release_db
+
+        with self._lock:
+            if not self.exists:
+                return None
+            file_version = self._file_version()
+            if self._state is not None and self._state.file_version == file_version:
+                return self._state
+            conn = connect_db(self.path)
+            if conn is None:
+                return None
+            try:
+                table_names, table_info = get_table_info(conn)
+                if not table_info:
+                    return None
+                foreign_keys = get_foreign_keys(conn)
+            finally:
+                release_db(conn)
+            schema_index = get_schema_index(table_info, foreign_keys)
+            self._state = DatabaseState(table_names, table_info, foreign_keys, schema_index,
+                                        schema_index.full_schema(), file_version)
+            return self._state
+
+
+def schema_name(name):
+    """
+    SQL identifier used as the ATTACH schema for a database name ("E-commerce" -> "e_commerce").
+    """
+    schema = re.sub(r"\W+", "_", name.strip().lower()).strip("_") or "db"
+    return "_" + schema if schema[0].isdigit() else schema
+
+
+def attach_pool(database, immutables=()):
+    """
+    Register the connection pool of an attached database, once; its path is then usable with connect_db().
+    """
+    from connection_pool import AttachedPool, default_pools
+
+    if not default_pools.has_pool(database.path):
+        default_pools.register(AttachedPool(database.path, database.attached, immutables=immutables))
+
+
+def immutable_pool(database):
+    """
+    Register an immutable connection pool for a database configured as never written, once.
+    """
+    from connection_pool import ConnectionPool, default_pools
+
+    if not default_pools.has_pool(os.path.abspath(database.path)):
+        default_pools.register(ConnectionPool(database.path, immutable=True))
+
+
+def discover_databases(directory=DATABASE_DIR):
+    """
+    {file stem: path} of the *.sqlite files in directory.
+    """
+    return {os.path.splitext(os.path.basename(db_path))[0]: db_path
+            for db_path in sorted(glob.glob(os.path.join(directory, "*.sqlite")))}
+
+
+def parse_databases(databases, base_dir):
+    """
+    Databases from a config mapping of name -> path or name -> {"path", "erd", "description", "immutable"}.
+
+    Relative paths (database and ERD image) are resolved against base_dir. "immutable": true opts a
+    file that is never written into SQLite's immutable mode; by default databases are opened mode=ro.
+    """
+    parsed = {}
+    for name, spec in databases.items():
+        if isinstance(spec, str):
+            spec = {"path": spec}
+        erd = spec.get("erd")
+        parsed[name] = Database(name, os.path.join(base_dir, spec["path"]),
+                                erd=os.path.join(base_dir, erd) if erd else None, description=spec.get("description"),
+                                immutable=spec.get("immutable") is True)
+    return parsed
+
+
+class DatabaseRegistry:
+    """
+    The databases the apps and the service can query, by name, in configured order.
+    """
+
+    def __init__(self, databases, attach_mode=ATTACH_MODE):
+        self.databases = dict(databases)
+        self.attach_mode = attach_mode
+        for database in self.databases.values():
+            if database.immutable and not database.attached:
+                immutable_pool(database)
+        if attach_mode and len(self.databases) > 1:
+            self.databases[ATTACHED_NAME] = self.attached()
+
+    @classmethod
+    def load(cls, config_path=DATABASES_CONFIG, directory=DATABASE_DIR, attach_mode=ATTACH_MODE):
+        """
+        Registry from the JSON config ({"databases": {name: spec}}), or by discovering *.sqlite files.
+        """
+        if config_path and os.path.isfile(config_path):
+            with open(config_path, "r", encoding="utf-8") as f:
+                config = json.load(f)
+            databases = parse_databases(config.get("databases", {}),
+                                        os.path.dirname(os.path.abspath(config_path)))
+        else:
+            databases = parse_databases(discover_databases(directory), directory)
+        return cls(databases, attach_mode=attach_mode)
+
+    def names(self):
+        """
+        Names of the databases whose files exist, in configured order.
+        """
+        return [name for name, database in self.databases.items() if database.exists]
+
+    def get(self, name):
+        if name not in self.databases:
+            raise KeyError(f"unknown database {name!r}; known: {', '.join(self.databases)}")
+        return self.databases[name]
+
+    def attached(self, names=None, name=ATTACHED_NAME):
+        """
+        A Database ATTACHing the named databases (default: all, up to MAX_ATTACHED) into each
+        connection, so one query can join across them as schema.table.
+
+        Its connection pool is registered here but opens no connection until first checkout.
+        """
+        names = [db_name for db_name in (names or list(self.databases))
+                 if not self.databases[db_name].attached and self.databases[db_name].exists][:MAX_ATTACHED]
+        attached, immutables = {}, set()
+        for db_name in names:
+            schema = base = schema_name(db_name)
+            suffix = 2
+            while schema in attached:
+                schema, suffix = f"{base}_{suffix}", suffix + 1
+            attached[schema] = self.databases[db_name].path
+            if self.databases[db_name].immutable:
+                immutables.add(schema)
+        description = ("Databases attached into one connection; tables are named schema.table ("
+                       + ", ".join(f"{schema} = {db_name}" for schema, db_name in zip(attached, names)) + ").")
+        database = Database(name, "attach:" + "+".join(attached), description=description, attached=attached)
+        attach_pool(database, immutables)
+        return database
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_database_registry():
+    """
+    Process-wide registry, loaded on first use.
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = DatabaseRegistry.load()
+        return _registry
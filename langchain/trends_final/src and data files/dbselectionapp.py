@@ -1,52 +1,32 @@
-import os
-import sqlite3
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
-from langchain_community.llms import HuggingFacePipeline
+import time
 import streamlit as st
-import pandas as pd  # For result handling
-from sql_functions import connect_db, get_table_info, llm_create_sql
+from jobs import FINISHED, POLL_SECONDS, job_manager
+from db_registry import get_database_registry
+from warmup import get_warmer
+from constrained_decoding import CONSTRAINED_DECODING
+from sql_streaming import STREAM_TOKENS
+from instrumentation import render_debug_panel, span, start_trace
+from query_guard import QueryTimeout
+from result_stream import EXPORT_FORMATS, available_export_formats, preview_page
 import warnings
 warnings.filterwarnings("ignore", category=UserWarning)
 
 
-# Initialize Local LLM
+# Local LLM, loaded lazily on the first question and kept warm by the shared model registry
 model_id = 'NumbersStation/nsql-350M'  # Replace with your local model
-tokenizer = AutoTokenizer.from_pretrained(model_id)
-model = AutoModelForCausalLM.from_pretrained(model_id, load_in_8bit=False)
-
-pipe = pipeline(
-    "text2text-generation",
-    model=model,
-    tokenizer=tokenizer,
-    max_length=10000,
-)
-
-local_llm = HuggingFacePipeline(pipeline=pipe)
-
-# Database filepaths
-databases = {
-    "Chinook": {
-        "path": r"C:\Users\mehul\OneDrive\Documents\Trends Marketplace\trendsRepo\text-to-sql\src\app\Chinook_Sqlite.sqlite",  # Replace with your Chinook database path
-        "erd": "chinook_erd.png"
-    },
-    "E-commerce": {
-        "path": r"C:\Users\mehul\OneDrive\Documents\Trends Marketplace\trendsRepo\text-to-sql\src\app\olist.sqlite",  # Replace with your E-commerce database path
-        "erd": "ecommerce_erd.png"
-    },
-    "Pets-stackexchange": {
-        "path": r"C:\Users\mehul\OneDrive\Documents\Trends Marketplace\trendsRepo\text-to-sql\src\app\pets_stackexchange.sqlite",  # Replace with your E-commerce database path
-        "erd": "ecommerce_erd.png"
-    }
-}
-
-def sql_copilot(language_model=local_llm):
+
+# Databases from databases.json (or the *.sqlite files found next to the app); each is opened on first use
+databases = get_database_registry()
+
+def sql_copilot(language_model=None):
     st.title("langChain Based SQL Assistant")
     st.markdown("### LLM-Powered SQL Assistant")
 
     # Database selection
-    db_choice = st.selectbox("Select the database", list(databases.keys()))
-    db_filepath = databases[db_choice]["path"]
-    erd_image = databases[db_choice]["erd"]
+    db_choice = st.selectbox("Select the database", databases.names())
+    database = databases.get(db_choice)
+    db_filepath = database.path
+    erd_image = database.erd
 
     # Input query
     user_question = st.text_input("Enter your question here", "")
@@ -55,63 +35,117 @@ def sql_copilot(language_model=local_llm):
     tabs = st.tabs(["Result", "Query", "ERD"])
 
     # Check if query is provided
-    if user_question:
-        # Connect to the selected database
-        conn = connect_db(db_filepath)
-        if not conn:
-            st.error("Failed to connect to the database.")
-            return
+    # Opt-in per-stage timings for this script run
+    show_debug = st.sidebar.checkbox("Show pipeline timings")
+    # Connections, schemas, page cache and the model are warmed in the background, once per process;
+    # started by the first run rather than at import, which must not load the model's dependencies
+    warmer = get_warmer(databases, model_id=model_id)
+    if not warmer.ready():
+        st.sidebar.caption("Warming up the model and databases; the first answer may take longer.")
+    spans = start_trace(show_debug)
 
-        # Retrieve table info
-        table_names, table_info = get_table_info(conn)
-        if not table_info:
-            st.error("No valid tables found in the database.")
+    if user_question:
+        # Each question runs as a background job kept in session state; reruns (widget clicks)
+        # only redraw its current state, and other questions can be asked while it runs
+        job = job_manager.session_job(st.session_state, db_filepath, user_question,
+                                      export_format=st.session_state.get("export_format", "CSV"),
+                                      model_id=model_id, language_model=language_model, trace_spans=show_debug,
+                                      stream_tokens=STREAM_TOKENS, constrained=CONSTRAINED_DECODING)
+
+        if job.error_stage == "connect":
+            st.error(job.error)
             return
 
-        # Generate SQL query
         with tabs[1]:  # "Query" tab
             st.markdown("#### Generated SQL Query")
-            try:
-                sql_query = llm_create_sql(table_info=table_info, question=user_question, lang_model=language_model)
-                # Display the query as a readable block without a scroller
-                st.text_area("SQL Query", value=sql_query, height=200, max_chars=None)
-            except Exception as e:
-                st.error(f"Error generating SQL query: {e}")
-                return
-
-        # Execute the query and display results
+            if job.error_stage == "generate":
+                st.error(f"Error generating SQL query: {job.error}")
+            elif job.sql is not None:
+                st.text_area("SQL Query", value=job.sql, height=200, max_chars=None)
+            elif job.status == "cancelled":
+                st.info("Cancelled.")
+            elif job.partial_sql:
+                st.code(job.partial_sql, language="sql")
+            else:
+                st.info("Loading the model and generating SQL..." if job.status == "generating" else "Queued...")
+
         with tabs[0]:  # "Result" tab
             st.markdown("#### Query Results")
-            try:
-                cursor = conn.cursor()
-                cursor.execute(sql_query)
-                result = cursor.fetchall()
-
-                # Fetch column names
-                columns = [desc[0] for desc in cursor.description]
-
-                # Convert to a pandas DataFrame
-                result_df = pd.DataFrame(result, columns=columns)
-
-                if not result_df.empty:
-                    st.dataframe(result_df)  # Display results as a table
+            if job.guard is not None and job.guard.rejected:
+                st.error(f"Query not executed: {job.guard.rejected}.")
+            elif job.error_stage == "execute":
+                if isinstance(job.error, QueryTimeout):
+                    st.error(f"Query stopped: {job.error}. Try a more specific question.")
+                else:
+                    st.error(f"Error executing SQL query: {job.error}")
+            elif job.guard is not None:
+                for warning in job.guard.warnings:
+                    st.caption(f"Note: {warning}")
+                export_format = st.selectbox("Download format", available_export_formats(), key="export_format")
+                result = job.results.get(export_format)
+                if result is None:
+                    # Runs only the execution stage again; the SQL is reused
+                    job_manager.execute(job, export_format)
+                    st.info("Cancelled." if job.status == "cancelled" else "Running query...")
+                elif result.row_count:
+                    page_count = preview_page(result, 1)[1]
+                    page = st.number_input("Page", min_value=1, max_value=page_count, value=1) if page_count > 1 else 1
+                    page_rows, _ = preview_page(result, page)
+                    with span("dataframe", rows=len(page_rows)):
+                        import pandas as pd  # Loaded on the first result, not at app start
+
+                        page_df = pd.DataFrame(page_rows, columns=result.columns)
+                    st.dataframe(page_df)  # Display results as a table
+                    if result.cache_hit:
+                        st.caption("Result served from cache; the database has not changed since it was run.")
+                    if result.truncated:
+                        st.warning(f"Result truncated after {result.row_count:,} rows: {result.truncation_reason}.")
+                    elif result.row_count > len(result.preview_rows):
+                        st.caption(f"Previewing the first {len(result.preview_rows):,} of {result.row_count:,} rows; "
+                                   "download for the full result.")
+                    extension, mime = EXPORT_FORMATS[export_format]
                     st.download_button(
-                        label="Download Results as CSV",
-                        data=result_df.to_csv(index=False),
-                        file_name="query_results.csv",
-                        mime="text/csv"
+                        label=f"Download Results as {export_format}",
+                        data=result.export_stream(),
+                        file_name=f"query_results.{extension}",
+                        mime=mime
                     )
+                    # Only answers the user confirms become few-shot examples for later questions
+                    if job.example_saved:
+                        st.caption("Saved as an example for similar questions.")
+                    elif st.button("This answer is correct"):
+                        job_manager.save_example(job)
+                        st.rerun()
                 else:
                     st.info("Query executed successfully but returned no results.")
-            except sqlite3.Error as e:
-                st.error(f"Error executing SQL query: {e}")
-            finally:
-                conn.close()
+            elif job.status not in FINISHED:
+                st.info("Waiting for the generated SQL...")
 
         # ERD visualization
         with tabs[2]:  # "ERD" tab
             st.markdown("#### Entity-Relationship Diagram (ERD)")
-            st.image(erd_image, caption=f"{db_choice} Database ERD")
+            if erd_image:
+                st.image(erd_image, caption=f"{db_choice} Database ERD")
+            else:
+                st.caption("No ERD is configured for this database.")
+
+        if job.in_flight and st.button(f"Cancel {job.id}"):
+            job.cancel()
+        if job.status in ("failed", "cancelled") and st.button("Retry"):
+            job_manager.retry(st.session_state, job)
+            st.rerun()
+
+        # Recent questions of this session and where they are
+        for session_job in reversed(st.session_state["jobs"].values()):
+            st.sidebar.caption(f"{session_job.id} · {session_job.status} · {session_job.question[:40]}")
+
+        if show_debug:
+            render_debug_panel(st, job.spans + spans)
+
+        # Poll until the job finishes; each rerun is cheap because nothing is recomputed
+        if job.in_flight:
+            time.sleep(POLL_SECONDS)
+            st.rerun()
 
 if __name__ == '__main__':
     sql_copilot()
@@ -0,0 +1,244 @@
+import argparse
+import json
+import os
+import threading
+import time
+import zlib
+
+from instrumentation import span
+from nl2sql_cache import normalize_question
+from schema_linking import count_tokens, question_tokens
+
+
+EXAMPLES_DIR = os.path.dirname(os.path.abspath(__file__))
+EXAMPLE_STORE_PATH = os.environ.get("SQL_EXAMPLE_STORE", os.path.join(EXAMPLES_DIR, "examples.jsonl"))
+SEED_QUESTIONS_PATH = os.path.join(EXAMPLES_DIR, "benchmark_questions.json")
+# Examples per prompt, the prompt tokens they may use, and the least similarity worth showing
+EXAMPLE_K = int(os.environ.get("SQL_EXAMPLE_K", 3))
+EXAMPLE_TOKEN_BUDGET = int(os.environ.get("SQL_EXAMPLE_TOKENS", 256))
+MIN_SIMILARITY = 0.3
+# Width of the hashed feature vectors
+FEATURE_DIM = 4096
+
+
+def embed_question(question):
+    """
+    L2-normalized hashed bag of word stems (weight 2) and character trigrams (weight 1).
+    """
+    import numpy as np
+
+    vector = np.zeros(FEATURE_DIM, dtype=np.float32)
+    for token in question_tokens(question):
+        vector[zlib.crc32(b"w:" + token.encode("utf-8")) % FEATURE_DIM] += 2.0
+    padded = f"  {normalize_question(question)} "
+    for i in range(len(padded) - 2):
+        vector[zlib.crc32(b"c:" + padded[i:i + 3].encode("utf-8")) % FEATURE_DIM] += 1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class Example:
+    """
+    A validated (question, SQL) pair for one database schema.
+    """
+
+    def __init__(self, question, sql, fingerprint, db="", source="seed"):
+        self.question = question
+        self.sql = sql
+        self.fingerprint = fingerprint
+        self.db = db
+        self.source = source
+
+    def to_json(self):
+        return {"question": self.question, "sql": self.sql, "fingerprint": self.fingerprint, "db": self.db,
+                "source": self.source}
+
+
+class ExampleStore:
+    """
+    Few-shot examples per schema fingerprint with a vectorized similarity index (NumPy, imported on first search).
+
+    Each schema's questions are embedded into one float32 matrix, so a lookup is a single
+    matrix-vector product and an argpartition. Added examples are appended to a JSONL file
+    (path=None keeps them in memory only). With exclude_exact, a stored example with the same
+    normalized question is never returned (used by the benchmark to hold out the gold answer).
+    """
+
+    def __init__(self, path=EXAMPLE_STORE_PATH, exclude_exact=False):
+        self.path = path
+        self.exclude_exact = exclude_exact
+        self._examples = {}  # fingerprint -> [Example]
+        self._keys = set()  # (fingerprint, normalized question)
+        self._matrices = {}  # fingerprint -> (len, float32 matrix)
+        self._lock = threading.Lock()
+        if path and os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self._add(Example(**json.loads(line)))
+                    except (ValueError, TypeError):
+                        continue  # A line cut short by a crash
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _add(self, example):
+        key = (example.fingerprint, normalize_question(example.question))
+        if key in self._keys:
+            return False
+        self._keys.add(key)
+        self._examples.setdefault(example.fingerprint, []).append(example)
+        return True
+
+    def add(self, question, sql, fingerprint, db="", source="run"):
+        """
+        Keep a validated pair (ignored if the question is already stored for this schema).
+        """
+        example = Example(question, sql.strip(), fingerprint, db, source)
+        with self._lock:
+            if not self._add(example):
+                return False
+            if self.path:
+                try:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(example.to_json()) + "\n")
+                except OSError as e:
+                    print(f"Could not save example to {self.path}: {e}")
+        return True
+
+    def _matrix(self, fingerprint):
+        import numpy as np
+
+        examples = self._examples.get(fingerprint, [])
+        cached = self._matrices.get(fingerprint)
+        if cached is not None and cached[0] == len(examples):
+            return cached[1]
+        rows = [] if cached is None else [cached[1]]
+        start = 0 if cached is None else cached[0]
+        rows.append(np.stack([embed_question(example.question) for example in examples[start:]])
+                    if len(examples) > start else np.zeros((0, FEATURE_DIM), dtype=np.float32))
+        matrix = np.concatenate(rows) if len(rows) > 1 else rows[0]
+        self._matrices[fingerprint] = (len(examples), matrix)
+        return matrix
+
+    def search(self, question, fingerprint, k=EXAMPLE_K, min_similarity=MIN_SIMILARITY):
+        """
+        [(similarity, Example)] of the k most similar stored questions for this schema, best first.
+        """
+        import numpy as np
+
+        with self._lock:
+            examples = self._examples.get(fingerprint)
+            if not examples:
+                return []
+            matrix = self._matrix(fingerprint)
+            examples = examples[:matrix.shape[0]]
+        scores = matrix @ embed_question(question)
+        if self.exclude_exact:
+            normalized = normalize_question(question)
+            for i, example in enumerate(examples):
+                if normalize_question(example.question) == normalized:
+                    scores[i] = -1.0
+        k = min(k, len(examples))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), examples[i]) for i in top if scores[i] >= min_similarity]
+
+    def seed(self, questions_path=SEED_QUESTIONS_PATH):
+        """
+        Add the (question, gold SQL) pairs of a benchmark-style JSON file for the databases present.
+        """
+        from nl2sql_cache import schema_fingerprint
+        from sql_functions import connect_db, get_table_info, release_db
+
+        with open(questions_path, "r", encoding="utf-8") as f:
+            questions = json.load(f)
+        added = 0
+        base_dir = os.path.dirname(os.path.abspath(questions_path))
+        for db_name, items in questions.items():
+            conn = connect_db(os.path.join(base_dir, db_name))
+            if conn is None:
+                continue
+            try:
+                _, table_info = get_table_info(conn)
+            finally:
+                release_db(conn)
+            if not table_info:
+                continue
+            fingerprint = schema_fingerprint(table_info)
+            for item in items:
+                added += self.add(item["question"], item["gold"], fingerprint, db_name, source="seed")
+        return added
+
+
+def render_examples(matches, budget_tokens=EXAMPLE_TOKEN_BUDGET, tokenizer=None):
+    """
+    Prompt block with as many of the matches (best first) as fit in budget_tokens; "" if none fit.
+    """
+    lines, used = [], 0
+    for _, example in matches:
+        block = f"        Question: {example.question}\n        SQL: {example.sql.rstrip(';')};\n"
+        tokens = count_tokens(block, tokenizer)
+        if used + tokens > budget_tokens:
+            break
+        lines.append(block)
+        used += tokens
+    if not lines:
+        return ""
+    return "\n        Examples of questions answered with SQL on this database:\n" + "".join(lines)
+
+
+def examples_for_prompt(store, question, fingerprint, tokenizer=None, k=EXAMPLE_K,
+                        budget_tokens=EXAMPLE_TOKEN_BUDGET):
+    """
+    The examples block for llm_create_sql's prompt, timed as the "examples" stage.
+    """
+    with span("examples") as s:
+        matches = store.search(question, fingerprint, k=k)
+        block = render_examples(matches, budget_tokens, tokenizer)
+        s.set(examples=block.count("Question:"), best=round(matches[0][0], 3) if matches else None)
+    return block
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_example_store():
+    """
+    Process-wide store at SQL_EXAMPLE_STORE, seeded from benchmark_questions.json when first created.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ExampleStore()
+            if not len(_store) and os.path.isfile(SEED_QUESTIONS_PATH):
+                print(f"Seeded {_store.seed()} few-shot examples from {SEED_QUESTIONS_PATH}")
+        return _store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Query the few-shot example store and time its lookups.")
+    parser.add_argument("question")
+    parser.add_argument("--db", default="Chinook_Sqlite.sqlite")
+    parser.add_argument("-k", type=int, default=EXAMPLE_K)
+    args = parser.parse_args()
+
+    from nl2sql_cache import schema_fingerprint
+    from sql_functions import connect_db, get_table_info, release_db
+
+    store = get_example_store()
+    conn = connect_db(args.db)
+    try:
+        _, table_info = get_table_info(conn)
+    finally:
+        release_db(conn)
+    fingerprint = schema_fingerprint(table_info)
+    store.search(args.question, fingerprint, k=args.k)
+    start = time.perf_counter()
+    for _ in range(1000):
+        matches = store.search(args.question, fingerprint, k=args.k)
+    elapsed = (time.perf_counter() - start) / 1000
+    for score, example in matches:
+        print(f"{score:.3f}  {example.question}\n       {example.sql}")
+    print(f"{len(store)} examples; lookup {elapsed * 1e6:.0f}us")
@@ -0,0 +1,417 @@
+import argparse
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import CancelledError, Future, TimeoutError as FutureTimeout
+
+from instrumentation import count, span
+from model_registry import DEFAULT_MODEL_ID, default_registry
+from sql_streaming import MAX_NEW_TOKENS, SQLCompletionDetector, max_new_tokens_for
+
+
+MAX_BATCH_SIZE = int(os.environ.get("SQL_MAX_BATCH_SIZE", 8))
+MAX_WAIT_MS = float(os.environ.get("SQL_BATCH_WAIT_MS", 20))
+# Seconds a caller waits for its generation before giving up
+GENERATION_TIMEOUT = float(os.environ.get("SQL_GENERATION_TIMEOUT", 300))
+# How often a waiting caller checks its cancel event
+CANCEL_POLL_SECONDS = 0.05
+
+
+class GenerationRequest:
+    """
+    One queued prompt; with table_info, its decoding is constrained to valid SQL over that schema,
+    and with on_text, on_text(partial_sql) is called as its tokens are generated. Once
+    cancel_event is set, the prompt is dropped from the queue or stopped at its next token.
+    prefix is the start of prompt whose key/values may come from the model's PrefixCache.
+    """
+
+    def __init__(self, prompt, table_info=None, on_text=None, cancel_event=None, prefix=None):
+        self.prompt = prompt
+        self.table_info = table_info
+        self.on_text = on_text
+        self.cancel_event = cancel_event
+        self.prefix = prefix
+        self.error = None  # raised by on_text, or CancelledError; stops this prompt only
+
+    def cancelled(self):
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+
+def _row_stopping_criteria(tokenizer, prompt_length, requests):
+    import torch
+    from transformers import StoppingCriteria, StoppingCriteriaList
+
+    class StatementsComplete(StoppingCriteria):
+        """
+        Per-row stop: each prompt of the batch finishes at the end of its own SQL statement.
+        """
+
+        def __init__(self):
+            self.decoded = 0
+            self.detectors = [SQLCompletionDetector() for _ in requests]
+            self.done = [False] * len(requests)
+
+        def __call__(self, input_ids, scores, **kwargs):
+            new_tokens = input_ids[:, prompt_length + self.decoded:]
+            self.decoded += new_tokens.shape[1]
+            for row, (request, detector) in enumerate(zip(requests, self.detectors)):
+                if self.done[row]:
+                    continue
+                if request.cancelled():
+                    request.error = CancelledError()
+                    self.done[row] = True
+                    continue
+                done = detector.feed(tokenizer.decode(new_tokens[row], skip_special_tokens=True))
+                if request.on_text is not None and detector.start is not None:
+                    try:
+                        request.on_text(detector.statement())
+                    except Exception as e:
+                        request.error = e
+                        done = True
+                self.done[row] = done
+            return torch.tensor(self.done, dtype=torch.bool, device=input_ids.device)
+
+    return StoppingCriteriaList([StatementsComplete()])
+
+
+class GenerationServer:
+    """
+    Dynamic micro-batching front end for one local causal language model.
+
+    Prompts submitted from any thread are queued; a single worker thread takes the first
+    waiting prompt, keeps collecting for up to max_wait_ms (or until max_batch_size), groups
+    the batch into buckets of similar token length to limit padding, and runs each bucket
+    through model.generate together. Prompts submitted with a schema are decoded under the SQL
+    grammar mask (constrained_decoding.py), row by row, in the same batch as the others; each
+    prompt stops at the end of its statement and can stream its partial SQL to a callback. A
+    prompt decoded on its own reuses the cached key/values of its schema prefix (prefix_cache.py);
+    batched prompts share one prefill instead. submit() returns a Future with the generated text.
+    close() releases the model (the registry does this when it evicts the model).
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS,
+                 bucket_width=64, max_new_tokens=MAX_NEW_TOKENS):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.bucket_width = bucket_width
+        self.max_new_tokens = max_new_tokens
+        self.batches = 0
+        self.prompts = 0
+        self._queue = queue.Queue()
+        self._stopped = threading.Event()
+        self._worker = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+        # Decoder-only models need left padding so every prompt ends right before generation
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.tokenizer.padding_side = "left"
+
+    def start(self):
+        with self._lock:
+            if not self._closed and (self._worker is None or not self._worker.is_alive()):
+                self._stopped.clear()
+                self._worker = threading.Thread(target=self._run, name="generation-server", daemon=True)
+                self._worker.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._worker is not None:
+            self._worker.join()
+
+    def close(self):
+        """
+        Stop serving and drop the model so its memory can be freed; queued prompts fail and
+        later submits raise.
+        """
+        with self._lock:
+            self._closed = True
+            self._stopped.set()
+            self.model = None
+        error = RuntimeError("generation server closed: its model was unloaded")
+        while True:
+            try:
+                _, future = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if future.set_running_or_notify_cancel():
+                future.set_exception(error)
+
+    def submit(self, prompt, table_info=None, on_text=None, cancel_event=None, prefix=None):
+        """
+        Queue a prompt (constrained to table_info's schema when given, streaming partial SQL to
+        on_text when given, abandoned once cancel_event is set, reusing prefix's cached
+        key/values when given); the returned Future resolves to the generated continuation.
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("generation server closed: its model was unloaded")
+            self._queue.put((GenerationRequest(prompt, table_info, on_text, cancel_event, prefix), future))
+        self.start()
+        return future
+
+    def generate(self, prompts):
+        """
+        Generate for a list of prompts through the batching queue and wait for all of them.
+        """
+        futures = [self.submit(prompt) for prompt in prompts]
+        return [future.result(timeout=GENERATION_TIMEOUT) for future in futures]
+
+    def _collect(self):
+        try:
+            batch = [self._queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopped.is_set():
+            batch = []
+            for request, future in self._collect():
+                if request.cancelled():
+                    future.cancel()
+                elif future.set_running_or_notify_cancel():
+                    batch.append((request, future))
+            if not batch:
+                continue
+            try:
+                self._serve(batch)
+            except BaseException as e:
+                # The worker must outlive any batch: otherwise every queued caller waits forever
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                if not isinstance(e, Exception):
+                    raise
+
+    def _serve(self, batch):
+        buckets = defaultdict(list)
+        for request, future in batch:
+            try:
+                length = len(self.tokenizer.encode(request.prompt))
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            buckets[length // self.bucket_width].append((request, future))
+
+        for items in buckets.values():
+            try:
+                outputs = self._generate_batch([request for request, _ in items])
+                if len(outputs) != len(items):
+                    raise RuntimeError(f"model returned {len(outputs)} outputs for {len(items)} prompts")
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+            for (request, future), text in zip(items, outputs):
+                if request.error is not None:
+                    future.set_exception(request.error)
+                else:
+                    future.set_result(text)
+
+    def _generate_batch(self, requests):
+        import torch
+
+        from prefix_cache import prefix_cached_inputs, supports_prefix_caching
+
+        model = self.model
+        if model is None:
+            raise RuntimeError("generation server closed: its model was unloaded")
+        prompts = [request.prompt for request in requests]
+        prefix = requests[0].prefix
+        if len(requests) == 1 and prefix and prompts[0].startswith(prefix) and supports_prefix_caching(model):
+            inputs = prefix_cached_inputs(model, self.tokenizer, prefix, prompts[0][len(prefix):])
+        else:
+            with span("tokenize", batch=len(prompts)):
+                inputs = self.tokenizer(prompts, return_tensors="pt", padding=True)
+        prompt_length = inputs["input_ids"].shape[1]
+        logits_processor = None
+        if any(request.table_info is not None for request in requests):
+            from constrained_decoding import sql_logits_processor
+
+            logits_processor = sql_logits_processor(self.tokenizer, None,
+                                                    rows=[request.table_info for request in requests])
+        with span("model_generate", batch=len(prompts), constrained=logits_processor is not None) as s:
+            with torch.inference_mode():
+                output_ids = model.generate(
+                    **inputs,
+                    max_new_tokens=min(self.max_new_tokens, max_new_tokens_for(prompt_length)),
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    do_sample=False,
+                    logits_processor=logits_processor,
+                    stopping_criteria=_row_stopping_criteria(self.tokenizer, prompt_length, requests),
+                )
+            new_tokens = output_ids[:, prompt_length:]
+            tokens_in = int(inputs["attention_mask"].sum())
+            tokens_out = int((new_tokens != self.tokenizer.pad_token_id).sum())
+            s.set(tokens_in=tokens_in, tokens_out=tokens_out)
+        count("model_tokens_in", tokens_in)
+        count("model_tokens_out", tokens_out)
+        self.batches += 1
+        self.prompts += len(prompts)
+        return self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "prompts": self.prompts,
+            "mean_batch_size": self.prompts / self.batches if self.batches else 0.0,
+            "queued": self._queue.qsize(),
+        }
+
+
+def wait_for(future, cancel_event=None, timeout=GENERATION_TIMEOUT):
+    """
+    Result of a submitted prompt. Raises TimeoutError after timeout and CancelledError once
+    cancel_event is set; either way a prompt that is still queued is cancelled.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = max(0.0, deadline - time.monotonic())
+        try:
+            return future.result(timeout=remaining if cancel_event is None else min(remaining, CANCEL_POLL_SECONDS))
+        except FutureTimeout:
+            if cancel_event is not None and cancel_event.is_set():
+                future.cancel()  # A running prompt stops at its next token instead
+                raise CancelledError()
+            if time.monotonic() >= deadline:
+                future.cancel()  # Drops it from the queue if the batch hasn't started
+                raise
+
+
+_servers = {}
+_servers_lock = threading.Lock()
+
+
+def get_generation_server(model_id=DEFAULT_MODEL_ID):
+    """
+    Process-wide GenerationServer for model_id, sharing the model held by the model registry.
+
+    The server lives as long as the registry keeps its model: eviction closes it, and a reloaded
+    model gets a new server.
+    """
+    # Outside _servers_lock: loading may evict another model, which calls _drop_server
+    entry = default_registry.get_entry(model_id)
+    with _servers_lock:
+        server = _servers.get(model_id)
+        if server is None or server.model is not entry.model:
+            if server is not None:
+                server.close()
+            server = GenerationServer(entry.model, entry.tokenizer).start()
+            _servers[model_id] = server
+        return server
+
+
+def _drop_server(entry):
+    with _servers_lock:
+        server = _servers.get(entry.model_id)
+        if server is None or server.model is not entry.model:
+            return
+        del _servers[entry.model_id]
+    server.close()
+    print(f"Closed the generation server for {entry.model_id}")
+
+
+default_registry.add_eviction_listener(_drop_server)
+
+
+def generate_sql_batch(questions, db_path, model_id=DEFAULT_MODEL_ID, top_k=4):
+    """
+    Translate many questions against one database in a single pass, for offline bulk jobs.
+
+    Returns the SQL strings in the same order as questions.
+    """
+    from schema_linking import get_schema_index
+    from sql_functions import (build_tables_summary, connect_db, extract_sql, format_sql_prompt,
+                               get_foreign_keys, get_table_info, release_db)
+
+    conn = connect_db(db_path)
+    if conn is None:
+        raise FileNotFoundError(db_path)
+    try:
+        _, table_info = get_table_info(conn)
+        if not table_info:
+            raise ValueError(f"No valid tables found in {db_path}")
+        schema_index = get_schema_index(table_info, get_foreign_keys(conn))
+    finally:
+        release_db(conn)
+
+    server = get_generation_server(model_id)
+    prompts = [
+        format_sql_prompt(build_tables_summary(table_info, question, schema_index=schema_index, top_k=top_k,
+                                               tokenizer=server.tokenizer), question)
+        for question in questions
+    ]
+    return [extract_sql(text) for text in server.generate(prompts)]
+
+
+def measure_throughput(server, prompts, concurrency_levels=(1, 2, 4, 8)):
+    """
+    Questions/sec when `concurrency` client threads each submit prompts one at a time.
+    """
+    results = {}
+    for concurrency in concurrency_levels:
+        work = queue.Queue()
+        for prompt in prompts:
+            work.put(prompt)
+
+        def client():
+            while True:
+                try:
+                    prompt = work.get_nowait()
+                except queue.Empty:
+                    return
+                server.submit(prompt).result()
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=client) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        results[concurrency] = len(prompts) / elapsed
+        print(f"concurrency={concurrency}: {results[concurrency]:.2f} questions/sec")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure batched generation throughput on a bundled database.")
+    parser.add_argument("--db", default="Chinook_Sqlite.sqlite")
+    parser.add_argument("--model", default=DEFAULT_MODEL_ID)
+    parser.add_argument("--questions", type=int, default=32)
+    parser.add_argument("--concurrency", default="1,2,4,8")
+    args = parser.parse_args()
+
+    from sql_functions import build_tables_summary, connect_db, format_sql_prompt, get_table_info, release_db
+
+    conn = connect_db(args.db)
+    _, table_info = get_table_info(conn)
+    release_db(conn)
+    tables_summary = build_tables_summary(table_info, "")
+    sample_questions = [
+        "How many customers are there?",
+        "List the ten longest tracks.",
+        "What is the total of all invoices per billing country?",
+        "Which artists have more than five albums?",
+    ]
+    prompts = [format_sql_prompt(tables_summary, sample_questions[i % len(sample_questions)])
+               for i in range(args.questions)]
+    measure_throughput(get_generation_server(args.model), prompts,
+                       [int(level) for level in args.concurrency.split(",")])
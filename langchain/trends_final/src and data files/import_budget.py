@@ -0,0 +1,91 @@
+import argparse
+import os
+import subprocess
+import sys
+
+
+BUDGET_DIR = os.path.dirname(os.path.abspath(__file__))
+# Cumulative import time allowed per module, on top of what `import streamlit` costs by itself
+IMPORT_BUDGET_MS = float(os.environ.get("SQL_IMPORT_BUDGET_MS", 500))
+# Modules the UI, schema browsing and the service must not import until generation or a DataFrame needs them
+HEAVY_MODULES = ("torch", "transformers", "langchain", "langchain_community", "langchain_core", "pandas", "numpy",
+                 "pyarrow", "vllm", "llama_cpp")
+# The library modules and the Streamlit apps (which need streamlit installed)
+LIBRARY_MODULES = ("sql_functions", "db_registry", "jobs", "service", "schema_catalog", "result_stream",
+                   "index_advisor", "example_store", "warmup")
+APP_MODULES = ("texttosql", "dbselectionapp", "dbselection_v1")
+
+
+def import_profile(statement):
+    """
+    ({top-level package: cumulative microseconds}, total microseconds) of running statement
+    under `python -X importtime` in a fresh interpreter.
+    """
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], cwd=BUDGET_DIR,
+                               capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else
+                           f"{statement!r} exited with {completed.returncode}")
+    packages, total = {}, 0
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue  # The header line
+        package = name.strip().split(".")[0]
+        packages[package] = max(packages.get(package, 0), int(cumulative))
+        # Only top-level imports (no indentation) add up to the statement's cost
+        if name == " " + name.strip():
+            total += int(cumulative)
+    return packages, total
+
+
+def check_module(module, baseline=frozenset(), baseline_us=0, budget_ms=IMPORT_BUDGET_MS):
+    """
+    (milliseconds, problems) of importing module beyond the baseline: heavy packages it pulls in
+    and time over budget (no problems: []).
+    """
+    packages, total = import_profile(f"import {module}")
+    problems = [f"imports {package}" for package in HEAVY_MODULES if package in packages and package not in baseline]
+    elapsed_ms = (total - baseline_us) / 1000
+    if elapsed_ms > budget_ms:
+        problems.append(f"takes {elapsed_ms:.0f}ms to import (budget {budget_ms:.0f}ms)")
+    return elapsed_ms, problems
+
+
+def baseline(statement="pass"):
+    """
+    (packages, microseconds) of statement alone (by default, interpreter startup), or None if it fails.
+    """
+    try:
+        packages, total = import_profile(statement)
+    except RuntimeError:
+        return None
+    return frozenset(packages), total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check that the apps and library modules import quickly and "
+                                                 "leave the heavy dependencies unloaded.")
+    parser.add_argument("modules", nargs="*", help="Modules to check (default: the library modules and the apps)")
+    parser.add_argument("--budget-ms", type=float, default=IMPORT_BUDGET_MS)
+    args = parser.parse_args()
+
+    modules = args.modules or LIBRARY_MODULES + APP_MODULES
+    startup = baseline()
+    streamlit = baseline("import streamlit") if any(module in APP_MODULES for module in modules) else None
+    failed = False
+    for module in modules:
+        if module in APP_MODULES and streamlit is None:
+            print(f"{module:<16} skipped (streamlit is not installed)")
+            continue
+        try:
+            elapsed_ms, problems = check_module(module, *(streamlit if module in APP_MODULES else startup),
+                                                budget_ms=args.budget_ms)
+        except RuntimeError as e:
+            # e.g. a heavy dependency imported at module level that isn't installed here
+            elapsed_ms, problems = 0.0, [f"failed to import: {e}"]
+        failed = failed or bool(problems)
+        print(f"{module:<16} {elapsed_ms:>7.1f}ms  {'; '.join(problems) if problems else 'ok'}")
+    sys.exit(1 if failed else 0)
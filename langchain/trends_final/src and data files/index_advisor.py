@@ -0,0 +1,454 @@
+import argparse
+import json
+import os
+import re
+import sqlite3
+import statistics
+import threading
+import time
+from collections import OrderedDict
+
+from connection_pool import read_only_uri
+from query_guard import strip_sql, table_aliases
+from result_cache import normalize_sql
+from schema_catalog import quote_identifier
+
+
+ADVISOR_DIR = os.path.dirname(os.path.abspath(__file__))
+# Opt-in: set to a file path to append every executed statement there (one JSON object per line)
+WORKLOAD_LOG = os.environ.get("SQL_WORKLOAD_LOG", "")
+# Past this size the log is rotated to <path>.1 (replacing the previous one)
+WORKLOAD_LOG_MAX_BYTES = int(os.environ.get("SQL_WORKLOAD_LOG_MB", 64)) * 2**20
+# A shape has to be seen this often before an index is proposed for it
+MIN_SHAPE_COUNT = 2
+# Covering indexes stop growing past this many columns
+MAX_INDEX_COLUMNS = 6
+INDEX_PREFIX = "idx_advisor_"
+# Deterministic functions SQLite allows in expression indexes
+INDEXABLE_FUNCTIONS = {"lower", "upper", "substr", "strftime", "date", "abs", "length", "trim", "round", "coalesce"}
+
+_CLAUSE_END = r"(?=\bGROUP\s+BY\b|\bORDER\s+BY\b|\bLIMIT\b|\bHAVING\b|\bUNION\b|\bEXCEPT\b|\bINTERSECT\b|$)"
+_FROM_TABLE = re.compile(r"(?:\bFROM\b|\bJOIN\b|,)\s*[\"`\[]?(\w+)[\"`\]]?", re.I)
+_PREDICATE = re.compile(r"(?<![\w.])(?:(\w+)\.)?(\w+)\s*(=|\bIN\b|<|>|\bBETWEEN\b|\bLIKE\b)", re.I)
+_COLUMN_REF = re.compile(r"(?<![\w.])(?:(\w+)\.)?(\w+)(?![\w(])")
+
+
+class WorkloadLog:
+    """
+    Append-only JSONL record of the SQL the apps and the service executed, with timings.
+
+    Nothing is recorded without a path. Once the file reaches max_bytes it is moved to
+    <path>.1, so at most two files' worth is kept on disk.
+    """
+
+    def __init__(self, path=WORKLOAD_LOG, max_bytes=WORKLOAD_LOG_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def record(self, db_path, sql_query, seconds, rows):
+        if not self.path:
+            return
+        line = json.dumps({"db": db_path, "sql": sql_query, "seconds": round(seconds, 6), "rows": rows,
+                           "at": time.time()})
+        try:
+            with self._lock:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+                    size = f.tell()
+                if size >= self.max_bytes:
+                    os.replace(self.path, self.path + ".1")
+        except OSError as e:
+            print(f"Could not record executed SQL in {self.path}: {e}")
+
+    def read(self, db_path=None):
+        """
+        Recorded entries (the rotated file's first), optionally only those for db_path.
+        """
+        if not self.path:
+            return []
+        entries = []
+        for path in (self.path + ".1", self.path):
+            if not os.path.isfile(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # A line cut short by a crash
+                    if db_path is None or os.path.abspath(entry["db"]) == os.path.abspath(db_path):
+                        entries.append(entry)
+        return entries
+
+
+default_workload_log = WorkloadLog()
+
+
+def query_shape(sql_query):
+    """
+    The statement with literals replaced by '?', so queries differing only in constants group together.
+    """
+    shape = normalize_sql(sql_query)
+    shape = re.sub(r"'(?:[^']|'')*'", "?", shape)
+    shape = re.sub(r"(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])", "?", shape)
+    return re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(?)", shape)
+
+
+def plan_problems(plan):
+    """
+    (scanned tables, temp B-tree uses) from EXPLAIN QUERY PLAN rows; covering-index scans don't count.
+    """
+    scans, temp_trees = [], []
+    for _, _, _, detail in plan:
+        match = re.match(r"SCAN (?:TABLE )?(\w+)(?: AS (\w+))?", detail)
+        if match and "COVERING INDEX" not in detail:
+            scans.append(match.group(2) or match.group(1))
+        elif detail.startswith("USE TEMP B-TREE"):
+            temp_trees.append(detail[len("USE TEMP B-TREE FOR "):])
+    return scans, temp_trees
+
+
+class ShapeStats:
+    """
+    One recurring query shape: how often it ran, how long it took, and an example statement.
+    """
+
+    def __init__(self, shape, example):
+        self.shape = shape
+        self.example = example
+        self.statements = OrderedDict()  # distinct SQL -> None
+        self.count = 0
+        self.seconds = []
+        self.scans = []
+        self.temp_trees = []
+
+    def add(self, entry):
+        self.count += 1
+        self.seconds.append(entry["seconds"])
+        self.statements[entry["sql"]] = None
+
+
+def group_workload(entries):
+    """
+    {shape: ShapeStats}, most executed shape first.
+    """
+    shapes = {}
+    for entry in entries:
+        shape = query_shape(entry["sql"])
+        if shape not in shapes:
+            shapes[shape] = ShapeStats(shape, entry["sql"])
+        shapes[shape].add(entry)
+    return dict(sorted(shapes.items(), key=lambda item: -item[1].count))
+
+
+class IndexProposal:
+    """
+    A CREATE INDEX the advisor recommends, and the shapes that would use it.
+    """
+
+    def __init__(self, table, columns):
+        self.table = table
+        self.columns = columns  # quoted column names or expressions, in index order
+        self.shapes = []
+        self.used = None  # set once tried on a replica
+
+    @property
+    def name(self):
+        parts = [re.sub(r"\W+", "_", column).strip("_").lower() for column in self.columns]
+        return (INDEX_PREFIX + re.sub(r"\W+", "_", self.table).lower() + "_" + "_".join(parts))[:120]
+
+    @property
+    def sql(self):
+        return (f"CREATE INDEX IF NOT EXISTS {quote_identifier(self.name)} ON {quote_identifier(self.table)} "
+                f"({', '.join(self.columns)});")
+
+
+def _clause(masked, keyword):
+    """
+    Text of every `keyword ...` clause in the masked statement, up to the next clause.
+    """
+    return [match.group(1) for match in re.finditer(rf"\b{keyword}\b(.*?){_CLAUSE_END}", masked, flags=re.I | re.S)]
+
+
+def _join_conditions(masked):
+    return [match.group(1) for match in re.finditer(
+        r"\bON\b(.*?)(?=\bJOIN\b|\bWHERE\b|\bGROUP\s+BY\b|\bORDER\s+BY\b|\bLIMIT\b|\bLEFT\b|\bINNER\b|$)",
+        masked, flags=re.I | re.S)]
+
+
+class _Scope:
+    """
+    The tables a statement reads (FROM/JOIN) and the aliases it gives them, for resolving columns.
+    """
+
+    def __init__(self, sql_query, masked, table_names, columns_by_table):
+        self.aliases = table_aliases(sql_query, table_names)
+        self.tables = {self.aliases[name.lower()] for name in _FROM_TABLE.findall(masked)
+                       if name.lower() in self.aliases}
+        self.columns_by_table = columns_by_table
+
+    def resolve(self, qualifier, column):
+        """
+        Table of a column reference: through its alias/table qualifier, else the one FROM table having it.
+        """
+        column = column.lower()
+        if qualifier:
+            table = self.aliases.get(qualifier.lower())
+            return table if table and column in self.columns_by_table.get(table, {}) else None
+        owners = {table for table in self.tables if column in self.columns_by_table.get(table, {})}
+        return owners.pop() if len(owners) == 1 else None
+
+
+def _references(text, scope):
+    """
+    [(table, column name as declared)] for the column references in a clause.
+    """
+    found = []
+    for qualifier, column in _COLUMN_REF.findall(text):
+        table = scope.resolve(qualifier, column)
+        if table:
+            found.append((table, scope.columns_by_table[table][column.lower()]))
+    return found
+
+
+def _expressions(sql_query, masked, scope):
+    """
+    [(table, expression)] for indexable function calls compared in WHERE clauses, e.g. strftime('%Y', InvoiceDate).
+    """
+    found = []
+    for where in re.finditer(rf"\bWHERE\b(.*?){_CLAUSE_END}", masked, flags=re.I | re.S):
+        for call in re.finditer(r"\b(\w+)\s*\(([^()]*)\)\s*(?:=|<|>|\bIN\b|\bBETWEEN\b|\bLIKE\b)",
+                                masked[where.start(1):where.end(1)], flags=re.I):
+            if call.group(1).lower() not in INDEXABLE_FUNCTIONS:
+                continue
+            start, end = where.start(1) + call.start(1), where.start(1) + call.end(2) + 1
+            expression = sql_query[start:end]
+            if "'now'" in expression.lower():
+                continue
+            tables = {table for table, _ in _references(call.group(2), scope)}
+            if len(tables) == 1:
+                table = tables.pop()
+                # Qualifiers aren't allowed in an index expression
+                expression = re.sub(r"(?<![\w.'])\w+\.(?=\w)", "", expression)
+                found.append((table, expression))
+    return found
+
+
+def propose_indexes(conn, shapes, table_names, table_info, min_count=MIN_SHAPE_COUNT):
+    """
+    Index proposals for the recurring shapes whose plans scan tables or sort through temp B-trees.
+
+    Per scanned table the index leads with equality-filtered columns, then range-filtered and join
+    columns, then GROUP BY / ORDER BY columns, and is extended with the table's other referenced
+    columns to cover the query while it stays within MAX_INDEX_COLUMNS. Indexable function calls
+    in WHERE get expression indexes.
+    """
+    columns_by_table = {table: {col[1].lower(): quote_identifier(col[1]) for col in ddl}
+                        for table, ddl, _ in table_info}
+    existing = set()
+    for table in table_names:
+        for index in conn.execute(f"PRAGMA index_list({quote_identifier(table)});").fetchall():
+            cols = [row[2] for row in conn.execute(f"PRAGMA index_info({quote_identifier(index[1])});").fetchall()]
+            if cols and None not in cols:
+                existing.add((table, tuple(quote_identifier(col) for col in cols)))
+
+    proposals = {}
+    for stats in shapes.values():
+        if stats.count < min_count:
+            continue
+        try:
+            plan = conn.execute("EXPLAIN QUERY PLAN " + stats.example).fetchall()
+        except sqlite3.Error as e:
+            print(f"Skipping shape that no longer compiles ({e}): {stats.shape}")
+            continue
+        stats.scans, stats.temp_trees = plan_problems(plan)
+        if not stats.scans and not stats.temp_trees:
+            continue
+
+        masked = strip_sql(stats.example)
+        scope = _Scope(stats.example, masked, table_names, columns_by_table)
+        # Plans name tables by alias when there is one
+        scanned = {scope.aliases.get(name.lower(), name) for name in stats.scans}
+        if stats.temp_trees:
+            scanned |= scope.tables
+
+        equality, ranges = [], []
+        for where in _clause(masked, "WHERE"):
+            for qualifier, column, op in _PREDICATE.findall(where):
+                table = scope.resolve(qualifier, column)
+                if table:
+                    target = equality if op in ("=",) or op.upper() == "IN" else ranges
+                    target.append((table, columns_by_table[table][column.lower()]))
+        joins = [ref for condition in _join_conditions(masked)
+                 for ref in _references(condition, scope)]
+        ordering = [ref for keyword in (r"GROUP\s+BY", r"ORDER\s+BY") for clause in _clause(masked, keyword)
+                    for ref in _references(clause, scope)]
+        referenced = _references(masked, scope)
+
+        candidates = []
+        for table in sorted(scanned):
+            lead = []
+            for group in (equality, ranges, joins, ordering):
+                for ref_table, column in group:
+                    if ref_table == table and column not in lead:
+                        lead.append(column)
+            if not lead:
+                continue
+            covering = list(lead)
+            for ref_table, column in referenced:
+                if ref_table == table and column not in covering and len(covering) < MAX_INDEX_COLUMNS:
+                    covering.append(column)
+            candidates.append((table, covering))
+        candidates += [(table, [expression]) for table, expression in _expressions(stats.example, masked, scope)]
+
+        for table, columns in candidates:
+            if any(key[0] == table and key[1][:len(columns)] == tuple(columns) for key in existing):
+                continue
+            key = (table, tuple(columns))
+            proposal = proposals.get(key)
+            if proposal is None:
+                proposal = proposals[key] = IndexProposal(table, columns)
+            proposal.shapes.append(stats)
+    return list(proposals.values())
+
+
+def make_replica(db_path, replica_path):
+    """
+    Copy db_path to a writable replica_path with SQLite's backup API (consistent while others read).
+    """
+    if os.path.abspath(db_path) == os.path.abspath(replica_path):
+        raise ValueError("the replica must be a different file from the served database")
+    source = sqlite3.connect(read_only_uri(db_path), uri=True)
+    target = sqlite3.connect(replica_path)
+    try:
+        source.backup(target)
+    finally:
+        source.close()
+        target.close()
+
+
+def apply_indexes(replica_path, proposals):
+    """
+    Create the proposed indexes on the replica, run ANALYZE, and drop the ones the planner then
+    ignores for every shape they were proposed for. Returns the proposals kept.
+    """
+    conn = sqlite3.connect(replica_path)
+    try:
+        for proposal in proposals:
+            print(f"Creating {proposal.sql}")
+            conn.execute(proposal.sql)
+        conn.execute("ANALYZE;")
+        for proposal in proposals:
+            plans = [conn.execute("EXPLAIN QUERY PLAN " + stats.example).fetchall() for stats in proposal.shapes]
+            proposal.used = any(proposal.name in detail for plan in plans for _, _, _, detail in plan)
+            if not proposal.used:
+                print(f"Dropping unused {proposal.name}")
+                conn.execute(f"DROP INDEX IF EXISTS {quote_identifier(proposal.name)};")
+        conn.execute("ANALYZE;")
+        conn.commit()
+    finally:
+        conn.close()
+    return [proposal for proposal in proposals if proposal.used]
+
+
+def time_workload(conn, statements, repeats=3):
+    """
+    Median seconds to execute and fetch each statement (after one warm-up run).
+    """
+    timings = {}
+    for sql_query in statements:
+        try:
+            conn.execute(sql_query).fetchall()
+            samples = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                conn.execute(sql_query).fetchall()
+                samples.append(time.perf_counter() - start)
+            timings[sql_query] = statistics.median(samples)
+        except sqlite3.Error as e:
+            print(f"Could not time statement ({e}): {sql_query}")
+    return timings
+
+
+def advise(db_path, log=default_workload_log, replica_path=None, min_count=MIN_SHAPE_COUNT, repeats=3):
+    """
+    Group the recorded workload of db_path by shape and propose indexes for its recurring scans
+    and sorts. With replica_path, copy the database there and time the workload on the replica
+    before and after applying the indexes (the served database is never timed). Returns a
+    JSON-ready report.
+    """
+    from sql_functions import connect_db, get_table_info, release_db
+
+    shapes = group_workload(log.read(db_path))
+    conn = connect_db(db_path)
+    if conn is None:
+        raise FileNotFoundError(db_path)
+    try:
+        table_names, table_info = get_table_info(conn)
+        proposals = propose_indexes(conn, shapes, table_names or [], table_info or [], min_count)
+        statements = [sql_query for stats in shapes.values() if stats.count >= min_count
+                      for sql_query in stats.statements]
+    finally:
+        release_db(conn)
+
+    before, after = {}, {}
+    if replica_path and proposals:
+        make_replica(db_path, replica_path)
+        replica = sqlite3.connect(replica_path)
+        try:
+            before = time_workload(replica, statements, repeats)
+        finally:
+            replica.close()
+        proposals = apply_indexes(replica_path, proposals)
+        replica = sqlite3.connect(replica_path)
+        try:
+            after = time_workload(replica, statements, repeats)
+        finally:
+            replica.close()
+    # Totals compare the same statements: those that could be timed both times
+    timed = [sql_query for sql_query in before if sql_query in after]
+
+    return {
+        "db": db_path,
+        "statements": sum(stats.count for stats in shapes.values()),
+        "shapes": [{"shape": stats.shape, "count": stats.count, "scans": stats.scans, "temp_b_trees": stats.temp_trees,
+                    "median_seconds": statistics.median(stats.seconds)} for stats in shapes.values()],
+        "proposals": [{"sql": proposal.sql, "used": proposal.used, "shapes": [s.shape for s in proposal.shapes]}
+                      for proposal in proposals],
+        "before_seconds": sum(before[sql_query] for sql_query in timed) if timed else None,
+        "after_seconds": sum(after[sql_query] for sql_query in timed) if timed else None,
+        "timings": [{"sql": sql_query, "before": before[sql_query], "after": after[sql_query]} for sql_query in timed],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Propose indexes for the recorded SQL workload, "
+                                                 "optionally trying them on a replica.")
+    parser.add_argument("--db", default="Chinook_Sqlite.sqlite")
+    parser.add_argument("--log", default=WORKLOAD_LOG, help="Workload JSONL the apps and the service write when "
+                                                            "SQL_WORKLOAD_LOG is set (default: that path)")
+    parser.add_argument("--apply", metavar="REPLICA", help="Copy the database here, create the indexes and ANALYZE")
+    parser.add_argument("--min-count", type=int, default=MIN_SHAPE_COUNT)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", help="Also write the report as JSON")
+    args = parser.parse_args()
+    if not args.log:
+        parser.error("no workload log: set SQL_WORKLOAD_LOG while the apps run, then pass it with --log")
+
+    report = advise(args.db, WorkloadLog(args.log), args.apply, args.min_count, args.repeats)
+    print(f"{report['statements']} recorded statements in {len(report['shapes'])} shapes")
+    for shape in report["shapes"]:
+        problems = ([f"scan {table}" for table in shape["scans"]]
+                    + [f"temp b-tree {use}" for use in shape["temp_b_trees"]])
+        print(f"{shape['count']:>5}x {shape['median_seconds'] * 1000:>8.1f}ms  {shape['shape'][:80]}"
+              + (f"  [{', '.join(problems)}]" if problems else ""))
+    for proposal in report["proposals"]:
+        status = "" if proposal["used"] is None else (" (used)" if proposal["used"] else " (unused, dropped)")
+        print(f"{proposal['sql']}{status}")
+    if report["after_seconds"] is not None:
+        print(f"Workload: {report['before_seconds'] * 1000:.1f}ms before, {report['after_seconds'] * 1000:.1f}ms after "
+              f"({report['before_seconds'] / max(report['after_seconds'], 1e-9):.1f}x)")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,163 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+# fp32: plain PyTorch weights; bf16: bfloat16 weights where the CPU supports them; int8: PyTorch
+# dynamic quantization of the Linear layers; onnx: ONNX Runtime through optimum
+BACKENDS = ("fp32", "bf16", "int8", "onnx")
+_backend = os.environ.get("SQL_INFERENCE_BACKEND", "fp32")
+ONNX_CACHE_DIR = os.environ.get("SQL_ONNX_CACHE_DIR",
+                                os.path.join(os.path.expanduser("~"), ".cache", "llm4sql", "onnx"))
+
+
+def set_default_backend(backend):
+    """
+    Backend used by load_model() when none is given (e.g. from the service config).
+    """
+    global _backend
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown inference backend {backend!r}; choose from {', '.join(BACKENDS)}")
+    _backend = backend
+
+
+def default_backend():
+    return _backend
+
+
+def bf16_supported():
+    """
+    True when bfloat16 matmuls are hardware accelerated (AVX512-BF16/AMX on CPU, or a bf16 GPU).
+    """
+    import torch
+
+    if torch.cuda.is_available():
+        return torch.cuda.is_bf16_supported()
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def _load_onnx(model_id):
+    from optimum.onnxruntime import ORTModelForCausalLM
+
+    export_dir = os.path.join(ONNX_CACHE_DIR, model_id.replace("/", "--"))
+    if os.path.isdir(export_dir):
+        return ORTModelForCausalLM.from_pretrained(export_dir, provider="CPUExecutionProvider")
+    print(f"Exporting {model_id} to ONNX in {export_dir} (first use only)")
+    model = ORTModelForCausalLM.from_pretrained(model_id, export=True, provider="CPUExecutionProvider")
+    model.save_pretrained(export_dir)
+    return model
+
+
+def load_model(model_id, backend=None):
+    """
+    Load the causal LM for model_id with the given (or configured) inference backend.
+
+    Falls back to fp32 with a message when bf16 isn't accelerated on this machine.
+    """
+    backend = backend or _backend
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown inference backend {backend!r}; choose from {', '.join(BACKENDS)}")
+    if backend == "onnx":
+        return _load_onnx(model_id)
+
+    import torch
+    from transformers import AutoModelForCausalLM
+
+    if backend == "bf16":
+        if bf16_supported():
+            return AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=torch.bfloat16)
+        print("bfloat16 is not accelerated on this machine; loading fp32 weights instead")
+
+    model = AutoModelForCausalLM.from_pretrained(model_id)
+    if backend == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model.eval()
+
+
+def benchmark_backend(backend, model_id, questions):
+    """
+    Load model_id with backend and run the accuracy/latency benchmark through a GenerationServer.
+    """
+    from benchmark import run_benchmark
+    from generation_server import GenerationServer
+    from model_registry import load_hf_pipeline, model_size_bytes
+
+    start = time.perf_counter()
+    llm, pipe, tokenizer, model = load_hf_pipeline(model_id, backend=backend)
+    load_seconds = time.perf_counter() - start
+
+    server = GenerationServer(model, tokenizer).start()
+    try:
+        results = run_benchmark(questions, server, llm)
+    finally:
+        server.stop()
+    return {
+        "backend": backend,
+        "accuracy": results["accuracy"],
+        "generate": results["stages"]["generate"],
+        "load_seconds": load_seconds,
+        "model_bytes": model_size_bytes(model),
+        "peak_rss_bytes": results["memory"]["process_peak_rss_bytes"],
+    }
+
+
+def compare_backends(backends, model_id, databases=None):
+    """
+    Benchmark each backend in its own process, so peak memory is measured per backend.
+    """
+    rows = []
+    for backend in backends:
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+            output = f.name
+        command = [sys.executable, os.path.abspath(__file__), "--only", backend, "--model", model_id,
+                   "--output", output]
+        for db in databases or []:
+            command += ["--db", db]
+        completed = subprocess.run(command)
+        if completed.returncode != 0:
+            rows.append({"backend": backend, "error": f"exited with status {completed.returncode}"})
+            continue
+        with open(output, "r", encoding="utf-8") as f:
+            rows.append(json.load(f))
+        os.remove(output)
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare inference backends on latency, memory and accuracy.")
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--model", default="NumbersStation/nsql-350M")
+    parser.add_argument("--db", action="append", help="Only run this database file (repeatable)")
+    parser.add_argument("--output", default="backend_results.json")
+    parser.add_argument("--only", choices=BACKENDS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.only:
+        # Child process of compare_backends
+        from benchmark import load_questions
+        row = benchmark_backend(args.only, args.model, load_questions(databases=args.db))
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(row, f, indent=2)
+        raise SystemExit(0)
+
+    rows = compare_backends(args.backends.split(","), args.model, args.db)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(rows, f, indent=2)
+
+    print(f"{'backend':<8} {'accuracy':>8} {'gen p50':>10} {'gen p90':>10} {'load':>8} {'model':>10} {'peak RSS':>10}")
+    for row in rows:
+        if "error" in row:
+            print(f"{row['backend']:<8} {row['error']}")
+            continue
+        rss = f"{row['peak_rss_bytes'] / 2**20:.0f} MiB" if row["peak_rss_bytes"] else "n/a"
+        print(f"{row['backend']:<8} {row['accuracy']:>8.3f} {row['generate']['p50'] * 1000:>8.0f}ms "
+              f"{row['generate']['p90'] * 1000:>8.0f}ms {row['load_seconds']:>7.1f}s "
+              f"{row['model_bytes'] / 2**20:>6.0f} MiB {rss:>10}")
+    print(f"Results written to {args.output}")
@@ -0,0 +1,240 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+logger = logging.getLogger("llm4sql.trace")
+
+# Latency histogram buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_enabled = False
+_current_trace = contextvars.ContextVar("llm4sql_trace", default=None)
+
+
+class Metrics:
+    """
+    In-process counters and latency histograms rendered in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def render(self):
+        lines = []
+        typed = set()
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} counter")
+                    typed.add(name)
+                lines.append(f"{name}{_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} histogram")
+                    typed.add(name)
+                for bound, count in zip(BUCKETS, histogram["buckets"]):
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', repr(bound)),))} {count}")
+                lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+                lines.append(f"{name}_sum{_labels(labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+metrics = Metrics()
+
+
+def set_enabled(enabled=True):
+    """
+    Turn process-wide metrics and structured logs on or off.
+    """
+    global _enabled
+    _enabled = enabled
+    if enabled and not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+
+
+def is_active():
+    return _enabled or _current_trace.get() is not None
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class Span:
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.start = None
+        self.seconds = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        spans = _current_trace.get()
+        if spans is not None:
+            spans.append(self)
+        if _enabled:
+            metrics.observe("llm4sql_stage_seconds", self.seconds, stage=self.name)
+            logger.info(json.dumps({"event": "span", "stage": self.name,
+                                    "ms": round(self.seconds * 1000, 3), **self.attrs}, default=str))
+        return False
+
+    def as_dict(self):
+        return {"stage": self.name, "ms": round(self.seconds * 1000, 3), **self.attrs}
+
+
+def span(name, **attrs):
+    """
+    Time a pipeline stage. Costs one flag check when tracing is off.
+
+    Usage: with span("generate", model=model_id) as s: ...; s.set(tokens_out=n)
+    """
+    if not (_enabled or _current_trace.get() is not None):
+        return _NOOP
+    return Span(name, attrs)
+
+
+def count(name, value, **labels):
+    """
+    Add to a counter such as tokens in/out or rows/bytes returned (no-op when metrics are off).
+    """
+    if _enabled:
+        metrics.inc(f"llm4sql_{name}_total", value, **labels)
+
+
+def start_trace(enabled=True):
+    """
+    Start (or with enabled=False, stop) collecting spans for the rest of the current
+    thread/context, i.e. one Streamlit script run. Returns the span list or None.
+    """
+    spans = [] if enabled else None
+    _current_trace.set(spans)
+    return spans
+
+
+@contextmanager
+def trace(spans=None):
+    """
+    Collect the spans of one request in the current context, e.g. for the debug panel.
+
+    Pass a list to keep appending to it (e.g. one job traced across worker threads).
+    """
+    spans = [] if spans is None else spans
+    token = _current_trace.set(spans)
+    try:
+        yield spans
+    finally:
+        _current_trace.reset(token)
+
+
+def render_debug_panel(st, spans):
+    """
+    Streamlit expander listing each stage's duration and attributes.
+    """
+    with st.expander("Debug: pipeline timings"):
+        if not spans:
+            st.write("No spans recorded.")
+            return
+        total = sum(s.seconds for s in spans)
+        st.table([s.as_dict() for s in spans])
+        st.caption(f"{len(spans)} spans, {total * 1000:.1f} ms total")
+
+
+_server = None
+
+
+def start_metrics_server(port=9464, host="127.0.0.1"):
+    """
+    Serve /metrics in a daemon thread (once per process) and enable metrics collection.
+
+    Only local clients can connect by default; pass another host (e.g. "0.0.0.0") to expose it.
+    """
+    # http.server pulls in the email package; only pay for it when metrics are served
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    global _server
+    set_enabled(True)
+    if _server is None:
+        _server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+        print(f"Serving Prometheus metrics on http://{host}:{port}/metrics")
+    return _server
+
+
+if os.environ.get("SQL_TRACING") == "1":
+    set_enabled(True)
+if os.environ.get("SQL_METRICS_PORT"):
+    # SQL_METRICS_HOST=0.0.0.0 lets a scraper on another machine reach it
+    start_metrics_server(int(os.environ["SQL_METRICS_PORT"]), os.environ.get("SQL_METRICS_HOST", "127.0.0.1"))
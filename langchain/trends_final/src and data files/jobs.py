@@ -0,0 +1,348 @@
+import itertools
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import trace
+from model_registry import DEFAULT_MODEL_ID
+
+
+# Generation is CPU/GPU bound and executes few at a time; SQLite execution mostly waits on I/O
+GENERATION_WORKERS = int(os.environ.get("SQL_GENERATION_WORKERS", 2))
+EXECUTION_WORKERS = int(os.environ.get("SQL_EXECUTION_WORKERS", 8))
+# Jobs remembered per browser session; older ones are cancelled and their results closed
+MAX_SESSION_JOBS = 10
+# How often a page with a job in flight reruns to show progress
+POLL_SECONDS = 0.3
+
+FINISHED = ("done", "failed", "cancelled")
+
+
+class JobCancelled(Exception):
+    """
+    Raised inside a worker when its job has been cancelled.
+    """
+
+
+class Job:
+    """
+    One question's trip through connect -> introspect -> generate -> execute.
+
+    Worker threads update the attributes in place; the Streamlit script only reads them, so a
+    rerun shows the current status without repeating finished work. status is one of queued,
+    generating, executing, done, failed or cancelled. error_stage says where error happened
+    (connect, generate or execute).
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, db_path, question, export_format, model_id, language_model, trace_spans, stream_tokens,
+                 llm_options):
+        self.id = f"job-{next(Job._ids)}"
+        self.db_path = db_path
+        self.question = question
+        self.export_format = export_format
+        self.model_id = model_id
+        self.language_model = language_model
+        self.trace_spans = trace_spans
+        self.stream_tokens = stream_tokens
+        self.llm_options = llm_options
+        self.status = "queued"
+        self.partial_sql = ""
+        self.sql = None
+        self.table_names = None
+        self.guard = None
+        self.results = {}  # export format -> StreamedResult
+        self.error = None
+        self.error_stage = None
+        self.spans = []
+        self.fingerprint = None
+        self.sql_source = None  # "cache", "model" or "repaired" (see llm_create_sql)
+        self.example_saved = False
+        self.created = time.time()
+        self.finished = None
+        self._cancel = threading.Event()
+        self._pending = {}  # phase -> Future
+        self._conns = set()
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self):
+        return any(not future.done() for future in self._pending.values())
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def check_cancelled(self):
+        if self._cancel.is_set():
+            raise JobCancelled(self.id)
+
+    def cancel(self):
+        """
+        Stop the job: queued phases never start, running SQLite statements are interrupted and
+        generation stops at its next token (a prompt still queued on the GenerationServer is
+        dropped).
+        """
+        self._cancel.set()
+        with self._lock:
+            for future in self._pending.values():
+                future.cancel()
+            for conn in self._conns:
+                conn.interrupt()
+        if not self.in_flight and self.status not in FINISHED:
+            self._finish("cancelled")
+
+    def close(self):
+        self.cancel()
+        for result in self.results.values():
+            result.close()
+
+    def _finish(self, status, error=None, stage=None):
+        self.status = status
+        self.error = error
+        self.error_stage = stage
+        self.finished = time.time()
+
+    def _track(self, conn):
+        with self._lock:
+            self._conns.add(conn)
+
+    def _untrack(self, conn):
+        with self._lock:
+            self._conns.discard(conn)
+
+
+class JobManager:
+    """
+    Runs jobs on two thread pools, one for generation and one for SQLite execution, so the
+    model and the database stay busy at the same time across sessions.
+    """
+
+    def __init__(self, generation_workers=GENERATION_WORKERS, execution_workers=EXECUTION_WORKERS):
+        self.generation_workers = generation_workers
+        self.execution_workers = execution_workers
+        self._generation = None
+        self._execution = None
+        self._lock = threading.Lock()
+
+    def executors(self):
+        """
+        (generation, execution) thread pools, created on first use.
+        """
+        with self._lock:
+            if self._generation is None:
+                self._generation = ThreadPoolExecutor(self.generation_workers, thread_name_prefix="sql-generate")
+                self._execution = ThreadPoolExecutor(self.execution_workers, thread_name_prefix="sql-execute")
+            return self._generation, self._execution
+
+    def submit(self, db_path, question, export_format="CSV", model_id=DEFAULT_MODEL_ID, language_model=None,
+               trace_spans=False, stream_tokens=False, **llm_options):
+        """
+        Queue a new job for question against db_path; execution in export_format follows
+        generation automatically. The model comes from the registry unless language_model is
+        given. With stream_tokens, job.partial_sql grows as tokens arrive; llm_options are
+        passed on to llm_create_sql.
+        """
+        job = Job(db_path, question, export_format, model_id, language_model, trace_spans, stream_tokens,
+                  llm_options)
+        generation, _ = self.executors()
+        job._pending["generate"] = generation.submit(self._run_generation, job)
+        return job
+
+    def execute(self, job, export_format):
+        """
+        Run the job's SQL again for another export format (no-op if done or under way).
+        """
+        if job.sql is None or export_format in job.results or job.cancelled or job.guard is None:
+            return
+        if job.guard.rejected:
+            return
+        phase = f"execute:{export_format}"
+        future = job._pending.get(phase)
+        if future is not None and not future.done():
+            return
+        _, execution = self.executors()
+        job.status = "executing"
+        job._pending[phase] = execution.submit(self._run_execution, job, export_format)
+
+    def session_job(self, session_state, db_path, question, **submit_options):
+        """
+        The job for (db_path, question) in the session's job table, submitting it on first sight.
+
+        The table lives in session_state["jobs"] (st.session_state); the oldest jobs beyond
+        MAX_SESSION_JOBS are cancelled and their results closed.
+        """
+        session_jobs = session_state.setdefault("jobs", OrderedDict())
+        key = (db_path, question)
+        job = session_jobs.get(key)
+        if job is None:
+            job = session_jobs[key] = self.submit(db_path, question, **submit_options)
+        session_jobs.move_to_end(key)
+        while len(session_jobs) > MAX_SESSION_JOBS:
+            _, old = session_jobs.popitem(last=False)
+            old.close()
+        return job
+
+    def retry(self, session_state, job):
+        """
+        Replace a failed or cancelled job with a fresh one for the same question.
+        """
+        session_state.setdefault("jobs", OrderedDict()).pop((job.db_path, job.question), None)
+        job.close()
+        return self.session_job(session_state, job.db_path, job.question, export_format=job.export_format,
+                                model_id=job.model_id, language_model=job.language_model,
+                                trace_spans=job.trace_spans,
+                                stream_tokens=job.stream_tokens, **job.llm_options)
+
+    def save_example(self, job):
+        """
+        Keep the job's guarded SQL as a few-shot example, once the user has confirmed its result.
+
+        Rows alone don't make SQL right (a wrong query can run fine, and a cached or repaired
+        answer may be a near miss), so examples are only ever added on this explicit confirmation.
+        Returns True if the example was stored.
+        """
+        from example_store import get_example_store
+
+        if job.example_saved or job.guard is None or job.guard.rejected or not job.fingerprint:
+            return False
+        if not any(result.row_count for result in job.results.values()):
+            return False
+        examples = job.llm_options["examples"] if "examples" in job.llm_options else get_example_store()
+        if examples is None:
+            return False
+        sql_query = job.guard.sql
+        if any(rewrite.startswith("added LIMIT") for rewrite in job.guard.rewrites):
+            # The guard's row cap is not part of the answer
+            sql_query = sql_query[:sql_query.rindex("\nLIMIT")]
+        examples.add(job.question, sql_query, job.fingerprint, os.path.basename(job.db_path), source="confirmed")
+        job.example_saved = True
+        return True
+
+    def _traced(self, job, work, *args):
+        if not job.trace_spans:
+            return work(job, *args)
+        with trace(job.spans):
+            return work(job, *args)
+
+    def _run_generation(self, job):
+        try:
+            self._traced(job, self._generate)
+        except JobCancelled:
+            job._finish("cancelled")
+        except Exception as e:
+            print(f"Job {job.id} failed: {e}")
+            job._finish("failed", e, "generate")
+
+    def _run_execution(self, job, export_format):
+        try:
+            self._traced(job, self._execute, export_format)
+        except JobCancelled:
+            job._finish("cancelled")
+        except Exception as e:
+            print(f"Job {job.id} failed: {e}")
+            job._finish("failed", e, "execute")
+
+    def _generate(self, job):
+        from example_store import get_example_store
+        from generation_server import get_generation_server
+        from model_registry import default_registry
+        from nl2sql_cache import get_default_cache, schema_fingerprint
+        from query_guard import guard_query
+        from schema_linking import get_schema_index
+        from sql_functions import connect_db, get_foreign_keys, get_table_info, llm_create_sql, release_db
+
+        job.check_cancelled()
+        job.status = "generating"
+        conn = connect_db(job.db_path)
+        if not conn:
+            job._finish("failed", "Failed to connect to the database.", "connect")
+            return
+        job._track(conn)
+        try:
+            job.table_names, table_info = get_table_info(conn)
+            if not table_info:
+                job._finish("failed", "No valid tables found in the database.", "connect")
+                return
+            language_model = job.language_model or default_registry.get(job.model_id)
+            job.check_cancelled()
+
+            def on_token(partial):
+                job.check_cancelled()
+                job.partial_sql = partial
+
+            options = dict(job.llm_options)
+            if "cache" not in options:
+                options["cache"] = get_default_cache()
+            # A caller-supplied language_model is used as is, never swapped for the registry model
+            if "generator" not in options and job.language_model is None:
+                options["generator"] = get_generation_server(job.model_id)
+            if "examples" not in options:
+                options["examples"] = get_example_store()
+            job.fingerprint = schema_fingerprint(table_info)
+            provenance = {}
+            job.sql = llm_create_sql(table_info=table_info, question=job.question, lang_model=language_model,
+                                     schema_index=get_schema_index(table_info, get_foreign_keys(conn)),
+                                     on_token=on_token if job.stream_tokens else None, conn=conn,
+                                     provenance=provenance, cancel_event=job._cancel, **options)
+            job.sql_source = provenance.get("source")
+            job.check_cancelled()
+            try:
+                job.guard = guard_query(conn, job.sql, job.table_names)
+            except sqlite3.Error as e:
+                job._finish("failed", e, "execute")
+                return
+        except JobCancelled:
+            raise
+        except Exception as e:
+            if job.cancelled:
+                raise JobCancelled(job.id) from e
+            job._finish("failed", e, "generate")
+            return
+        finally:
+            job._untrack(conn)
+            release_db(conn)
+
+        if job.guard.rejected:
+            job._finish("done")
+        else:
+            self.execute(job, job.export_format)
+
+    def _execute(self, job, export_format):
+        from index_advisor import default_workload_log
+        from query_guard import time_limit
+        from result_cache import default_result_cache
+        from result_stream import stream_query
+        from sql_functions import connect_db, release_db
+
+        job.check_cancelled()
+        conn = connect_db(job.db_path)
+        if not conn:
+            # e.g. the file was removed after the SQL was generated
+            job._finish("failed", f"Database not found: {job.db_path}", "connect")
+            return
+        job._track(conn)
+        try:
+            started = time.perf_counter()
+            with time_limit(conn):
+                result = stream_query(conn, job.guard.sql, export_format=export_format, cache=default_result_cache)
+            if not result.cache_hit:
+                default_workload_log.record(job.db_path, job.guard.sql, time.perf_counter() - started,
+                                            result.row_count)
+            job.results[export_format] = result
+        except sqlite3.Error as e:
+            if job.cancelled:
+                raise JobCancelled(job.id) from e
+            job._finish("failed", e, "execute")
+            return
+        finally:
+            job._untrack(conn)
+            release_db(conn)
+        job._finish("done")
+
+
+job_manager = JobManager()
@@ -0,0 +1,206 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from inference_backends import load_model
+from sql_streaming import MAX_NEW_TOKENS
+
+
+DEFAULT_MODEL_ID = 'NumbersStation/nsql-350M'
+
+
+class LoadedModel:
+    """
+    A model kept resident by the registry, with its load statistics.
+    """
+
+    def __init__(self, model_id, llm, pipe, tokenizer, model, load_seconds, size_bytes):
+        self.model_id = model_id
+        self.llm = llm
+        self.pipe = pipe
+        self.tokenizer = tokenizer
+        self.model = model
+        self.load_seconds = load_seconds
+        self.size_bytes = size_bytes
+        self.last_used = time.time()
+        self.uses = 0
+
+
+def _tensor_bytes(value):
+    if isinstance(value, (tuple, list)):
+        return sum(_tensor_bytes(item) for item in value)
+    if hasattr(value, "numel") and hasattr(value, "element_size"):
+        return value.numel() * value.element_size()
+    return 0
+
+
+def model_size_bytes(model):
+    """
+    Resident size of a model's weights: the torch state dict (int8 packed weights included),
+    or the exported files of an ONNX Runtime model.
+    """
+    if hasattr(model, "state_dict"):
+        return sum(_tensor_bytes(value) for value in model.state_dict().values())
+    export_dir = getattr(model, "model_save_dir", None)
+    if export_dir and os.path.isdir(export_dir):
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(export_dir)
+                   for name in names if name.endswith((".onnx", ".onnx_data")))
+    return 0
+
+
+def load_hf_pipeline(model_id, backend=None):
+    """
+    Load a local HuggingFace model with the configured inference backend and wrap it for LangChain.
+
+    Returns (llm, pipe, tokenizer, model).
+    """
+    from transformers import AutoTokenizer, pipeline
+    from langchain_community.llms import HuggingFacePipeline
+
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+    model = load_model(model_id, backend)
+
+    pipe = pipeline(
+        "text2text-generation",
+        model=model,
+        tokenizer=tokenizer,
+        max_new_tokens=MAX_NEW_TOKENS,
+    )
+
+    return HuggingFacePipeline(pipeline=pipe, model_id=model_id), pipe, tokenizer, model
+
+
+class ModelRegistry:
+    """
+    Process-wide registry that loads models lazily and keeps them warm.
+
+    Models stay resident across Streamlit reruns and sessions (the module is imported once
+    per process). When the total resident size exceeds memory_budget_bytes, the least
+    recently used models are evicted; the model currently being requested is never evicted.
+    Whatever else holds on to a model (e.g. its GenerationServer) registers an eviction
+    listener so the memory is actually released.
+    """
+
+    def __init__(self, memory_budget_bytes=None, loader=load_hf_pipeline):
+        self.memory_budget_bytes = memory_budget_bytes
+        self.loader = loader
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self._listeners = []
+
+    def add_eviction_listener(self, callback):
+        """
+        Call callback(entry) whenever a LoadedModel is evicted or unloaded.
+        """
+        self._listeners.append(callback)
+
+    def get(self, model_id=DEFAULT_MODEL_ID):
+        """
+        Return the LangChain LLM for model_id, loading it on first use.
+        """
+        return self.get_entry(model_id).llm
+
+    def get_entry(self, model_id=DEFAULT_MODEL_ID):
+        """
+        Return the LoadedModel for model_id, loading it on first use.
+        """
+        with self._lock:
+            entry = self._touch(model_id)
+            if entry is not None:
+                return entry
+            load_lock = self._load_locks.setdefault(model_id, threading.Lock())
+
+        # Only one thread loads a given model; others wait for it instead of loading a copy
+        with load_lock:
+            with self._lock:
+                entry = self._touch(model_id)
+                if entry is not None:
+                    return entry
+
+            start = time.perf_counter()
+            llm, pipe, tokenizer, model = self.loader(model_id)
+            load_seconds = time.perf_counter() - start
+            size_bytes = model_size_bytes(model) if model is not None else 0
+            entry = LoadedModel(model_id, llm, pipe, tokenizer, model, load_seconds, size_bytes)
+            entry.uses = 1
+            print(f"Loaded model {model_id} in {load_seconds:.2f}s ({size_bytes / 2**20:.1f} MiB resident)")
+
+            with self._lock:
+                self._models[model_id] = entry
+                evicted = self._evict(keep=model_id)
+            self._notify(evicted)
+            return entry
+
+    def is_loaded(self, model_id):
+        with self._lock:
+            return model_id in self._models
+
+    def unload(self, model_id):
+        with self._lock:
+            entry = self._models.pop(model_id, None)
+        if entry is not None:
+            self._notify([entry])
+
+    def resident_bytes(self):
+        with self._lock:
+            return sum(entry.size_bytes for entry in self._models.values())
+
+    def stats(self):
+        """
+        Load time, resident size and usage of every warm model, most recently used last.
+        """
+        with self._lock:
+            return [
+                {
+                    "model_id": entry.model_id,
+                    "load_seconds": round(entry.load_seconds, 3),
+                    "size_bytes": entry.size_bytes,
+                    "uses": entry.uses,
+                    "last_used": entry.last_used,
+                }
+                for entry in self._models.values()
+            ]
+
+    def _touch(self, model_id):
+        entry = self._models.get(model_id)
+        if entry is not None:
+            self._models.move_to_end(model_id)
+            entry.last_used = time.time()
+            entry.uses += 1
+        return entry
+
+    def _notify(self, entries):
+        # Outside self._lock: listeners may call back into the registry
+        for entry in entries:
+            for callback in self._listeners:
+                try:
+                    callback(entry)
+                except Exception as e:
+                    print(f"Eviction listener failed for {entry.model_id}: {e}")
+
+    def _evict(self, keep):
+        evicted = []
+        if self.memory_budget_bytes is None:
+            return evicted
+        total = sum(entry.size_bytes for entry in self._models.values())
+        for model_id in list(self._models):
+            if total <= self.memory_budget_bytes:
+                break
+            if model_id == keep:
+                continue
+            entry = self._models.pop(model_id)
+            evicted.append(entry)
+            total -= entry.size_bytes
+            print(f"Evicted model {model_id} ({entry.size_bytes / 2**20:.1f} MiB) to stay within memory budget")
+        return evicted
+
+
+def _budget_from_env():
+    budget_mb = os.environ.get("SQL_MODEL_MEMORY_BUDGET_MB")
+    return int(budget_mb) * 2**20 if budget_mb else None
+
+
+# Shared by every Streamlit session and rerun in the process
+default_registry = ModelRegistry(memory_budget_bytes=_budget_from_env())
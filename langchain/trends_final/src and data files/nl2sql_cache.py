@@ -0,0 +1,246 @@
+import hashlib
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+
+# Per-user by default: cached SQL is executed as is, so the file must not be writable by others
+NL2SQL_CACHE_PATH = os.environ.get("SQL_NL2SQL_CACHE_PATH",
+                                   os.path.join(os.path.expanduser("~"), ".cache", "llm4sql", "nl2sql_cache.sqlite"))
+# 'USA' or "Rock": a quote that doesn't sit inside a word (as in don't) opens a literal
+_QUOTED = re.compile(r"""(?<!\w)'[^']*'(?!\w)|(?<!\w)"[^"]*"(?!\w)""")
+
+
+def _normalize_text(text):
+    text = text.lower()
+    text = re.sub(r"(?<!\d)[^\w\s'](?!\d)|[?!]", " ", text)
+    return re.sub(r"\s+", " ", text)
+
+
+def normalize_question(question):
+    """
+    Lowercase, drop punctuation (except inside numbers) and collapse whitespace; quoted
+    literals are kept exactly as written ('USA' and 'usa' are different questions).
+    """
+    parts, position = [], 0
+    for match in _QUOTED.finditer(question):
+        parts.append(_normalize_text(question[position:match.start()]))
+        parts.append(match.group())
+        position = match.end()
+    parts.append(_normalize_text(question[position:]))
+    return re.sub(r"\s+", " ", " ".join(parts)).strip()
+
+
+def schema_fingerprint(table_info):
+    """
+    Hash of the table names and (column, type) pairs that llm_create_sql puts in the prompt.
+    """
+    structure = [(table, [(col[1], col[2]) for col in ddl]) for table, ddl, _ in table_info]
+    return hashlib.sha1(repr(structure).encode("utf-8")).hexdigest()
+
+
+def _char_ngrams(text, n=3):
+    padded = f"  {text} "
+    return Counter(padded[i:i + n] for i in range(len(padded) - n + 1))
+
+
+def _cosine(a, b):
+    dot = sum(count * b[gram] for gram, count in a.items() if gram in b)
+    if not dot:
+        return 0.0
+    norm = math.sqrt(sum(v * v for v in a.values())) * math.sqrt(sum(v * v for v in b.values()))
+    return dot / norm
+
+
+def _literals(text):
+    # Numbers and quoted values change the meaning of an otherwise identical question
+    quoted = _QUOTED.findall(text)
+    return sorted(quoted + re.findall(r"\d+(?:\.\d+)?", _QUOTED.sub(" ", text)))
+
+
+# Words that flip or order a question's meaning while barely changing its trigrams, by canonical form
+POLARITY_WORDS = {
+    "no": "not", "not": "not", "without": "not", "never": "not", "none": "not", "nobody": "not",
+    "nothing": "not", "neither": "not", "nor": "not", "except": "not", "excluding": "not",
+    "asc": "asc", "ascending": "asc", "increasing": "asc", "desc": "desc", "descending": "desc",
+    "decreasing": "desc", "highest": "highest", "largest": "highest", "biggest": "highest", "top": "highest",
+    "maximum": "highest", "max": "highest", "lowest": "lowest", "smallest": "lowest", "bottom": "lowest",
+    "minimum": "lowest", "min": "lowest", "most": "most", "least": "least", "more": "more", "greater": "more",
+    "larger": "more", "above": "more", "over": "more", "less": "less", "fewer": "less", "smaller": "less",
+    "below": "less", "under": "less", "before": "before", "earliest": "before", "oldest": "before",
+    "after": "after", "latest": "after", "newest": "after", "first": "first", "last": "last",
+}
+
+
+def _polarity(text):
+    # Negations and comparison/order words: "artists with no albums" must not reuse "artists with albums"
+    words = re.findall(r"[a-z]+(?:'[a-z]+)?", text)
+    return sorted({"not" if word.endswith("n't") else POLARITY_WORDS[word] for word in words
+                   if word.endswith("n't") or word in POLARITY_WORDS})
+
+
+class NL2SQLCache:
+    """
+    Two-tier cache of generated SQL in front of llm_create_sql.
+
+    Tier one is an exact match on (namespace, schema fingerprint, normalized question).
+    Tier two is a near-duplicate match: character trigram cosine similarity against questions
+    stored for the same namespace and fingerprint, accepted above similarity_threshold and
+    only when both questions have identical numbers and quoted literals and the same negation,
+    order and comparison words (POLARITY_WORDS), since trigrams barely see "no" or "desc". Because the
+    schema fingerprint is part of every lookup, SQL generated for an older schema is never
+    returned. Entries live in an SQLite file with a TTL and a maximum entry count.
+    """
+
+    def __init__(self, path=None, ttl_seconds=7 * 24 * 3600, max_entries=10000, similarity_threshold=0.9):
+        self.path = path or NL2SQL_CACHE_PATH
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # {(namespace, fingerprint): [(normalized_question, ngrams, literals, polarity)]}
+        self._index = {}
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS nl2sql_cache (
+                namespace TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                question TEXT NOT NULL,
+                sql_query TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (namespace, fingerprint, question)
+            )
+        """)
+        self._conn.commit()
+
+    def lookup(self, question, fingerprint, namespace=""):
+        """
+        Return cached SQL for the question, or None on a miss.
+        """
+        normalized = normalize_question(question)
+        now = time.time()
+        with self._lock:
+            sql_query = self._get(namespace, fingerprint, normalized, now)
+            if sql_query is not None:
+                self.exact_hits += 1
+                return sql_query
+
+            match = self._nearest(namespace, fingerprint, normalized)
+            if match is not None:
+                sql_query = self._get(namespace, fingerprint, match, now)
+                if sql_query is not None:
+                    self.near_hits += 1
+                    print(f"Near-duplicate cache hit: '{question}' ~ '{match}'")
+                    return sql_query
+
+            self.misses += 1
+            return None
+
+    def store(self, question, fingerprint, sql_query, namespace=""):
+        normalized = normalize_question(question)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO nl2sql_cache VALUES (?, ?, ?, ?, ?, ?)",
+                (namespace, fingerprint, normalized, sql_query, now, now),
+            )
+            self._evict(now)
+            self._conn.commit()
+            self._index.pop((namespace, fingerprint), None)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM nl2sql_cache")
+            self._conn.commit()
+            self._index.clear()
+
+    def stats(self):
+        lookups = self.exact_hits + self.near_hits + self.misses
+        return {
+            "exact_hits": self.exact_hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "hit_rate": (self.exact_hits + self.near_hits) / lookups if lookups else 0.0,
+        }
+
+    def _get(self, namespace, fingerprint, normalized, now):
+        row = self._conn.execute(
+            "SELECT sql_query, created_at FROM nl2sql_cache WHERE namespace = ? AND fingerprint = ? AND question = ?",
+            (namespace, fingerprint, normalized),
+        ).fetchone()
+        if row is None:
+            return None
+        sql_query, created_at = row
+        if now - created_at > self.ttl_seconds:
+            self._conn.execute(
+                "DELETE FROM nl2sql_cache WHERE namespace = ? AND fingerprint = ? AND question = ?",
+                (namespace, fingerprint, normalized),
+            )
+            self._conn.commit()
+            self._index.pop((namespace, fingerprint), None)
+            return None
+        self._conn.execute(
+            "UPDATE nl2sql_cache SET last_used = ? WHERE namespace = ? AND fingerprint = ? AND question = ?",
+            (now, namespace, fingerprint, normalized),
+        )
+        self._conn.commit()
+        return sql_query
+
+    def _nearest(self, namespace, fingerprint, normalized):
+        key = (namespace, fingerprint)
+        if key not in self._index:
+            rows = self._conn.execute(
+                "SELECT question FROM nl2sql_cache WHERE namespace = ? AND fingerprint = ?",
+                (namespace, fingerprint),
+            ).fetchall()
+            self._index[key] = [(q, _char_ngrams(q), _literals(q), _polarity(q)) for (q,) in rows]
+
+        grams = _char_ngrams(normalized)
+        literals = _literals(normalized)
+        polarity = _polarity(normalized)
+        best, best_score = None, self.similarity_threshold
+        for stored, stored_grams, stored_literals, stored_polarity in self._index[key]:
+            if stored_literals != literals or stored_polarity != polarity:
+                continue
+            score = _cosine(grams, stored_grams)
+            if score >= best_score:
+                best, best_score = stored, score
+        return best
+
+    def _evict(self, now):
+        self._conn.execute("DELETE FROM nl2sql_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        count = self._conn.execute("SELECT COUNT(*) FROM nl2sql_cache").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM nl2sql_cache WHERE rowid IN "
+                "(SELECT rowid FROM nl2sql_cache ORDER BY last_used ASC LIMIT ?)",
+                (count - self.max_entries,),
+            )
+            # Evicted questions may sit in any namespace's index
+            self._index.clear()
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache():
+    """
+    Process-wide cache at NL2SQL_CACHE_PATH (~/.cache/llm4sql by default), opened on first use.
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = NL2SQLCache()
+        return _default_cache
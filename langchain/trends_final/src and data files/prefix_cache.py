@@ -0,0 +1,185 @@
+import argparse
+import copy
+import os
+import time
+import threading
+import weakref
+from collections import OrderedDict
+
+from instrumentation import count, span
+
+
+# Memory for cached past key/values, per model
+PREFIX_CACHE_BYTES = int(os.environ.get("SQL_PREFIX_CACHE_MB", 512)) * 2**20
+PREFIX_CACHING = os.environ.get("SQL_PREFIX_CACHING", "1") == "1"
+# Largest schema sent whole (unpruned) so its prefix is cached; bigger schemas are pruned per question
+PREFIX_SCHEMA_MAX_TOKENS = int(os.environ.get("SQL_PREFIX_SCHEMA_MAX_TOKENS", 1024))
+
+
+def past_bytes(past):
+    """
+    Memory held by past key/values (a transformers Cache or the legacy tuple of tuples).
+    """
+    if hasattr(past, "layers"):
+        # Newer transformers caches: one layer object (keys, values) per decoder layer
+        past = [(layer.keys, layer.values) for layer in past.layers]
+    elif hasattr(past, "to_legacy_cache"):
+        past = past.to_legacy_cache()
+    return sum(tensor.numel() * tensor.element_size() for layer in past for tensor in layer if tensor is not None)
+
+
+def supports_prefix_caching(model):
+    """
+    Only decoder-only PyTorch models: encoder-decoder and ONNX Runtime models manage their own inputs.
+    """
+    import torch
+
+    config = getattr(model, "config", None)
+    return (PREFIX_CACHING and isinstance(model, torch.nn.Module)
+            and not getattr(config, "is_encoder_decoder", False))
+
+
+class PrefixCache:
+    """
+    LRU of the model's past key/values for prompt prefixes (the schema preamble of a database).
+
+    Entries are keyed by the prefix text and evicted least recently used first once their total
+    size exceeds max_bytes. Entries are never mutated; callers get a copy to extend.
+    """
+
+    def __init__(self, max_bytes=PREFIX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # prefix -> (prefix_ids, past, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, model, tokenizer, prefix):
+        """
+        (prefix_ids, past, hit) for prefix, encoding it on a miss.
+        """
+        import torch
+
+        with self._lock:
+            entry = self._entries.get(prefix)
+            if entry is not None:
+                self._entries.move_to_end(prefix)
+                self.hits += 1
+                return entry[0], entry[1], True
+            self.misses += 1
+
+        prefix_ids = tokenizer(prefix, return_tensors="pt")["input_ids"]
+        with torch.inference_mode():
+            past = model(input_ids=prefix_ids, use_cache=True).past_key_values
+        size = past_bytes(past)
+        with self._lock:
+            if prefix not in self._entries and size <= self.max_bytes:
+                self._entries[prefix] = (prefix_ids, past, size)
+                self._bytes += size
+                while self._bytes > self.max_bytes:
+                    _, (_, _, evicted) = self._entries.popitem(last=False)
+                    self._bytes -= evicted
+        return prefix_ids, past, False
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+
+_caches = weakref.WeakKeyDictionary()
+_caches_lock = threading.Lock()
+
+
+def get_prefix_cache(model):
+    """
+    The PrefixCache of a model; it goes away with the model (e.g. on registry eviction).
+    """
+    with _caches_lock:
+        cache = _caches.get(model)
+        if cache is None:
+            cache = _caches[model] = PrefixCache()
+        return cache
+
+
+def prefix_cached_inputs(model, tokenizer, prefix, suffix):
+    """
+    generate() inputs for prefix + suffix that reuse the cached prefix key/values.
+
+    The suffix (all but its last token) is run on a copy of the cached past here, so the
+    returned past covers every prompt token except the last and generate() only has to
+    process that one token before decoding.
+    """
+    import torch
+
+    suffix_ids = tokenizer(suffix, return_tensors="pt", add_special_tokens=False)["input_ids"]
+    if suffix_ids.shape[1] == 0:
+        return dict(tokenizer(prefix, return_tensors="pt"))
+
+    with span("prefix_cache") as s:
+        prefix_ids, past, hit = get_prefix_cache(model).get(model, tokenizer, prefix)
+        input_ids = torch.cat([prefix_ids, suffix_ids], dim=1)
+        with torch.inference_mode():
+            past = copy.deepcopy(past)
+            if suffix_ids.shape[1] > 1:
+                past = model(input_ids=suffix_ids[:, :-1], past_key_values=past,
+                             attention_mask=torch.ones_like(input_ids[:, :-1]), use_cache=True).past_key_values
+        s.set(hit=hit, prefix_tokens=prefix_ids.shape[1], suffix_tokens=suffix_ids.shape[1])
+    count("prefix_cache_hits" if hit else "prefix_cache_misses", 1)
+    return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids), "past_key_values": past}
+
+
+def measure_prefill(model, tokenizer, prompts, prefix):
+    """
+    Mean seconds to encode each prompt in full vs. with the cached prefix (after one warm-up).
+    """
+    import torch
+
+    with torch.inference_mode():
+        start = time.perf_counter()
+        for prompt in prompts:
+            model(**tokenizer(prompt, return_tensors="pt"), use_cache=True)
+        full = (time.perf_counter() - start) / len(prompts)
+
+        get_prefix_cache(model).get(model, tokenizer, prefix)
+        start = time.perf_counter()
+        for prompt in prompts:
+            inputs = prefix_cached_inputs(model, tokenizer, prefix, prompt[len(prefix):])
+            model(input_ids=inputs["input_ids"][:, -1:], past_key_values=inputs["past_key_values"], use_cache=True)
+        cached = (time.perf_counter() - start) / len(prompts)
+    return full, cached
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare prompt prefill time with and without the prefix cache.")
+    parser.add_argument("--db", default="Chinook_Sqlite.sqlite")
+    parser.add_argument("--model", default="NumbersStation/nsql-350M")
+    args = parser.parse_args()
+
+    from benchmark import load_questions
+    from model_registry import default_registry
+    from sql_functions import (SQL_PROMPT_TEMPLATE, connect_db, get_table_info, release_db, schema_prefix,
+                               summarize_tables)
+
+    conn = connect_db(args.db)
+    try:
+        _, table_info = get_table_info(conn)
+    finally:
+        release_db(conn)
+    entry = default_registry.get_entry(args.model)
+    tables_summary = summarize_tables(table_info)
+    questions = [item["question"] for item in load_questions(databases=[args.db]).get(args.db, [])]
+    questions = questions or ["How many rows are in the largest table?"]
+    prompts = [SQL_PROMPT_TEMPLATE.format(tables_summary=tables_summary, examples="", question=question)
+               for question in questions]
+    prefix = schema_prefix(SQL_PROMPT_TEMPLATE, {"tables_summary": tables_summary, "question": ""})
+
+    full, cached = measure_prefill(entry.model, entry.tokenizer, prompts, prefix)
+    print(f"{len(prompts)} prompts, {len(entry.tokenizer(prefix)['input_ids'])} prefix tokens: "
+          f"full prefill {full * 1000:.1f}ms, with prefix cache {cached * 1000:.1f}ms ({full / cached:.1f}x)")
+    print(get_prefix_cache(entry.model).stats())
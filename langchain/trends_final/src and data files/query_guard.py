@@ -0,0 +1,187 @@
+import os
+import re
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from result_stream import MAX_RESULT_ROWS
+from schema_catalog import quote_identifier
+
+
+# Tables with more rows than this are reported when fully scanned
+LARGE_TABLE_ROWS = int(os.environ.get("SQL_LARGE_TABLE_ROWS", 100000))
+# Queries whose nested-loop row estimate exceeds this are rejected
+MAX_ESTIMATED_ROWS = int(os.environ.get("SQL_MAX_ESTIMATED_ROWS", 10**9))
+# Wall-clock budget for executing and fetching one query
+QUERY_TIME_LIMIT = float(os.environ.get("SQL_QUERY_TIME_LIMIT", 30))
+
+
+class QueryTimeout(sqlite3.OperationalError):
+    """
+    Raised when a query is interrupted for exceeding its wall-clock budget.
+    """
+
+
+class GuardResult:
+    """
+    Outcome of the pre-execution analysis: the (possibly rewritten) SQL and what was found.
+    """
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.rejected = None
+        self.rewrites = []
+        self.warnings = []
+        self.plan = []
+        self.estimated_rows = None
+
+
+def strip_sql(sql_query):
+    """
+    Replace string literals and comments with spaces so keyword searches ignore them.
+    """
+    return re.sub(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/",
+                  lambda m: " " * len(m.group(0)), sql_query, flags=re.S)
+
+
+def has_top_level_limit(sql_query):
+    depth = 0
+    for match in re.finditer(r"\(|\)|\bLIMIT\b", strip_sql(sql_query), flags=re.I):
+        token = match.group(0)
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+        elif depth == 0:
+            return True
+    return False
+
+
+def table_aliases(sql_query, table_names=None):
+    """
+    Map the names used in FROM/JOIN clauses (aliases included) to real table names.
+
+    Without table_names, every name right after FROM or JOIN is taken to be a table.
+    """
+    stripped = strip_sql(sql_query)
+    if table_names is None:
+        table_names = re.findall(r"(?:\bFROM\b|\bJOIN\b)\s*[\"`\[]?(\w+(?:\.\w+)?)", stripped, flags=re.I)
+    # The alias is captured in a lookahead so a clause word after one name (", t.Name FROM") isn't consumed
+    pattern = r"(?:\bFROM\b|\bJOIN\b|,)\s*[\"`\[]?(\w+(?:\.\w+)?)[\"`\]]?(?=(?:\s+(?:AS\s+)?(\w+))?)"
+    lookup = {name.lower(): name for name in table_names}
+    aliases = {name.lower(): name for name in table_names}
+    for table, alias in re.findall(pattern, stripped, flags=re.I):
+        if table.lower() in lookup and alias and alias.upper() not in _CLAUSE_WORDS:
+            aliases[alias.lower()] = lookup[table.lower()]
+    return aliases
+
+
+_CLAUSE_WORDS = {"WHERE", "JOIN", "INNER", "LEFT", "RIGHT", "FULL", "CROSS", "NATURAL", "ON", "USING",
+                 "GROUP", "ORDER", "LIMIT", "HAVING", "UNION", "EXCEPT", "INTERSECT", "WINDOW", "OUTER"}
+
+
+def estimate_table_rows(conn, table):
+    """
+    Row estimate from sqlite_stat1 when ANALYZE has run, else max(rowid); None if unknown.
+
+    table may be qualified with the schema of an ATTACHed database (schema.table).
+    """
+    schema, _, name = table.rpartition(".")
+    prefix = f"{quote_identifier(schema)}." if schema else ""
+    try:
+        row = conn.execute(f"SELECT stat FROM {prefix}sqlite_stat1 WHERE tbl = ? LIMIT 1", (name,)).fetchone()
+        if row and row[0]:
+            return int(row[0].split()[0])
+    except sqlite3.Error:
+        pass  # No sqlite_stat1 until ANALYZE has been run
+    try:
+        row = conn.execute(f"SELECT max(rowid) FROM {prefix}{quote_identifier(name)}").fetchone()
+        return row[0] or 0
+    except sqlite3.Error:
+        return None  # WITHOUT ROWID tables and views
+
+
+def guard_query(conn, sql_query, table_names, row_limit=MAX_RESULT_ROWS + 1,
+                large_table_rows=LARGE_TABLE_ROWS, max_estimated_rows=MAX_ESTIMATED_ROWS):
+    """
+    Analyse generated SQL before it runs.
+
+    Rejects anything that is not a single SELECT and nested-loop plans whose estimated row
+    count exceeds max_estimated_rows; warns on full scans of large tables, automatic
+    (unindexed) join indexes and scans joined inside another loop; appends a LIMIT when the
+    statement has none. The row_limit is one past the display cap so truncation is still
+    detected downstream. Every rejection and rewrite is logged.
+    """
+    result = GuardResult(sql_query.strip().rstrip(";").strip())
+    stripped = strip_sql(result.sql).strip()
+
+    if not re.match(r"(?is)^(SELECT|WITH)\b", stripped):
+        result.rejected = "only SELECT statements can be executed"
+    elif ";" in stripped:
+        result.rejected = "multiple statements are not allowed"
+    if result.rejected:
+        print(f"Query rejected ({result.rejected}): {sql_query}")
+        return result
+
+    # Raises sqlite3.Error for SQL that does not compile; callers report it like an execution error
+    result.plan = conn.execute("EXPLAIN QUERY PLAN " + result.sql).fetchall()
+    aliases = table_aliases(result.sql, table_names)
+
+    estimated = 1
+    scans_seen = 0
+    for _, parent, _, detail in result.plan:
+        match = re.match(r"(SCAN|SEARCH)(?: TABLE)? (\w+)", detail)
+        if "AUTOMATIC" in detail:
+            result.warnings.append(f"unindexed join, SQLite builds a temporary index: {detail}")
+        if not match:
+            continue
+        op, name = match.groups()
+        table = aliases.get(name.lower(), name)
+        if op == "SEARCH":
+            continue
+        rows = estimate_table_rows(conn, table)
+        if rows is not None and rows >= large_table_rows:
+            result.warnings.append(f"full scan of large table {table} (~{rows:,} rows)")
+        if parent == 0:
+            scans_seen += 1
+            if scans_seen > 1:
+                result.warnings.append(f"{table} is fully scanned for every row of an outer loop")
+            estimated *= max(rows or 1, 1)
+    result.estimated_rows = estimated
+
+    if estimated > max_estimated_rows:
+        result.rejected = (f"estimated {estimated:,} row visits exceeds the limit of {max_estimated_rows:,}; "
+                           "the query is probably missing a join condition")
+        print(f"Query rejected ({result.rejected}): {result.sql}")
+        return result
+
+    if row_limit and not has_top_level_limit(result.sql):
+        result.sql = f"{result.sql}\nLIMIT {int(row_limit)}"
+        result.rewrites.append(f"added LIMIT {int(row_limit)}")
+
+    for reason in result.rewrites:
+        print(f"Query rewritten ({reason}): {result.sql}")
+    for reason in result.warnings:
+        print(f"Query warning: {reason}")
+    return result
+
+
+@contextmanager
+def time_limit(conn, seconds=QUERY_TIME_LIMIT, check_every=10000):
+    """
+    Interrupt any statement on conn that is still running after seconds of wall-clock time.
+
+    The progress handler is checked every check_every SQLite VM instructions, so it also
+    covers rows fetched lazily after execute().
+    """
+    deadline = time.monotonic() + seconds
+    conn.set_progress_handler(lambda: 1 if time.monotonic() > deadline else 0, check_every)
+    try:
+        yield
+    except sqlite3.OperationalError as e:
+        if time.monotonic() > deadline and "interrupted" in str(e):
+            print(f"Query interrupted after exceeding the {seconds:g}s time limit")
+            raise QueryTimeout(f"query exceeded the {seconds:g}s time limit") from e
+        raise
+    finally:
+        conn.set_progress_handler(None, 0)
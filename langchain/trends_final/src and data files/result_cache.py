@@ -0,0 +1,339 @@
+import ast
+import atexit
+import hashlib
+import os
+import pickle
+import re
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from schema_catalog import database_path, file_stat
+
+
+RESULT_CACHE_BYTES = int(os.environ.get("SQL_RESULT_CACHE_MB", 256)) * 2**20
+RESULT_SPILL_BYTES = int(os.environ.get("SQL_RESULT_SPILL_MB", 2048)) * 2**20
+# Spilled results go to a private (0700) directory created per process under this one
+RESULT_SPILL_DIR = os.environ.get("SQL_RESULT_CACHE_DIR", tempfile.gettempdir())
+
+_SQL_TOKENS = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|(?:\s|--[^\n]*|/\*.*?\*/)+", re.S)
+
+
+def normalize_sql(sql_query):
+    """
+    Collapse whitespace and comments outside quoted strings and drop a trailing ';' (case is kept).
+    """
+    collapsed = _SQL_TOKENS.sub(lambda m: m.group(0) if m.group(0)[0] in "'\"" else " ", sql_query)
+    return collapsed.strip().rstrip(";").strip()
+
+
+def _exact_arrow_type(values):
+    import pyarrow as pa
+
+    kinds = {type(value) for value in values if value is not None}
+    if len(kinds) > 1:
+        return None  # Arrow would coerce (1 next to 1.5 comes back as 1.0) or refuse
+    kind = kinds.pop() if kinds else type(None)
+    return {int: pa.int64(), float: pa.float64(), str: pa.string(), bytes: pa.binary(),
+            type(None): pa.null()}.get(kind)
+
+
+def columnar(column_data):
+    """
+    An Arrow table of the columns (named c0, c1, ...) when pyarrow is installed and every column
+    holds one value type, so the values come back exactly as they went in; else None.
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        return None
+    if not column_data:
+        return None
+    arrays = []
+    for values in column_data:
+        value_type = _exact_arrow_type(values)
+        if value_type is None:
+            return None
+        try:
+            arrays.append(pa.array(values, type=value_type))
+        except (pa.ArrowInvalid, OverflowError):
+            return None
+    return pa.Table.from_arrays(arrays, names=[f"c{i}" for i in range(len(arrays))])
+
+
+class CachedResult:
+    """
+    A finished query result stored column by column, with the database version it was read at.
+
+    The columns are an Arrow table when columnar() can hold them exactly; columns mixing value
+    types (SQLite allows integers, floats and text in one column) stay Python tuples.
+    """
+
+    def __init__(self, columns, column_data, row_count, byte_count, truncated, truncation_reason,
+                 file_version, generation, table=None):
+        self.columns = columns
+        self.column_data = column_data  # one tuple of values per column, when there is no table
+        self.table = table
+        self.row_count = row_count
+        self.byte_count = byte_count
+        self.truncated = truncated
+        self.truncation_reason = truncation_reason
+        self.file_version = file_version
+        self.generation = generation
+
+    @property
+    def size(self):
+        overhead = 64 * len(self.columns) + 256
+        if self.table is not None:
+            return self.table.nbytes + overhead
+        # Tuples and their boxed values cost roughly twice the raw data
+        return 2 * self.byte_count + overhead
+
+    def chunks(self, chunk_size):
+        if self.table is not None:
+            for batch in self.table.to_batches(max_chunksize=chunk_size):
+                yield list(zip(*(column.to_pylist() for column in batch.columns)))
+            return
+        rows = list(zip(*self.column_data)) if self.column_data else []
+        for start in range(0, len(rows), chunk_size):
+            yield rows[start:start + chunk_size]
+
+
+class ResultCollector:
+    """
+    Accumulates the rows of a query as they stream, giving up past max_bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.rows = []
+        self.too_large = False
+
+    def add(self, rows, byte_count):
+        if self.too_large:
+            return
+        if byte_count > self.max_bytes:
+            self.too_large = True
+            self.rows = []
+            return
+        self.rows.extend(rows)
+
+
+class ResultCache:
+    """
+    Result sets keyed by (database path, normalized SQL).
+
+    Results live in memory as columns (Arrow tables where the types allow, see CachedResult),
+    bounded by max_bytes (least recently used first out); evicted results spill as Parquet
+    (pickled columns for the rest), bounded by spill_bytes, to a directory this process creates
+    under spill_dir with mkdtemp (readable by its owner only, never shared with other processes,
+    removed at exit). An entry is stale when the database file (or its WAL) changes mtime/size, or
+    when any pooled connection sees PRAGMA data_version move: data_version is only comparable
+    within one connection, so each connection's last value is tracked and a change bumps the
+    database's generation, which every older entry fails.
+    """
+
+    def __init__(self, max_bytes=RESULT_CACHE_BYTES, spill_dir=RESULT_SPILL_DIR, spill_bytes=RESULT_SPILL_BYTES):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_bytes = spill_bytes
+        self._memory = OrderedDict()  # key -> (CachedResult, size)
+        self._memory_bytes = 0
+        self._spilled = OrderedDict()  # key -> (path, size)
+        self._spilled_bytes = 0
+        self._seen_versions = {}  # (db_path, id(conn)) -> data_version
+        self._generations = {}  # db_path -> int
+        self._private_dir = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _version(self, conn):
+        db_path = database_path(conn)
+        if not db_path:
+            return None, None, None
+        data_version = conn.execute("PRAGMA data_version;").fetchone()[0]
+        with self._lock:
+            seen_key = (db_path, id(conn))
+            previous = self._seen_versions.get(seen_key)
+            if previous is not None and previous != data_version:
+                self._generations[db_path] = self._generations.get(db_path, 0) + 1
+            self._seen_versions[seen_key] = data_version
+            generation = self._generations.get(db_path, 0)
+        return db_path, file_stat(db_path), generation
+
+    def lookup(self, conn, sql_query):
+        """
+        The CachedResult for sql_query on this connection's database, or None if absent or stale.
+        """
+        db_path, file_version, generation = self._version(conn)
+        if db_path is None:
+            return None
+        key = (db_path, normalize_sql(sql_query))
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                cached = entry[0]
+            else:
+                cached = None
+        if cached is None:
+            cached = self._load_spilled(key)
+        if cached is not None and (cached.file_version, cached.generation) != (file_version, generation):
+            self._drop(key)
+            cached = None
+        with self._lock:
+            if cached is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return cached
+
+    def collector(self):
+        # One result may use at most a quarter of the memory budget
+        return ResultCollector(self.max_bytes // 4)
+
+    def store(self, conn, sql_query, collector, result):
+        """
+        Keep the rows gathered by collector for the StreamedResult they produced.
+        """
+        # Truncated results depend on the caller's row/byte caps, which aren't part of the key
+        if collector.too_large or result.truncated:
+            return
+        db_path, file_version, generation = self._version(conn)
+        if db_path is None:
+            return
+        column_data = tuple(zip(*collector.rows)) if collector.rows else ()
+        table = columnar(column_data)
+        cached = CachedResult(result.columns, None if table is not None else column_data, result.row_count,
+                              result.byte_count, result.truncated, result.truncation_reason, file_version, generation,
+                              table=table)
+        self._put((db_path, normalize_sql(sql_query)), cached, cached.size)
+
+    def _put(self, key, cached, size):
+        evicted = []
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_bytes -= old[1]
+            self._memory[key] = (cached, size)
+            self._memory_bytes += size
+            while self._memory_bytes > self.max_bytes and len(self._memory) > 1:
+                old_key, (old_cached, old_size) = self._memory.popitem(last=False)
+                self._memory_bytes -= old_size
+                evicted.append((old_key, old_cached))
+        for old_key, old_cached in evicted:
+            self._spill(old_key, old_cached)
+
+    def _spill_path(self, key):
+        with self._lock:
+            if self._private_dir is None:
+                os.makedirs(self.spill_dir, exist_ok=True)
+                self._private_dir = tempfile.mkdtemp(prefix="llm4sql_results_", dir=self.spill_dir)
+                atexit.register(shutil.rmtree, self._private_dir, True)
+        name = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self._private_dir, name)
+
+    def _spill(self, key, cached):
+        if not self.spill_dir or not self.spill_bytes:
+            return
+        try:
+            path = self._spill_path(key)
+        except OSError as e:
+            print(f"Could not create a spill directory in {self.spill_dir}: {e}")
+            return
+        try:
+            meta = {"columns": cached.columns, "row_count": cached.row_count, "byte_count": cached.byte_count,
+                    "truncated": cached.truncated, "truncation_reason": cached.truncation_reason,
+                    "file_version": cached.file_version, "generation": cached.generation}
+            if cached.table is not None:
+                import pyarrow.parquet as pq
+
+                path += ".parquet"
+                pq.write_table(cached.table.replace_schema_metadata({"llm4sql": repr(meta)}), path)
+            else:
+                # Mixed-type columns are pickled so every value keeps its type
+                path += ".pickle"
+                with open(path, "wb") as f:
+                    pickle.dump((meta, cached.column_data), f, protocol=pickle.HIGHEST_PROTOCOL)
+            size = os.path.getsize(path)
+        except (OSError, ValueError, TypeError) as e:
+            print(f"Could not spill cached result to {path}: {e}")
+            _remove(path)
+            return
+
+        removed = []
+        with self._lock:
+            self._spilled[key] = (path, size)
+            self._spilled_bytes += size
+            while self._spilled_bytes > self.spill_bytes and self._spilled:
+                _, (old_path, old_size) = self._spilled.popitem(last=False)
+                self._spilled_bytes -= old_size
+                removed.append(old_path)
+        for old_path in removed:
+            _remove(old_path)
+
+    def _load_spilled(self, key):
+        with self._lock:
+            spilled = self._spilled.pop(key, None)
+            if spilled is None:
+                return None
+            self._spilled_bytes -= spilled[1]
+        path = spilled[0]
+        table = column_data = None
+        try:
+            if path.endswith(".parquet"):
+                import pyarrow.parquet as pq
+
+                table = pq.read_table(path)
+                meta = ast.literal_eval(table.schema.metadata[b"llm4sql"].decode("utf-8"))
+                table = table.replace_schema_metadata(None)
+            else:
+                with open(path, "rb") as f:
+                    meta, column_data = pickle.load(f)
+        except (OSError, ValueError, KeyError, SyntaxError, pickle.UnpicklingError) as e:
+            print(f"Could not read spilled result {path}: {e}")
+            return None
+        finally:
+            _remove(path)
+        cached = CachedResult(meta["columns"], column_data, meta["row_count"], meta["byte_count"], meta["truncated"],
+                              meta["truncation_reason"], meta["file_version"], meta["generation"], table=table)
+        # Back into memory as the most recently used entry
+        self._put(key, cached, cached.size)
+        return cached
+
+    def _drop(self, key):
+        with self._lock:
+            entry = self._memory.pop(key, None)
+            if entry is not None:
+                self._memory_bytes -= entry[1]
+            spilled = self._spilled.pop(key, None)
+            if spilled is not None:
+                self._spilled_bytes -= spilled[1]
+        if spilled is not None:
+            _remove(spilled[0])
+
+    def clear(self):
+        with self._lock:
+            paths = [path for path, _ in self._spilled.values()]
+            self._memory.clear()
+            self._spilled.clear()
+            self._memory_bytes = self._spilled_bytes = 0
+        for path in paths:
+            _remove(path)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._memory), "bytes": self._memory_bytes, "spilled": len(self._spilled),
+                    "spilled_bytes": self._spilled_bytes, "hits": self.hits, "misses": self.misses}
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+default_result_cache = ResultCache()
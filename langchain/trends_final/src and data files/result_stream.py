@@ -0,0 +1,301 @@
+import csv
+import io
+import json
+import os
+import pickle
+import tempfile
+
+from instrumentation import count, span
+
+
+MAX_RESULT_ROWS = int(os.environ.get("SQL_MAX_RESULT_ROWS", 100000))
+MAX_RESULT_BYTES = int(os.environ.get("SQL_MAX_RESULT_BYTES", 64 * 2**20))
+PREVIEW_ROWS = 1000
+CHUNK_SIZE = 500
+# Exports larger than this spill from memory to a temporary file
+SPOOL_MAX_MEMORY = 8 * 2**20
+
+EXPORT_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "NDJSON": ("ndjson", "application/x-ndjson"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+    "Arrow": ("arrow", "application/vnd.apache.arrow.stream"),
+}
+
+
+def available_export_formats():
+    """
+    Export formats usable in this environment (Parquet and Arrow need pyarrow).
+    """
+    formats = ["CSV", "NDJSON"]
+    try:
+        import pyarrow  # noqa: F401
+        formats.extend(["Parquet", "Arrow"])
+    except ImportError:
+        pass
+    return formats
+
+
+def _row_bytes(row):
+    # Cheap size estimate; exact encoding happens in the exporter
+    size = 0
+    for value in row:
+        if isinstance(value, (str, bytes)):
+            size += len(value)
+        else:
+            size += 8
+    return size
+
+
+class StreamedResult:
+    """
+    Outcome of a streamed query: column names, a bounded preview and the spooled export.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.preview_rows = []
+        self.row_count = 0
+        self.byte_count = 0
+        self.truncated = False
+        self.truncation_reason = None
+        self.export_file = None
+        self.export_format = None
+        self.cache_hit = False
+
+    def export_stream(self):
+        """
+        The spooled export rewound to its start, for a download (read it, don't close it).
+        """
+        if self.export_file is None:
+            return io.BytesIO()
+        self.export_file.seek(0)
+        return self.export_file
+
+    def close(self):
+        if self.export_file is not None:
+            self.export_file.close()
+            self.export_file = None
+
+
+def iter_chunks(cursor, result, chunk_size=CHUNK_SIZE, max_rows=MAX_RESULT_ROWS, max_bytes=MAX_RESULT_BYTES):
+    """
+    Yield lists of rows from an executed cursor with fetchmany, stopping at the row/byte caps.
+
+    Progress and truncation are recorded on result.
+    """
+    return capped_chunks(iter(lambda: cursor.fetchmany(chunk_size), []), result, max_rows, max_bytes)
+
+
+def capped_chunks(chunks, result, max_rows=MAX_RESULT_ROWS, max_bytes=MAX_RESULT_BYTES):
+    """
+    Yield the lists of rows from chunks until the row/byte caps are reached, recording progress
+    and truncation on result.
+    """
+    for rows in chunks:
+        kept = []
+        for row in rows:
+            if result.row_count >= max_rows:
+                result.truncated, result.truncation_reason = True, f"row limit of {max_rows:,} reached"
+                break
+            size = _row_bytes(row)
+            if result.byte_count + size > max_bytes:
+                result.truncated, result.truncation_reason = True, f"size limit of {max_bytes / 2**20:.0f} MiB reached"
+                break
+            result.row_count += 1
+            result.byte_count += size
+            kept.append(row)
+        if kept:
+            yield kept
+        if result.truncated:
+            return
+
+
+def csv_chunks(columns, chunks):
+    """
+    Yield CSV text: the header, then one block per chunk of rows.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def ndjson_chunks(columns, chunks):
+    """
+    Yield newline-delimited JSON objects, one block per chunk of rows.
+    """
+    for rows in chunks:
+        yield "".join(json.dumps(dict(zip(columns, row)), default=str) + "\n" for row in rows)
+
+
+def _arrow_type(values):
+    import pyarrow as pa
+
+    try:
+        return pa.array(values).type
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, OverflowError):
+        return None  # Mixed value types in one SQLite column
+
+
+def _column_type(types):
+    """
+    One Arrow type for a column from the types its chunks inferred: NULL-only chunks don't count,
+    integers widen to float next to floats, and anything else mixed (or all NULL) is text.
+    """
+    import pyarrow as pa
+
+    types = {value_type for value_type in types if value_type is None or not pa.types.is_null(value_type)}
+    if len(types) == 1 and None not in types:
+        return types.pop()
+    if types and None not in types and all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in types):
+        return pa.float64()
+    return pa.string()
+
+
+def _text(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return str(value)
+
+
+def arrow_tables(columns, chunks):
+    """
+    Yield one Arrow table per chunk of rows, all with the same schema.
+
+    SQLite columns aren't typed: a column can be NULL for the first chunks or hold integers,
+    floats and text together, so the schema can't come from the first chunk. Rows are staged
+    in a spooled temporary file while every chunk's types are collected, then read back one
+    chunk at a time, keeping memory at a chunk plus the spool's in-memory threshold.
+    """
+    import pyarrow as pa
+
+    column_types = [[] for _ in columns]
+    chunk_count = 0
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY) as staging:
+        for rows in chunks:
+            for i, values in enumerate(zip(*rows)):
+                column_types[i].append(_arrow_type(values))
+            pickle.dump(rows, staging, protocol=pickle.HIGHEST_PROTOCOL)
+            chunk_count += 1
+        schema = pa.schema([(name, _column_type(types)) for name, types in zip(columns, column_types)])
+        staging.seek(0)
+        for _ in range(chunk_count):
+            rows = pickle.load(staging)
+            arrays = []
+            for field, values in zip(schema, zip(*rows)):
+                if pa.types.is_string(field.type):
+                    values = [_text(value) for value in values]
+                arrays.append(pa.array(values, type=field.type))
+            yield pa.Table.from_arrays(arrays, schema=schema)
+
+
+def write_parquet(columns, chunks, file):
+    """
+    Write chunks of rows to file as Parquet, one row group per chunk.
+    """
+    import pyarrow.parquet as pq
+
+    writer = None
+    for table in arrow_tables(columns, chunks):
+        if writer is None:
+            writer = pq.ParquetWriter(file, table.schema)
+        writer.write_table(table)
+    if writer is not None:
+        writer.close()
+
+
+def write_arrow(columns, chunks, file):
+    """
+    Write chunks of rows to file as an Arrow IPC stream, one record batch per chunk.
+    """
+    import pyarrow as pa
+
+    writer = None
+    for table in arrow_tables(columns, chunks):
+        if writer is None:
+            writer = pa.ipc.new_stream(file, table.schema)
+        writer.write_table(table)
+    if writer is not None:
+        writer.close()
+
+
+def stream_query(conn, sql_query, export_format="CSV", preview_rows=PREVIEW_ROWS, chunk_size=CHUNK_SIZE,
+                 max_rows=MAX_RESULT_ROWS, max_bytes=MAX_RESULT_BYTES, cache=None):
+    """
+    Execute sql_query and stream its rows once: the first preview_rows are kept for display
+    and every row (up to the caps) is written to a spooled export file in export_format.
+
+    Memory use is bounded by the preview, one chunk and the spool's in-memory threshold.
+    With a ResultCache, a current cached result is replayed instead of executing the query
+    (result.cache_hit is set), and a fresh result small enough is stored for next time.
+    """
+    cached = cache.lookup(conn, sql_query) if cache is not None else None
+    cursor = None
+    if cached is not None:
+        result = StreamedResult(cached.columns)
+        result.cache_hit = True
+        # Cached results are complete; this caller's caps apply to the replay as to a fresh run
+        source = capped_chunks(cached.chunks(chunk_size), result, max_rows, max_bytes)
+        collector = None
+        count("result_cache_hits", 1)
+    else:
+        cursor = conn.cursor()
+        with span("execute"):
+            cursor.execute(sql_query)
+        columns = [desc[0] for desc in cursor.description] if cursor.description else []
+        result = StreamedResult(columns)
+        source = iter_chunks(cursor, result, chunk_size, max_rows, max_bytes)
+        collector = cache.collector() if cache is not None else None
+    columns = result.columns
+
+    def chunks():
+        for rows in source:
+            room = preview_rows - len(result.preview_rows)
+            if room > 0:
+                result.preview_rows.extend(rows[:room])
+            if collector is not None:
+                collector.add(rows, result.byte_count)
+            yield rows
+
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    with span("fetch_export", format=export_format) as s:
+        if export_format == "Parquet":
+            write_parquet(columns, chunks(), spool)
+        elif export_format == "Arrow":
+            write_arrow(columns, chunks(), spool)
+        else:
+            writer = ndjson_chunks if export_format == "NDJSON" else csv_chunks
+            for text in writer(columns, chunks()):
+                spool.write(text.encode("utf-8"))
+        export_size = spool.tell()
+        spool.seek(0)
+        s.set(rows=result.row_count, bytes=result.byte_count, export_bytes=export_size, truncated=result.truncated,
+              cache_hit=result.cache_hit)
+    count("rows_returned", result.row_count)
+    count("bytes_returned", result.byte_count)
+
+    if cursor is not None:
+        cursor.close()
+    if collector is not None:
+        cache.store(conn, sql_query, collector, result)
+    result.export_file = spool
+    result.export_format = export_format
+    return result
+
+
+def preview_page(result, page, page_size=100):
+    """
+    Return (rows, page_count) for a 1-based page of the preview.
+    """
+    page_count = max(1, -(-len(result.preview_rows) // page_size))
+    page = min(max(page, 1), page_count)
+    return result.preview_rows[(page - 1) * page_size:page * page_size], page_count
@@ -0,0 +1,245 @@
+import hashlib
+import json
+import os
+import threading
+
+
+class CatalogEntry:
+    """
+    Introspected schema of one SQLite database file.
+    """
+
+    def __init__(self, db_path, table_names, tables, mtime, size, schema_version, data_version, conn_id):
+        self.db_path = db_path
+        self.table_names = table_names
+        # {table: {"columns": [...PRAGMA table_info rows], "foreign_keys": [...], "sample_rows": [...] or None}}
+        self.tables = tables
+        self.mtime = mtime
+        self.size = size
+        self.schema_version = schema_version
+        self.data_version = data_version
+        self.conn_id = conn_id
+
+    @property
+    def fingerprint(self):
+        """
+        Stable hash of the table/column/foreign-key structure (ignores data and samples).
+        """
+        structure = [
+            (table, [tuple(col) for col in self.tables[table]["columns"]],
+             [tuple(fk) for fk in self.tables[table]["foreign_keys"]])
+            for table in self.table_names
+        ]
+        return hashlib.sha1(repr(structure).encode("utf-8")).hexdigest()
+
+    def has_samples(self):
+        return all(self.tables[table]["sample_rows"] is not None for table in self.table_names)
+
+    def table_info(self, include_samples=False):
+        """
+        Return the (table, ddl, sample_rows) tuples expected by llm_create_sql.
+        """
+        return [
+            (table, self.tables[table]["columns"],
+             (self.tables[table]["sample_rows"] or []) if include_samples else [])
+            for table in self.table_names
+        ]
+
+    def to_json(self):
+        return {
+            "db_path": self.db_path,
+            "table_names": self.table_names,
+            "tables": {
+                table: {
+                    "columns": [list(col) for col in info["columns"]],
+                    "foreign_keys": [list(fk) for fk in info["foreign_keys"]],
+                    # Sample rows may hold blobs and are cheap to refetch; never persisted
+                    "sample_rows": None,
+                }
+                for table, info in self.tables.items()
+            },
+            "mtime": self.mtime,
+            "size": self.size,
+            "schema_version": self.schema_version,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        tables = {
+            table: {
+                "columns": [tuple(col) for col in info["columns"]],
+                "foreign_keys": [tuple(fk) for fk in info["foreign_keys"]],
+                "sample_rows": None,
+            }
+            for table, info in data["tables"].items()
+        }
+        return cls(data["db_path"], data["table_names"], tables, data["mtime"], data["size"],
+                   data["schema_version"], data_version=None, conn_id=None)
+
+
+def database_path(conn, schema="main"):
+    """
+    Return the absolute file path of the connection's main (or attached) database, or "" for in-memory databases.
+    """
+    for _, name, path in conn.execute("PRAGMA database_list;").fetchall():
+        if name == schema:
+            return os.path.abspath(path) if path else ""
+    return ""
+
+
+def attached_schemas(conn):
+    """
+    [(schema, path)] of the databases ATTACHed to the connection (main and temp excluded).
+    """
+    return [(name, os.path.abspath(path) if path else "")
+            for _, name, path in conn.execute("PRAGMA database_list;").fetchall() if name not in ("main", "temp")]
+
+
+def file_stat(db_path):
+    """
+    (mtime, size) of a database file; the mtime also moves when its WAL file is written.
+    """
+    stat = os.stat(db_path)
+    # Include the WAL file, which changes before the main file on write
+    wal_path = db_path + "-wal"
+    wal_mtime = os.stat(wal_path).st_mtime if os.path.exists(wal_path) else 0
+    return max(stat.st_mtime, wal_mtime), stat.st_size
+
+
+class SchemaCatalog:
+    """
+    Process-wide cache of database schemas.
+
+    Each database is introspected once; later lookups cost one os.stat and two PRAGMA reads.
+    An entry is rebuilt when the file mtime/size or PRAGMA schema_version change, or when
+    PRAGMA data_version changes on the connection that built it (data_version values are
+    only comparable within a single connection).
+    """
+
+    def __init__(self, cache_dir=None, sample_limit=5):
+        self.cache_dir = cache_dir
+        self.sample_limit = sample_limit
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, conn, include_samples=False, schema="main"):
+        """
+        Return the CatalogEntry for the connection's database, introspecting only if stale.
+
+        schema selects an ATTACHed database; its entry is shared with plain connections to the same file.
+        """
+        db_path = database_path(conn, schema)
+        if not db_path:
+            # In-memory databases have nothing to key on; introspect every time
+            return self._introspect(conn, db_path, include_samples, schema)
+
+        mtime, size = file_stat(db_path)
+        schema_version = conn.execute(f"PRAGMA {quote_identifier(schema)}.schema_version;").fetchone()[0]
+        data_version = conn.execute(f"PRAGMA {quote_identifier(schema)}.data_version;").fetchone()[0]
+
+        with self._lock:
+            entry = self._entries.get(db_path)
+            if entry is None:
+                entry = self._load_from_disk(db_path)
+            if entry is not None and self._is_fresh(entry, conn, mtime, size, schema_version, data_version):
+                entry.conn_id = id(conn)
+                entry.data_version = data_version
+                self._entries[db_path] = entry
+                self.hits += 1
+            else:
+                self.misses += 1
+                entry = None
+
+        if entry is None:
+            entry = self._introspect(conn, db_path, include_samples, schema)
+            entry.mtime, entry.size = mtime, size
+            entry.schema_version, entry.data_version = schema_version, data_version
+            with self._lock:
+                self._entries[db_path] = entry
+            self._save_to_disk(entry)
+        elif include_samples and not entry.has_samples():
+            self._fetch_samples(conn, entry, schema)
+        return entry
+
+    def invalidate(self, db_path=None):
+        """
+        Drop one database (or all databases) from the in-memory cache.
+        """
+        with self._lock:
+            if db_path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(os.path.abspath(db_path), None)
+
+    @staticmethod
+    def _is_fresh(entry, conn, mtime, size, schema_version, data_version):
+        if (entry.mtime, entry.size, entry.schema_version) != (mtime, size, schema_version):
+            return False
+        if entry.conn_id == id(conn) and entry.data_version != data_version:
+            return False
+        return True
+
+    def _introspect(self, conn, db_path, include_samples, schema="main"):
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT name FROM {quote_identifier(schema)}.sqlite_master WHERE type='table';")
+        table_names = [row[0] for row in cursor.fetchall()]
+
+        tables = {}
+        for table in table_names:
+            cursor.execute(f"PRAGMA {quote_identifier(schema)}.table_info({quote_identifier(table)});")
+            columns = cursor.fetchall()
+            cursor.execute(f"PRAGMA {quote_identifier(schema)}.foreign_key_list({quote_identifier(table)});")
+            foreign_keys = cursor.fetchall()
+            tables[table] = {"columns": columns, "foreign_keys": foreign_keys, "sample_rows": None}
+
+        entry = CatalogEntry(db_path, table_names, tables, mtime=None, size=None,
+                             schema_version=None, data_version=None, conn_id=id(conn))
+        if include_samples:
+            self._fetch_samples(conn, entry, schema)
+        return entry
+
+    def _fetch_samples(self, conn, entry, schema="main"):
+        cursor = conn.cursor()
+        for table in entry.table_names:
+            if entry.tables[table]["sample_rows"] is None:
+                cursor.execute(f"SELECT * FROM {quote_identifier(schema)}.{quote_identifier(table)} "
+                               f"LIMIT {int(self.sample_limit)};")
+                entry.tables[table]["sample_rows"] = cursor.fetchall()
+
+    def _disk_path(self, db_path):
+        name = hashlib.sha1(db_path.encode("utf-8")).hexdigest() + ".json"
+        return os.path.join(self.cache_dir, name)
+
+    def _load_from_disk(self, db_path):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._disk_path(db_path), "r", encoding="utf-8") as f:
+                return CatalogEntry.from_json(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _save_to_disk(self, entry):
+        if not self.cache_dir or not entry.db_path:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = self._disk_path(entry.db_path) + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry.to_json(), f)
+            os.replace(tmp_path, self._disk_path(entry.db_path))
+        except OSError as e:
+            print(f"Could not persist schema catalog for {entry.db_path}: {e}")
+
+
+def quote_identifier(name):
+    """
+    Quote an SQLite identifier so table names with spaces or keywords are safe in f-strings.
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+# Shared by every Streamlit session in the process; set SQL_CATALOG_DIR to also persist to disk
+default_catalog = SchemaCatalog(cache_dir=os.environ.get("SQL_CATALOG_DIR"))
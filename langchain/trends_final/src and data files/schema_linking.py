@@ -0,0 +1,249 @@
+import os
+import re
+import threading
+from collections import OrderedDict, defaultdict, deque
+
+from nl2sql_cache import schema_fingerprint
+
+
+# Schema indexes kept per process, least recently used evicted first
+SCHEMA_INDEX_CACHE_SIZE = int(os.environ.get("SQL_SCHEMA_INDEX_CACHE_SIZE", 32))
+# Wider tables are cut down to their keys, the columns the question mentions and the first columns up to this many
+MAX_PROMPT_COLUMNS = int(os.environ.get("SQL_SCHEMA_MAX_COLUMNS", 12))
+# Question words mapped onto the identifier tokens they usually refer to
+SYNONYMS = {
+    "song": ["track"], "songs": ["track"], "tune": ["track"],
+    "singer": ["artist"], "band": ["artist"], "musician": ["artist"],
+    "record": ["album"], "records": ["album"],
+    "client": ["customer"], "buyer": ["customer"], "purchaser": ["customer"],
+    "staff": ["employee"], "worker": ["employee"], "manager": ["employee"], "rep": ["employee", "support"],
+    "sale": ["invoice", "invoiceline"], "sales": ["invoice", "invoiceline"], "purchase": ["invoice"],
+    "order": ["invoice", "order"], "bill": ["invoice"], "billing": ["invoice"], "revenue": ["total", "unitprice"],
+    "spent": ["total"], "spend": ["total"], "price": ["unitprice", "price"], "cost": ["unitprice", "price"],
+    "category": ["genre", "category"], "style": ["genre"], "format": ["mediatype"], "media": ["mediatype"],
+    "length": ["milliseconds"], "duration": ["milliseconds"], "size": ["bytes"],
+    "country": ["country", "billingcountry"], "city": ["city", "billingcity"],
+    "person": ["people"], "persons": ["people"], "firm": ["company"], "job": ["employment"],
+    "directed": ["director", "directed_by"], "wrote": ["writer", "written_by"],
+    "film": ["movie"], "films": ["movie"], "show": ["tv_series"], "actress": ["actor"],
+    "question": ["post"], "answer": ["post"], "user": ["users"], "vote": ["votes"], "tag": ["tags"],
+}
+
+
+def identifier_tokens(name):
+    """
+    Split an identifier into lowercase word tokens: 'InvoiceLine' -> ['invoice', 'line', 'invoiceline'].
+    """
+    parts = re.findall(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+", name)
+    tokens = [part.lower() for part in parts]
+    whole = re.sub(r"[^a-z0-9]", "", name.lower())
+    if whole and whole not in tokens:
+        tokens.append(whole)
+    return [_stem(token) for token in tokens]
+
+
+def _stem(token):
+    if len(token) > 4 and token.endswith("ies"):
+        return token[:-3] + "y"
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+def question_tokens(question):
+    tokens = []
+    for word in re.findall(r"[A-Za-z_][A-Za-z0-9_]*", question):
+        tokens.extend(identifier_tokens(word))
+        for synonym in SYNONYMS.get(word.lower(), []):
+            tokens.append(_stem(synonym))
+    return tokens
+
+
+def count_tokens(text, tokenizer=None):
+    """
+    Prompt token count using the model tokenizer when available, else a word/punctuation estimate.
+    """
+    if tokenizer is not None:
+        return len(tokenizer.encode(text))
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+
+class SchemaIndex:
+    """
+    Inverted index over table and column identifiers with the foreign-key graph.
+
+    Built once per schema; rank() scores tables against a question and prune() returns the
+    top-k tables plus the tables on the foreign-key join paths between them, each cut down to
+    its relevant columns (rank_columns()).
+    """
+
+    def __init__(self, table_info, foreign_keys=None):
+        self.table_info = {table: (table, ddl, rows) for table, ddl, rows in table_info}
+        self.table_names = [table for table, _, _ in table_info]
+        self.foreign_keys = foreign_keys or {}
+        # token -> {table: weight}
+        self.postings = defaultdict(lambda: defaultdict(float))
+        self.neighbours = defaultdict(set)
+        # Primary and foreign key columns per table: always kept, joins need them
+        self.key_columns = defaultdict(set)
+        self._full_schema = None
+        self._full_tokens = {}  # tokenizer name -> tokens of the whole rendered schema
+
+        for table, ddl, _ in table_info:
+            for token in identifier_tokens(table):
+                self.postings[token][table] += 3.0
+            for col in ddl:
+                for token in identifier_tokens(col[1]):
+                    self.postings[token][table] += 1.0
+            self.key_columns[table].update(col[1] for col in ddl if col[5])
+        for table, fks in self.foreign_keys.items():
+            for fk in fks:
+                referenced = fk[2]
+                self.key_columns[table].add(fk[3])
+                if fk[4]:
+                    self.key_columns[referenced].add(fk[4])
+                if referenced in self.table_info and referenced != table:
+                    self.neighbours[table].add(referenced)
+                    self.neighbours[referenced].add(table)
+
+    def full_schema(self):
+        """
+        render() of every table, built once: the same text for every question.
+        """
+        if self._full_schema is None:
+            self._full_schema = self.render(list(self.table_info.values()))
+        return self._full_schema
+
+    def full_tokens(self, tokenizer=None):
+        """
+        Prompt tokens of the whole schema as render() writes it, counted once per tokenizer.
+        """
+        name = getattr(tokenizer, "name_or_path", type(tokenizer).__name__) if tokenizer is not None else None
+        if name not in self._full_tokens:
+            self._full_tokens[name] = count_tokens(self.full_schema(), tokenizer)
+        return self._full_tokens[name]
+
+    def rank(self, question):
+        """
+        Return [(table, score)] sorted by relevance to the question.
+        """
+        scores = defaultdict(float)
+        for token in set(question_tokens(question)):
+            for table, weight in self.postings.get(token, {}).items():
+                scores[table] += weight
+        # Tables next to strong matches are likely join partners
+        for table, score in list(scores.items()):
+            for neighbour in self.neighbours[table]:
+                scores[neighbour] += 0.25 * score
+        return sorted(((table, scores.get(table, 0.0)) for table in self.table_names),
+                      key=lambda item: -item[1])
+
+    def join_path(self, source, target):
+        """
+        Shortest foreign-key path between two tables (inclusive), or [] if they are not connected.
+        """
+        previous = {source: None}
+        queue = deque([source])
+        while queue:
+            table = queue.popleft()
+            if table == target:
+                path = []
+                while table is not None:
+                    path.append(table)
+                    table = previous[table]
+                return path[::-1]
+            for neighbour in sorted(self.neighbours[table]):
+                if neighbour not in previous:
+                    previous[neighbour] = table
+                    queue.append(neighbour)
+        return []
+
+    def rank_columns(self, question, table):
+        """
+        Return [(column, score)] of a table sorted by relevance to the question (schema order on ties).
+        """
+        tokens = set(question_tokens(question))
+        _, ddl, _ = self.table_info[table]
+        scores = [(col[1], sum(1.0 for token in identifier_tokens(col[1]) if token in tokens)) for col in ddl]
+        return sorted(scores, key=lambda item: -item[1])
+
+    def prune_columns(self, question, table, max_columns=MAX_PROMPT_COLUMNS):
+        """
+        The table_info tuple of a table with only its key columns, the columns the question
+        mentions and, up to max_columns, its first columns (in schema order).
+        """
+        table, ddl, rows = self.table_info[table]
+        if len(ddl) <= max_columns:
+            return table, ddl, rows
+        keep = set(self.key_columns[table])
+        keep.update(column for column, score in self.rank_columns(question, table) if score > 0)
+        for col in ddl:
+            if len(keep) >= max_columns:
+                break
+            keep.add(col[1])
+        indexes = [i for i, col in enumerate(ddl) if col[1] in keep]
+        # Sample rows (when fetched) follow the columns
+        return table, [ddl[i] for i in indexes], [tuple(row[i] for i in indexes) for row in rows or []]
+
+    def prune(self, question, top_k=4, min_relative_score=0.3, max_columns=MAX_PROMPT_COLUMNS):
+        """
+        Return the table_info tuples for the top_k relevant tables plus their join paths, with
+        their columns pruned to max_columns (see prune_columns()).
+
+        Tables scoring below min_relative_score of the best table are dropped even if they
+        fit in top_k. Falls back to the full schema when nothing in the question matches.
+        """
+        ranked = self.rank(question)
+        if not ranked or ranked[0][1] <= 0:
+            return list(self.table_info.values())
+
+        cutoff = ranked[0][1] * min_relative_score
+        selected = [table for table, score in ranked[:top_k] if score >= cutoff]
+        keep = set(selected)
+        anchor = selected[0]
+        for table in selected[1:]:
+            keep.update(self.join_path(anchor, table))
+        return [self.prune_columns(question, table, max_columns) for table in self.table_names if table in keep]
+
+    def render(self, table_info):
+        """
+        Compact CREATE TABLE rendering of the given tables, including foreign-key references.
+        """
+        statements = []
+        for table, ddl, _ in table_info:
+            references = {fk[3]: (fk[2], fk[4]) for fk in self.foreign_keys.get(table, [])}
+            columns = []
+            for col in ddl:
+                column = f"{col[1]} {col[2]}".strip()
+                if col[5]:
+                    column += " PRIMARY KEY"
+                if col[1] in references:
+                    ref_table, ref_column = references[col[1]]
+                    column += f" REFERENCES {ref_table}({ref_column or col[1]})"
+                columns.append(column)
+            statements.append(f"CREATE TABLE {table} ({', '.join(columns)});")
+        return "\n".join(statements)
+
+
+_indexes = OrderedDict()  # (schema fingerprint, foreign keys) -> SchemaIndex
+_indexes_lock = threading.Lock()
+
+
+def get_schema_index(table_info, foreign_keys=None):
+    """
+    Return the SchemaIndex for this schema and its foreign keys, building it only the first time
+    they are seen (the SCHEMA_INDEX_CACHE_SIZE most recently used are kept).
+    """
+    # The join graph comes from the foreign keys, so the same tables with other keys need their own index
+    references = tuple(sorted((table, tuple(map(tuple, fks))) for table, fks in (foreign_keys or {}).items()))
+    key = (schema_fingerprint(table_info), references)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = SchemaIndex(table_info, foreign_keys)
+            _indexes[key] = index
+            while len(_indexes) > max(1, SCHEMA_INDEX_CACHE_SIZE):
+                _indexes.popitem(last=False)
+        else:
+            _indexes.move_to_end(key)
+        return index
@@ -0,0 +1,440 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from constrained_decoding import CONSTRAINED_DECODING
+from db_registry import ATTACH_MODE, DatabaseRegistry, parse_databases
+from inference_backends import default_backend, set_default_backend
+from jobs import job_manager
+from model_registry import DEFAULT_MODEL_ID
+from query_guard import QueryTimeout
+from result_stream import EXPORT_FORMATS, available_export_formats
+from warmup import Warmer
+
+
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Idle keep-alive for `serve`; longer than the usual 60s load balancer idle timeout
+KEEP_ALIVE_SECONDS = 75
+# Translation threads mostly wait on the batching generation server, so there can be many
+TRANSLATE_WORKERS = int(os.environ.get("SQL_SERVICE_WORKERS", 16))
+READ_CHUNK = 64 * 1024
+# Response formats for /execute: "json" plus the export formats
+FORMAT_NAMES = {"json": None, "csv": "CSV", "ndjson": "NDJSON", "parquet": "Parquet", "arrow": "Arrow"}
+# Request body fields and the JSON type each must have
+PAYLOAD_TYPES = {"database": str, "question": str, "sql": str, "format": str, "questions": list}
+
+
+class ServiceError(Exception):
+    """
+    A request that can't be served; status is the HTTP status to answer with.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def load_config(path=None):
+    """
+    Service configuration from a JSON file (path, or SQL_SERVICE_CONFIG).
+
+    {"model_id": "...", "backend": "int8", "databases": {"chinook": "Chinook_Sqlite.sqlite", ...},
+     "top_k": 4, "constrained": true, "attach": false}. Relative database paths are resolved against the config
+    file. Without "databases", the same registry as the apps is served (databases.json, or the *.sqlite files
+    next to this module under their file names without extension; see db_registry.py). With "attach", every
+    database is also served ATTACHed into one connection.
+    """
+    path = path or os.environ.get("SQL_SERVICE_CONFIG")
+    config = {}
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+    attach_mode = config.get("attach", ATTACH_MODE)
+    if config.get("databases") is None:
+        registry = DatabaseRegistry.load(attach_mode=attach_mode)
+    else:
+        registry = DatabaseRegistry(parse_databases(config["databases"], os.path.dirname(os.path.abspath(path))),
+                                    attach_mode=attach_mode)
+    return {
+        "model_id": config.get("model_id", DEFAULT_MODEL_ID),
+        "backend": config.get("backend", default_backend()),
+        # Like the apps, only databases whose files exist
+        "databases": {name: registry.get(name).path for name in registry.names()},
+        "top_k": config.get("top_k", 4),
+        "constrained": config.get("constrained", CONSTRAINED_DECODING),
+        "registry": registry,
+    }
+
+
+class NL2SQLService:
+    """
+    The NL->SQL engine without a UI: translate questions, execute SQL and translate in bulk.
+
+    The model and the database list are loaded once per process and shared by all requests;
+    the methods are blocking and safe to call from many threads. Translations run on the
+    service's own pool, SQL execution on the job layer's execution pool. When served, the
+    warmer (see warmup.py) prepares every database and the model in the background; /ready
+    answers 503 until it has.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.model_id = config["model_id"]
+        self.databases = config["databases"]
+        set_default_backend(config["backend"])
+        self.translate_executor = ThreadPoolExecutor(TRANSLATE_WORKERS, thread_name_prefix="sql-translate")
+        _, self.execute_executor = job_manager.executors()
+        self.warmer = Warmer(config["registry"], model_id=self.model_id, constrained=config["constrained"])
+
+    def database_path(self, database):
+        if database not in self.databases:
+            raise ServiceError(404, f"unknown database {database!r}; known: {sorted(self.databases)}")
+        return self.databases[database]
+
+    def translate(self, database, question):
+        from example_store import get_example_store
+        from generation_server import get_generation_server
+        from model_registry import default_registry
+        from nl2sql_cache import get_default_cache
+        from schema_linking import get_schema_index
+        from sql_functions import connect_db, get_foreign_keys, get_table_info, llm_create_sql, release_db
+
+        if not question or not question.strip():
+            raise ServiceError(400, "question is empty")
+        started = time.perf_counter()
+        conn = connect_db(self.database_path(database))
+        if conn is None:
+            raise ServiceError(404, f"database file for {database!r} does not exist")
+        try:
+            _, table_info = get_table_info(conn)
+            if not table_info:
+                raise ServiceError(422, f"no valid tables found in {database!r}")
+            sql_query = llm_create_sql(table_info=table_info, question=question,
+                                       lang_model=default_registry.get(self.model_id), cache=get_default_cache(),
+                                       schema_index=get_schema_index(table_info, get_foreign_keys(conn)),
+                                       top_k=self.config["top_k"], generator=get_generation_server(self.model_id),
+                                       constrained=self.config["constrained"], conn=conn,
+                                       examples=get_example_store())
+        finally:
+            release_db(conn)
+        return {"database": database, "question": question, "sql": sql_query,
+                "seconds": round(time.perf_counter() - started, 4)}
+
+    def execute(self, database, sql_query, export_format="NDJSON"):
+        """
+        Guard and run sql_query; returns (GuardResult, StreamedResult). The caller closes the result.
+        """
+        from index_advisor import default_workload_log
+        from query_guard import guard_query, time_limit
+        from result_cache import default_result_cache
+        from result_stream import stream_query
+        from sql_functions import connect_db, get_table_info, release_db
+
+        if export_format not in available_export_formats():
+            raise ServiceError(406, f"{export_format} output is not available (pyarrow missing?)")
+        conn = connect_db(self.database_path(database))
+        if conn is None:
+            raise ServiceError(404, f"database file for {database!r} does not exist")
+        try:
+            table_names, _ = get_table_info(conn)
+            try:
+                guard = guard_query(conn, sql_query, table_names)
+                if guard.rejected:
+                    raise ServiceError(422, f"query not executed: {guard.rejected}")
+                started = time.perf_counter()
+                with time_limit(conn):
+                    result = stream_query(conn, guard.sql, export_format=export_format, cache=default_result_cache)
+                if not result.cache_hit:
+                    default_workload_log.record(self.database_path(database), guard.sql,
+                                                time.perf_counter() - started, result.row_count)
+                return guard, result
+            except QueryTimeout as e:
+                raise ServiceError(504, str(e))
+            except sqlite3.Error as e:
+                raise ServiceError(422, f"query failed: {e}")
+        finally:
+            release_db(conn)
+
+    def batch(self, database, questions):
+        """
+        Translate questions concurrently; their prompts meet in the generation server's queue and
+        are batched on the model (constrained decoding is applied per prompt inside the batch).
+        """
+        futures = [self.translate_executor.submit(self._translate_or_error, database, question)
+                   for question in questions]
+        return [future.result() for future in futures]
+
+    def _translate_or_error(self, database, question):
+        try:
+            return self.translate(database, question)
+        except Exception as e:
+            return {"database": database, "question": question, "sql": None, "error": str(e)}
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_service(config_path=None):
+    """
+    Process-wide service, configured on first use.
+    """
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = NL2SQLService(load_config(config_path))
+        return _service
+
+
+def result_body(guard, result):
+    """
+    JSON document with the rows of an NDJSON result, built from the spooled export in chunks of
+    about READ_CHUNK bytes.
+    """
+    header = json.dumps({"sql": guard.sql, "columns": result.columns, "row_count": result.row_count,
+                         "truncated": result.truncated, "cached": result.cache_hit,
+                         "warnings": guard.warnings})[:-1].encode("utf-8")
+    parts = [header, b', "rows": [']
+    size = 0
+    first = True
+    for line in result.export_file:
+        line = line.rstrip(b"\n")
+        if not line:
+            continue
+        parts.append(line if first else b"," + line)
+        first = False
+        size += len(line) + 1
+        if size >= READ_CHUNK:
+            yield b"".join(parts)
+            parts = []
+            size = 0
+    parts.append(b"]}")
+    yield b"".join(parts)
+
+
+def export_body(result):
+    while True:
+        chunk = result.export_file.read(READ_CHUNK)
+        if not chunk:
+            return
+        yield chunk
+
+
+# ASGI application: GET /health, GET /ready, GET /databases, POST /translate, POST /execute, POST /batch
+
+async def _read_json(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    try:
+        payload = json.loads(body or b"{}")
+    except ValueError:
+        raise ServiceError(400, "request body is not valid JSON")
+    if not isinstance(payload, dict):
+        raise ServiceError(400, "request body must be a JSON object")
+    for field, expected in PAYLOAD_TYPES.items():
+        value = payload.get(field)
+        if value is not None and not isinstance(value, expected):
+            raise ServiceError(400, f"{field} must be a {'list' if expected is list else 'string'}")
+    if not all(isinstance(question, str) for question in payload.get("questions") or []):
+        raise ServiceError(400, "questions must be a list of strings")
+    return payload
+
+
+async def _respond(send, status, body, content_type="application/json"):
+    if not isinstance(body, (bytes, str)):
+        body = json.dumps(body, default=str)
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _respond_stream(send, content_type, chunks):
+    # No content-length: the server uses chunked encoding and keeps the connection alive
+    await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", content_type.encode())]})
+    loop = asyncio.get_running_loop()
+    chunks = iter(chunks)
+    while True:
+        # Each chunk is read from the spooled result file: keep the blocking reads off the event loop
+        chunk = await loop.run_in_executor(None, next, chunks, None)
+        if chunk is None:
+            break
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+def _require(payload, *fields):
+    missing = [field for field in fields if not payload.get(field)]
+    if missing:
+        raise ServiceError(400, f"missing field(s): {', '.join(missing)}")
+
+
+def _response_format(payload, headers):
+    name = payload.get("format")
+    if name is None:
+        accept = headers.get(b"accept", b"").decode("latin-1")
+        name = next((fmt for fmt, export in FORMAT_NAMES.items()
+                     if export and EXPORT_FORMATS[export][1] in accept), "json")
+    if name.lower() not in FORMAT_NAMES:
+        raise ServiceError(400, f"unknown format {name!r}; use one of {sorted(FORMAT_NAMES)}")
+    return name.lower()
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                get_service().warmer.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    service = get_service()
+    loop = asyncio.get_running_loop()
+    route = (scope["method"], scope["path"].rstrip("/") or "/")
+    try:
+        if route == ("GET", "/health"):
+            await _respond(send, 200, {"status": "ok", "model_id": service.model_id,
+                                       "backend": service.config["backend"]})
+        elif route == ("GET", "/ready"):
+            # Readiness for the load balancer: 200 once every database and the model are warm
+            warmer = service.warmer.start()
+            await _respond(send, 200 if warmer.ready() else 503, warmer.status())
+        elif route == ("GET", "/databases"):
+            await _respond(send, 200, {"databases": sorted(service.databases)})
+        elif route == ("POST", "/translate"):
+            payload = await _read_json(receive)
+            _require(payload, "database", "question")
+            body = await loop.run_in_executor(service.translate_executor, service.translate, payload["database"],
+                                              payload["question"])
+            await _respond(send, 200, body)
+        elif route == ("POST", "/batch"):
+            payload = await _read_json(receive)
+            _require(payload, "database", "questions")
+            # Runs on the default executor: batch() itself queues onto the translation pool
+            body = await loop.run_in_executor(None, service.batch, payload["database"], payload["questions"])
+            await _respond(send, 200, {"results": body})
+        elif route == ("POST", "/execute"):
+            payload = await _read_json(receive)
+            _require(payload, "database")
+            response_format = _response_format(payload, dict(scope["headers"]))
+            sql_query = payload.get("sql")
+            if not sql_query:
+                _require(payload, "question")
+                translated = await loop.run_in_executor(service.translate_executor, service.translate, payload["database"],
+                                                        payload["question"])
+                sql_query = translated["sql"]
+            export_format = FORMAT_NAMES[response_format] or "NDJSON"
+            guard, result = await loop.run_in_executor(service.execute_executor, service.execute, payload["database"], sql_query,
+                                                       export_format)
+            try:
+                if response_format == "json":
+                    await _respond_stream(send, "application/json", result_body(guard, result))
+                else:
+                    await _respond_stream(send, EXPORT_FORMATS[export_format][1], export_body(result))
+            finally:
+                result.close()
+        else:
+            await _respond(send, 404, {"error": f"no route for {route[0]} {route[1]}"})
+    except ServiceError as e:
+        await _respond(send, e.status, {"error": str(e)})
+    except Exception as e:
+        print(f"Request {route[0]} {route[1]} failed: {e}")
+        await _respond(send, 500, {"error": str(e)})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless NL->SQL service and command line.")
+    parser.add_argument("--config", help="Service config JSON (default: SQL_SERVICE_CONFIG or bundled databases)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="Serve the ASGI app with uvicorn")
+    serve.add_argument("--host", default="0.0.0.0")
+    serve.add_argument("--port", type=int, default=8000)
+    serve.add_argument("--workers", type=int, default=1, help="Processes; each loads its own model")
+
+    translate = commands.add_parser("translate", help="Print the SQL for a question")
+    translate.add_argument("--db", required=True)
+    translate.add_argument("question")
+
+    execute = commands.add_parser("execute", help="Run SQL (or a question) and write the result")
+    execute.add_argument("--db", required=True)
+    execute.add_argument("sql", help="SQL to run; with --question, a question to translate first")
+    execute.add_argument("--question", action="store_true")
+    execute.add_argument("--format", choices=sorted(FORMAT_NAMES), default="csv")
+    execute.add_argument("--output", help="File to write (default: stdout)")
+
+    batch = commands.add_parser("batch", help="Translate one question per line; prints JSON lines")
+    batch.add_argument("--db", required=True)
+    batch.add_argument("input", help="Text file with one question per line, or - for stdin")
+    args = parser.parse_args(argv)
+
+    if args.config:
+        os.environ["SQL_SERVICE_CONFIG"] = args.config
+
+    if args.command == "serve":
+        try:
+            import uvicorn
+        except ImportError:
+            raise SystemExit("serve needs uvicorn: pip install uvicorn")
+        sys.path.insert(0, SERVICE_DIR)
+        uvicorn.run("service:app", host=args.host, port=args.port, workers=args.workers,
+                    timeout_keep_alive=KEEP_ALIVE_SECONDS)
+        return
+
+    # Progress messages go to stderr so stdout carries only the result
+    stdout = sys.stdout
+    service = get_service()
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            _run_command(service, args, stdout)
+    except ServiceError as e:
+        raise SystemExit(f"error: {e}")
+
+
+def _run_command(service, args, stdout):
+    if args.command == "translate":
+        print(service.translate(args.db, args.question)["sql"], file=stdout)
+    elif args.command == "execute":
+        sql_query = service.translate(args.db, args.sql)["sql"] if args.question else args.sql
+        export_format = FORMAT_NAMES[args.format] or "NDJSON"
+        guard, result = service.execute(args.db, sql_query, export_format)
+        try:
+            chunks = result_body(guard, result) if args.format == "json" else export_body(result)
+            out = open(args.output, "wb") if args.output else stdout.buffer
+            try:
+                for chunk in chunks:
+                    out.write(chunk)
+            finally:
+                if args.output:
+                    out.close()
+                else:
+                    out.flush()
+        finally:
+            result.close()
+    elif args.command == "batch":
+        source = sys.stdin if args.input == "-" else open(args.input, "r", encoding="utf-8")
+        with source:
+            questions = [line.strip() for line in source if line.strip()]
+        for record in service.batch(args.db, questions):
+            print(json.dumps(record), file=stdout)
+
+
+if __name__ == '__main__':
+    main()
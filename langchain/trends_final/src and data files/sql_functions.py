@@ -1,88 +1,329 @@
 import sqlite3
 import os
-import pandas as pd
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
+import time
+from connection_pool import default_pools
+from instrumentation import count, is_active, span
+from schema_catalog import attached_schemas, default_catalog
+from nl2sql_cache import schema_fingerprint
+from schema_linking import count_tokens
+from prefix_cache import PREFIX_SCHEMA_MAX_TOKENS, supports_prefix_caching
+from constrained_decoding import sql_logits_processor
+from sql_repair import default_repair_cache, validate_and_repair
+from example_store import examples_for_prompt
+from sql_streaming import SQLCompletionDetector, stream_sql
 
 # SQLite connection setup
 def connect_db(db_path):
-    # Ensure the directory exists
-    db_dir = os.path.dirname(db_path)
-    if not os.path.exists(db_dir):
-        print(f"Directory {db_dir} does not exist. Creating it.")
-        os.makedirs(db_dir)  # Create directory if it doesn't exist
+    """
+    Check out a pooled, read-only connection to db_path; return it with release_db().
 
-    # Check if the file exists and is accessible
-    if not os.path.exists(db_path):
-        print(f"Database file {db_path} does not exist. Creating the file.")
+    Returns None if the database file does not exist (it is never created).
+    """
+    if not default_pools.has_pool(db_path) and not os.path.isfile(db_path):
+        print(f"Database file {db_path} does not exist.")
+        return None
 
     try:
-        # Connect to the SQLite database
-        conn = sqlite3.connect(db_path)
+        with span("connect", db=os.path.basename(db_path)):
+            conn = default_pools.checkout(db_path)
         print(f"Successfully connected to the database at {db_path}")
         return conn
     except sqlite3.OperationalError as e:
         print(f"Error while connecting to the database: {e}")
         raise
 
-def get_table_info(conn):
+def release_db(conn):
     """
-    Retrieve all table names and sample rows from the database.
+    Return a connection from connect_db() to its pool.
     """
-    try:
-        cursor = conn.cursor()
+    default_pools.release(conn)
+
+def get_table_info(conn, include_samples=False):
+    """
+    Retrieve all table names and column info from the database.
 
-        # Get all table names
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        tables = cursor.fetchall()
-        if not tables:
+    Results come from the shared schema catalog, so the database is only re-introspected
+    when its file or schema changes. Sample rows are only fetched when include_samples is set.
+    On a connection with ATTACHed databases, the tables of every attached database are
+    returned as schema.table.
+    """
+    try:
+        with span("introspect") as s:
+            schemas = attached_schemas(conn)
+            if schemas:
+                table_names, table_info = [], []
+                for schema, _ in schemas:
+                    entry = default_catalog.get(conn, include_samples=include_samples, schema=schema)
+                    table_names += [f"{schema}.{table}" for table in entry.table_names]
+                    table_info += [(f"{schema}.{table}", ddl, rows)
+                                   for table, ddl, rows in entry.table_info(include_samples=include_samples)]
+            else:
+                entry = default_catalog.get(conn, include_samples=include_samples)
+                table_names, table_info = entry.table_names, entry.table_info(include_samples=include_samples)
+            s.set(tables=len(table_names))
+        if not table_names:
             print("No tables found in the database.")
             return None, None
 
-        table_names = [table[0] for table in tables]
-
-        # Get DDL and sample rows for each table
-        table_info = []
-        for table in table_names:
-            cursor.execute(f"PRAGMA table_info({table});")
-            ddl = cursor.fetchall()
-
-            cursor.execute(f"SELECT * FROM {table} LIMIT 5;")
-            sample_rows = cursor.fetchall()
-
-            table_info.append((table, ddl, sample_rows))
-
         return table_names, table_info
-    except sqlite3.Error as e:
+    except (sqlite3.Error, OSError) as e:
         print(f"Error retrieving table information: {e}")
         return None, None
 
-def llm_create_sql(table_info, question, lang_model):
+def get_foreign_keys(conn):
     """
-    Use the LLM to generate a SQL query based on table information and the user question.
+    Return {table: PRAGMA foreign_key_list rows} from the shared schema catalog.
+
+    Tables of ATTACHed databases (and the tables their keys reference) are named schema.table.
     """
-    # Format table information to include only names and DDL (excluding "Sample Rows")
-    tables_summary = "\n\n".join(
+    schemas = attached_schemas(conn)
+    if not schemas:
+        entry = default_catalog.get(conn)
+        return {table: info["foreign_keys"] for table, info in entry.tables.items()}
+    foreign_keys = {}
+    for schema, _ in schemas:
+        entry = default_catalog.get(conn, schema=schema)
+        for table, info in entry.tables.items():
+            foreign_keys[f"{schema}.{table}"] = [fk[:2] + (f"{schema}.{fk[2]}",) + tuple(fk[3:])
+                                                 for fk in info["foreign_keys"]]
+    return foreign_keys
+
+def summarize_tables(table_info):
+    """
+    Format table information to include only names and DDL (excluding "Sample Rows").
+    """
+    return "\n\n".join(
         f"Table Name: {table}\nSchema: {[(col[1], col[2]) for col in ddl]}" for table, ddl, rows in table_info
     )
 
-    # Updated prompt with clear instructions and clean metadata
-    create_prompt = PromptTemplate(
-        input_variables=["tables_summary", "question"],
-        template=f"""
+# Updated prompt with clear instructions and clean metadata
+SQL_PROMPT_TEMPLATE = """
         The following is the schema of tables in the database:
         {tables_summary}
-
+{examples}
         Using valid SQL syntax, answer the following question:
         {question}
         """
-    )
 
-    # Initialize the LLMChain with the prompt and the LLM model
-    create_chain = LLMChain(llm=lang_model, prompt=create_prompt, verbose=False)
+REPAIR_PROMPT_TEMPLATE = """
+        The following is the schema of tables in the database:
+        {tables_summary}
+
+        This SQL query fails with the error "{error}":
+        {sql_query}
+
+        Write a corrected SQL query that answers the following question:
+        {question}
+        """
+
+def build_tables_summary(table_info, question, schema_index=None, top_k=4, tokenizer=None, prune=True):
+    """
+    Schema text for the prompt: every table, or only the relevant tables and columns when a
+    SchemaIndex is given (all of them, rendered the same way, with prune=False).
+    """
+    with span("prompt_build", tables=len(table_info)) as s:
+        if schema_index is None:
+            return summarize_tables(table_info)
+        if not prune:
+            s.set(tables=len(table_info), schema_tokens=schema_index.full_tokens(tokenizer), schema_tokens_saved=0)
+            return schema_index.full_schema()
+        pruned_info = schema_index.prune(question, top_k=top_k)
+        tables_summary = schema_index.render(pruned_info)
+
+        # The whole schema is rendered and counted once per SchemaIndex, not per question
+        full_tokens = schema_index.full_tokens(tokenizer)
+        pruned_tokens = count_tokens(tables_summary, tokenizer)
+        s.set(tables=len(pruned_info), schema_tokens=pruned_tokens, schema_tokens_saved=full_tokens - pruned_tokens)
+        print(f"Schema pruning kept {len(pruned_info)}/{len(table_info)} tables, "
+              f"{sum(len(ddl) for _, ddl, _ in pruned_info)}/{sum(len(ddl) for _, ddl, _ in table_info)} columns: "
+              f"{full_tokens} -> {pruned_tokens} schema tokens ({full_tokens - pruned_tokens} saved)")
+    return tables_summary
+
+def caches_prefix(lang_model, generator=None):
+    """
+    Whether generation reuses cached key/values of the prompt's schema prefix (prefix_cache.py).
+    """
+    if generator is not None:
+        model = getattr(generator, "model", None)
+    else:
+        model = getattr(getattr(lang_model, "pipeline", None), "model", None)
+    return model is not None and supports_prefix_caching(model)
+
+def prompt_schema(table_info, question, lang_model, schema_index=None, top_k=4, generator=None):
+    """
+    (tables_summary, cache_prefix) for a question's prompt.
+
+    With prefix caching, a schema of at most PREFIX_SCHEMA_MAX_TOKENS is sent whole: pruning
+    would change the prompt prefix with every question and the cache would never hit.
+    """
+    tokenizer = getattr(getattr(lang_model, "pipeline", None), "tokenizer", None)
+    cache_prefix = caches_prefix(lang_model, generator) and (
+        schema_index is None or schema_index.full_tokens(tokenizer) <= PREFIX_SCHEMA_MAX_TOKENS)
+    tables_summary = build_tables_summary(table_info, question, schema_index=schema_index, top_k=top_k,
+                                          tokenizer=tokenizer, prune=not cache_prefix)
+    return tables_summary, cache_prefix
+
+def format_sql_prompt(tables_summary, question, examples=""):
+    return SQL_PROMPT_TEMPLATE.format(tables_summary=tables_summary, examples=examples, question=question)
+
+def extract_sql(generated_text):
+    """
+    Keep the first complete statement from the first SELECT of the model output.
+    """
+    sql_query = "SELECT "+generated_text.split("SELECT", 1)[-1].strip()
+    detector = SQLCompletionDetector()
+    detector.feed(sql_query)
+    return detector.statement()
+
+def schema_prefix(template, variables):
+    """
+    The prompt text up to and including the schema: shared by every question (and repair)
+    on the same tables, so its key/values can be cached.
+    """
+    if "{tables_summary}" not in template:
+        return None
+    end = template.index("{tables_summary}") + len("{tables_summary}")
+    return template[:end].format(**variables)
+
+def generate_text(lang_model, template, variables, table_info, generator=None, on_token=None, constrained=False,
+                  stage="generate", cancel_event=None, cache_prefix=False):
+    """
+    Run the filled-in template through the batching generator (which streams and constrains
+    too), else the local pipeline when streaming or constraining, else an LLMChain. With
+    cache_prefix, local generation reuses the key/values of the schema prefix.
+    """
+    pipe = getattr(lang_model, "pipeline", None)
+    tokenizer = getattr(pipe, "tokenizer", None)
+    prompt = template.format(**variables)
+    prefix = schema_prefix(template, variables) if cache_prefix else None
+    with span(stage) as s:
+        if generator is None and pipe is not None and (on_token is not None or constrained):
+            logits_processor = None
+            if constrained:
+                logits_processor = sql_logits_processor(pipe.tokenizer, table_info)
+            generated_text = stream_sql(pipe.model, pipe.tokenizer, prompt, on_text=on_token,
+                                        logits_processor=logits_processor,
+                                        prefix=prefix, cancel_event=cancel_event)
+            if logits_processor is not None:
+                s.set(masked_steps=logits_processor[0].masked_steps,
+                      unconstrained_steps=logits_processor[0].unconstrained_steps)
+        elif generator is not None:
+            from generation_server import wait_for
+
+            future = generator.submit(prompt, table_info=table_info if constrained else None, on_text=on_token,
+                                      cancel_event=cancel_event, prefix=prefix)
+            generated_text = wait_for(future, cancel_event)
+        else:
+            # LangChain is only needed on this fallback path; importing it costs seconds
+            from langchain.prompts import PromptTemplate
+            from langchain.chains import LLMChain
+
+            create_prompt = PromptTemplate(
+                input_variables=list(variables),
+                template=template
+            )
+
+            # Initialize the LLMChain with the prompt and the LLM model
+            create_chain = LLMChain(llm=lang_model, prompt=create_prompt, verbose=False)
+            generated_text = create_chain.predict(**variables)
+
+        if is_active():
+            tokens_in = count_tokens(prompt, tokenizer)
+            tokens_out = count_tokens(generated_text, tokenizer)
+            s.set(tokens_in=tokens_in, tokens_out=tokens_out)
+            count("tokens_in", tokens_in)
+            count("tokens_out", tokens_out)
+    return generated_text
+
+def llm_create_sql(table_info, question, lang_model, cache=None, schema_index=None, top_k=4, generator=None,
+                   on_token=None, constrained=False, conn=None,
+                   repair_cache=default_repair_cache, examples=None, provenance=None, cancel_event=None):
+    """
+    Use the LLM to generate a SQL query based on table information and the user question.
+
+    If an NL2SQLCache is given, a cached query for the same (or a near-duplicate) question
+    against the same schema is returned without calling the model.
+
+    If a SchemaIndex is given, only the top_k tables relevant to the question (plus the tables
+    joining them) are sent to the model, rendered as compact CREATE TABLE statements; when
+    the local model caches prompt prefixes and the schema is small enough, every table is sent
+    so the schema prefix is reused (see prompt_schema()).
+
+    If a GenerationServer is given, the prompt is queued on it and batched with prompts from
+    other sessions instead of calling lang_model directly.
+
+    If on_token is given and generation is local (the GenerationServer or a HuggingFace pipeline),
+    tokens are streamed and on_token(partial_sql) is called as they arrive; decoding stops once
+    the statement is complete.
+
+    If constrained is set and generation is local, every decoding step
+    is masked to tokens that keep the output a valid SQL prefix over this schema's tables and
+    columns (see constrained_decoding.py).
+
+    If conn is given, the SQL is compiled against it (without running) and compile errors are
+    sent back to the model for repair, within a retry and latency budget, reusing fixes from
+    repair_cache (see sql_repair.py). SQL that still does not compile is returned as is but
+    not stored in the NL2SQL cache.
+
+    If an ExampleStore is given, the most similar validated questions for this schema are put
+    in the prompt as few-shot examples, within its token budget (see example_store.py).
+
+    If a provenance dict is given, provenance["source"] is set to where the SQL came from:
+    "cache", "model" or "repaired" (the model's SQL needed a repair to compile).
+
+    If a cancel_event (threading.Event) is given, setting it stops local generation at its next
+    token, or drops a prompt still queued on the GenerationServer, and raises CancelledError.
+    """
+    if provenance is None:
+        provenance = {}
+    started = time.perf_counter()
+    if cache is not None:
+        fingerprint = schema_fingerprint(table_info)
+        namespace = getattr(lang_model, "model_id", type(lang_model).__name__)
+        with span("cache_lookup") as s:
+            cached_sql = cache.lookup(question, fingerprint, namespace=namespace)
+            s.set(hit=cached_sql is not None)
+        if cached_sql is not None:
+            print("sql-query (cached): ", cached_sql)
+            provenance["source"] = "cache"
+            return cached_sql
+
+    tokenizer = getattr(getattr(lang_model, "pipeline", None), "tokenizer", None)
+    tables_summary, cache_prefix = prompt_schema(table_info, question, lang_model, schema_index=schema_index,
+                                                 top_k=top_k, generator=generator)
+    examples_block = ""
+    if examples is not None:
+        examples_block = examples_for_prompt(examples, question, schema_fingerprint(table_info), tokenizer)
 
     # Generate SQL query
-    sql_query = create_chain.predict(tables_summary=tables_summary, question=question)
-    sql_query = "SELECT "+sql_query.split("SELECT", 1)[-1].strip()
+    generated_text = generate_text(lang_model, SQL_PROMPT_TEMPLATE,
+                                   {"tables_summary": tables_summary, "examples": examples_block,
+                                    "question": question},
+                                   table_info, generator=generator, on_token=on_token, constrained=constrained,
+                                   cancel_event=cancel_event, cache_prefix=cache_prefix)
+
+    with span("postprocess"):
+        sql_query = extract_sql(generated_text)
     print("sql-query: ", sql_query)
+    provenance["source"] = "model"
+
+    if conn is not None:
+        def repair(broken_sql, error):
+            variables = {"tables_summary": tables_summary, "error": error, "sql_query": broken_sql,
+                         "question": question}
+            return extract_sql(generate_text(lang_model, REPAIR_PROMPT_TEMPLATE, variables, table_info,
+                                             generator=generator, constrained=constrained,
+                                             stage="repair_generate", cancel_event=cancel_event,
+                                             cache_prefix=cache_prefix))
+
+        repaired = validate_and_repair(conn, sql_query, schema_fingerprint(table_info), repair, started=started,
+                                       cache=repair_cache)
+        sql_query = repaired.sql
+        if repaired.history:
+            provenance["source"] = "repaired"
+        if repaired.error is not None:
+            return sql_query
+
+    if cache is not None:
+        cache.store(question, fingerprint, sql_query, namespace=namespace)
     return sql_query
@@ -0,0 +1,245 @@
+import difflib
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from instrumentation import count, span
+from query_guard import strip_sql, table_aliases
+
+
+# Model calls allowed to repair one question, and the wall-clock budget for the whole loop
+MAX_REPAIR_RETRIES = int(os.environ.get("SQL_REPAIR_RETRIES", 2))
+REPAIR_BUDGET_SECONDS = float(os.environ.get("SQL_REPAIR_BUDGET", 30))
+
+_IDENTIFIER = r"[\"`\[]?(\w+)[\"`\]]?"
+_ERROR_PATTERNS = [
+    ("no such column", re.compile(rf"no such column: (?:{_IDENTIFIER}\.)?{_IDENTIFIER}")),
+    ("no such table", re.compile(rf"no such table: (?:\w+\.)?{_IDENTIFIER}")),
+    ("no such function", re.compile(r"no such function: (\w+)")),
+    ("ambiguous column name", re.compile(rf"ambiguous column name: (?:{_IDENTIFIER}\.)?{_IDENTIFIER}")),
+    ("syntax error", re.compile(r'near "([^"]*)": syntax error')),
+]
+# Mistakes whose fix is renaming one identifier, so it carries over to other queries
+_RENAMES = {"no such column", "no such table", "no such function"}
+_COLUMN_QUALIFIER = re.compile(rf"no such column: {_IDENTIFIER}\.")
+
+
+class RepairResult:
+    """
+    Outcome of validate_and_repair: the final SQL, the error it still has (None if it compiles)
+    and how it got there.
+    """
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.error = None
+        self.attempts = 0
+        self.cache_hits = 0
+        self.history = []  # (error, "cache" | "model") per repair step
+
+
+def compile_error(conn, sql_query):
+    """
+    Compile sql_query without running it; return SQLite's error message, or None if it compiles.
+    """
+    try:
+        conn.execute("EXPLAIN " + sql_query)
+    except (sqlite3.Error, sqlite3.Warning) as e:
+        return str(e)
+    return None
+
+
+def error_signature(message):
+    """
+    (kind, offending identifier) for a compile error, e.g. ("no such column", "nmae").
+    """
+    for kind, pattern in _ERROR_PATTERNS:
+        match = pattern.search(message)
+        if match:
+            return kind, [group for group in match.groups() if group is not None][-1].lower()
+    return re.sub(r"\d+", "N", message.lower()), ""
+
+
+def rename_scope(sql_query, message):
+    """
+    For a "no such column" error, the lowercased table the bad column was qualified with in
+    sql_query (aliases resolved), or "" if it was unqualified; None for other errors.
+    """
+    if not message.startswith("no such column"):
+        return None
+    match = _COLUMN_QUALIFIER.search(message)
+    if not match:
+        return ""
+    qualifier = match.group(1).lower()
+    return table_aliases(sql_query).get(qualifier, qualifier).lower()
+
+
+def _sql_tokens(sql_query):
+    return re.findall(r"\w+|'(?:[^']|'')*'|\S", sql_query)
+
+
+def _normalize_sql(sql_query):
+    return " ".join(_sql_tokens(sql_query)).lower().rstrip("; ")
+
+
+def derive_rename(broken_sql, repaired_sql, identifier):
+    """
+    The word that replaced identifier between the two queries, if that was a one-word swap.
+    """
+    broken, repaired = _sql_tokens(broken_sql), _sql_tokens(repaired_sql)
+    matcher = difflib.SequenceMatcher(a=[t.lower() for t in broken], b=[t.lower() for t in repaired],
+                                      autojunk=False)
+    for op, a1, a2, b1, b2 in matcher.get_opcodes():
+        if op == "replace" and a2 - a1 == 1 and b2 - b1 == 1 and broken[a1].lower() == identifier:
+            replacement = repaired[b1]
+            if re.fullmatch(r"\w+", replacement):
+                return replacement
+    return None
+
+
+def apply_rename(sql_query, identifier, replacement, scope=None):
+    """
+    Replace occurrences of the identifier word outside string literals and comments.
+
+    With a scope (from rename_scope), only column references that resolve to that table are
+    replaced ("" for unqualified references), so fixing t.Name leaves Artist.Name alone.
+    """
+    masked = strip_sql(sql_query)
+    aliases = table_aliases(sql_query) if scope else {}
+    pieces, last = [], 0
+    pattern = rf"(?:(\w+)\s*\.\s*)?(?<!\w)({re.escape(identifier)})(?!\w)"
+    for match in re.finditer(pattern, masked, flags=re.I):
+        if scope is not None:
+            qualifier = (match.group(1) or "").lower()
+            if (aliases.get(qualifier, qualifier).lower() if qualifier else "") != scope:
+                continue
+        pieces.append(sql_query[last:match.start(2)])
+        pieces.append(replacement)
+        last = match.end(2)
+    pieces.append(sql_query[last:])
+    return "".join(pieces)
+
+
+class RepairCache:
+    """
+    Repairs learned from the model, keyed by schema fingerprint and error signature.
+
+    A fix that renamed the offending identifier (a wrong column, table or function name) is
+    stored as that rename and applied to any later query with the same mistake; column renames
+    are kept per table (see rename_scope) and only touch columns of that table. Other fixes
+    are stored as the full repaired query and reused only for the same broken query.
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def lookup(self, fingerprint, signature, sql_query, scope=None):
+        """
+        Candidate fix for sql_query, or None. The caller still has to compile it.
+        """
+        kind, identifier = signature
+        rename_key = ("rename", fingerprint, signature, scope)
+        with self._lock:
+            candidate = None
+            rename = self._entries.get(rename_key)
+            if rename is not None:
+                self._entries.move_to_end(rename_key)
+                candidate = apply_rename(sql_query, identifier, rename, scope)
+            else:
+                exact_key = ("exact", fingerprint, signature, _normalize_sql(sql_query))
+                candidate = self._entries.get(exact_key)
+                if candidate is not None:
+                    self._entries.move_to_end(exact_key)
+            if candidate is None or candidate == sql_query:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return candidate
+
+    def store(self, fingerprint, signature, broken_sql, repaired_sql, scope=None):
+        kind, identifier = signature
+        rename = derive_rename(broken_sql, repaired_sql, identifier) if kind in _RENAMES else None
+        with self._lock:
+            if rename is not None:
+                self._put(("rename", fingerprint, signature, scope), rename)
+            else:
+                self._put(("exact", fingerprint, signature, _normalize_sql(broken_sql)), repaired_sql)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+default_repair_cache = RepairCache()
+
+
+def validate_and_repair(conn, sql_query, fingerprint, repair, max_retries=MAX_REPAIR_RETRIES,
+                        budget_seconds=REPAIR_BUDGET_SECONDS, started=None, cache=default_repair_cache):
+    """
+    Compile sql_query against conn and fix it until it compiles or the budget runs out.
+
+    Each compile error is first looked up in the repair cache; otherwise repair(sql, error)
+    is called (it asks the model and returns new SQL), at most max_retries times and only
+    while less than budget_seconds have passed since started (default: now). A model call
+    that has started is not interrupted. Returns a RepairResult.
+    """
+    started = time.perf_counter() if started is None else started
+    result = RepairResult(sql_query)
+    with span("validate") as s:
+        error = compile_error(conn, sql_query)
+        seen = {sql_query}
+        while error is not None:
+            signature = error_signature(error)
+            scope = rename_scope(sql_query, error)
+            candidate, source = None, None
+            if cache is not None:
+                candidate = cache.lookup(fingerprint, signature, sql_query, scope)
+                if candidate is not None and candidate not in seen:
+                    source = "cache"
+                    result.cache_hits += 1
+            if source is None:
+                if result.attempts >= max_retries:
+                    break
+                if time.perf_counter() - started > budget_seconds:
+                    print(f"SQL repair stopped: {budget_seconds:g}s budget spent")
+                    break
+                result.attempts += 1
+                with span("repair", error=signature[0]):
+                    candidate = repair(sql_query, error)
+                source = "model"
+            if candidate in seen:
+                # The model brought back a query that already failed
+                break
+
+            seen.add(candidate)
+            new_error = compile_error(conn, candidate)
+            print(f"SQL repair ({source}) for '{error}': {candidate}")
+            result.history.append((error, source))
+            if source == "model" and cache is not None and \
+                    (new_error is None or error_signature(new_error) != signature):
+                cache.store(fingerprint, signature, sql_query, candidate, scope)
+            sql_query, error = candidate, new_error
+
+        result.sql, result.error = sql_query, error
+        s.set(valid=error is None, attempts=result.attempts, cache_hits=result.cache_hits)
+    count("repairs", result.attempts)
+    if error is not None:
+        print(f"SQL still fails to compile after {result.attempts} repair attempts: {error}")
+    return result
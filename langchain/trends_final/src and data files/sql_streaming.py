@@ -0,0 +1,183 @@
+import os
+import threading
+from concurrent.futures import CancelledError
+
+from instrumentation import count, span
+
+
+# Stream partial SQL into the UI as tokens are generated (on the batching GenerationServer,
+# or one decode per session without it); set to 0 to show the SQL only once it is complete
+STREAM_TOKENS = os.environ.get("SQL_STREAM_TOKENS", "1") == "1"
+CONTEXT_WINDOW = 2048
+MIN_NEW_TOKENS = 32
+MAX_NEW_TOKENS = 256
+
+
+class SQLCompletionDetector:
+    """
+    Incremental scanner that notices when generated text contains one complete SQL statement.
+
+    Text before the first SELECT is ignored. The statement is complete at a ';' or a blank line
+    that is outside string literals, quoted identifiers and comments, with parentheses balanced.
+    Text is fed piece by piece; earlier characters are never rescanned.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.start = None
+        self.end = None
+        self._pos = 0
+        self._quote = None
+        self._depth = 0
+        self._comment = None
+
+    def feed(self, piece):
+        """
+        Add generated text; return True once the statement is complete.
+        """
+        self.text += piece
+        if self.end is not None:
+            return True
+        if self.start is None:
+            start = self.text.find("SELECT")
+            if start < 0:
+                return False
+            self.start = self._pos = start
+
+        text = self.text
+        while self._pos < len(text):
+            char = text[self._pos]
+            following = text[self._pos + 1] if self._pos + 1 < len(text) else ""
+            if self._comment == "line":
+                if char == "\n":
+                    self._comment = None
+            elif self._comment == "block":
+                if char == "*" and following == "/":
+                    self._comment = None
+                    self._pos += 1
+            elif self._quote:
+                if char == self._quote:
+                    self._quote = None
+            elif char in "'\"`":
+                self._quote = char
+            elif char == "-" and following == "-":
+                self._comment = "line"
+            elif char == "/" and following == "*":
+                self._comment = "block"
+            elif char == "(":
+                self._depth += 1
+            elif char == ")":
+                self._depth = max(0, self._depth - 1)
+            elif self._depth == 0 and (char == ";" or (char == "\n" and following == "\n")):
+                self.end = self._pos + 1 if char == ";" else self._pos
+                return True
+            elif char == "\n" and not following:
+                # Can't tell yet whether this newline starts a blank line
+                return False
+            self._pos += 1
+        return False
+
+    def statement(self):
+        """
+        The SQL statement seen so far (complete or not), starting at the first SELECT.
+        """
+        if self.start is None:
+            return ""
+        return self.text[self.start:self.end].strip()
+
+
+def max_new_tokens_for(prompt_tokens, context_window=CONTEXT_WINDOW, floor=MIN_NEW_TOKENS, cap=MAX_NEW_TOKENS):
+    """
+    Generation budget: at most cap new tokens and never past the context window.
+    """
+    return max(floor, min(cap, context_window - prompt_tokens))
+
+
+def _stopping_criteria(tokenizer, prompt_length, detector, stop_events):
+    from transformers import StoppingCriteria, StoppingCriteriaList
+
+    class StatementComplete(StoppingCriteria):
+        def __init__(self):
+            self.decoded = 0
+
+        def __call__(self, input_ids, scores, **kwargs):
+            new_tokens = input_ids[0, prompt_length + self.decoded:]
+            self.decoded += len(new_tokens)
+            complete = detector.feed(tokenizer.decode(new_tokens, skip_special_tokens=True))
+            return complete or any(event.is_set() for event in stop_events)
+
+    return StoppingCriteriaList([StatementComplete()])
+
+
+def stream_sql(model, tokenizer, prompt, on_text=None, context_window=CONTEXT_WINDOW, logits_processor=None,
+               prefix=None, cancel_event=None):
+    """
+    Generate SQL for prompt token by token, calling on_text(partial_sql) as text arrives.
+
+    Decoding stops as soon as the statement is complete, and max_new_tokens is derived from
+    the prompt size. An optional logits_processor (e.g. the SQL grammar mask) is applied to every
+    step. If prompt starts with prefix (e.g. the schema preamble), the prefix's key/values come
+    from the model's PrefixCache and only the rest of the prompt is encoded. Decoding also stops
+    once cancel_event is set (CancelledError is raised) or on_text raises. Returns the generated
+    text (everything the model produced).
+    """
+    import torch
+    from transformers import TextIteratorStreamer
+
+    from prefix_cache import prefix_cached_inputs, supports_prefix_caching
+
+    if prefix and prompt.startswith(prefix) and supports_prefix_caching(model):
+        inputs = prefix_cached_inputs(model, tokenizer, prefix, prompt[len(prefix):])
+    else:
+        inputs = tokenizer(prompt, return_tensors="pt")
+    prompt_length = inputs["input_ids"].shape[1]
+    max_new_tokens = max_new_tokens_for(prompt_length, context_window)
+    # Fed from the stopping criteria, token by token, in the generation thread
+    stop_detector = SQLCompletionDetector()
+    # Set when the consumer below exits early, so the generation thread stops too
+    abandoned = threading.Event()
+    stop_events = [abandoned] if cancel_event is None else [abandoned, cancel_event]
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+
+    def generate():
+        with torch.inference_mode():
+            model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id,
+                streamer=streamer,
+                stopping_criteria=_stopping_criteria(tokenizer, prompt_length, stop_detector, stop_events),
+                logits_processor=logits_processor,
+            )
+
+    with span("stream_generate", tokens_in=prompt_length, max_new_tokens=max_new_tokens,
+              constrained=logits_processor is not None) as s:
+        worker = threading.Thread(target=generate, name="sql-stream", daemon=True)
+        worker.start()
+        display = SQLCompletionDetector()
+        generated = ""
+        done = False
+        try:
+            for piece in streamer:
+                generated += piece
+                done = display.feed(piece)
+                if on_text is not None and display.start is not None:
+                    on_text(display.statement())
+                if done:
+                    break
+        except BaseException:
+            abandoned.set()
+            raise
+        if done:
+            # Remaining pieces (if any) arrive after the stopping criteria fired; drain them. Once
+            # the streamer is exhausted it must not be iterated again: it would block forever.
+            for piece in streamer:
+                generated += piece
+        worker.join()
+        if cancel_event is not None and cancel_event.is_set():
+            raise CancelledError()
+        tokens_out = len(tokenizer.encode(generated))
+        s.set(tokens_out=tokens_out, stopped_early=stop_detector.end is not None)
+    count("tokens_out", tokens_out)
+    return generated
@@ -0,0 +1,26 @@
+import pytest
+
+from import_budget import APP_MODULES, LIBRARY_MODULES, baseline, check_module
+
+
+@pytest.fixture(scope="module")
+def startup():
+    return baseline()
+
+
+@pytest.fixture(scope="module")
+def streamlit():
+    pytest.importorskip("streamlit")
+    return baseline("import streamlit")
+
+
+@pytest.mark.parametrize("module", LIBRARY_MODULES)
+def test_library_module_within_budget(startup, module):
+    _, problems = check_module(module, *startup)
+    assert problems == []
+
+
+@pytest.mark.parametrize("module", APP_MODULES)
+def test_app_within_budget(streamlit, module):
+    _, problems = check_module(module, *streamlit)
+    assert problems == []
@@ -0,0 +1,60 @@
+import pytest
+
+from nl2sql_cache import NL2SQLCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return NL2SQLCache(path=str(tmp_path / "cache.sqlite"))
+
+
+@pytest.mark.parametrize("stored, asked", [
+    ("Which artists have albums", "Which artists have no albums"),
+    ("List the customers who have invoices", "List the customers who have no invoices"),
+    ("List the tracks by length in descending order", "List the tracks by length in ascending order"),
+    ("Which customer spent the most", "Which customer spent the least"),
+    ("Which genre has the highest sales", "Which genre has the lowest sales"),
+    ("Invoices before 2010", "Invoices after 2010"),
+    ("Employees who have managers", "Employees who don't have managers"),
+])
+def test_near_hit_requires_same_polarity(cache, stored, asked):
+    cache.store(stored, "fp", "SELECT 1")
+    assert cache.lookup(asked, "fp") is None
+    assert cache.near_hits == 0
+
+
+def test_near_hit_with_same_polarity(cache):
+    cache.store("Which artists have no albums", "fp", "SELECT 1")
+    assert cache.lookup("Which artists have no albums?", "fp") == "SELECT 1"
+    assert cache.lookup("which artists have no album", "fp") == "SELECT 1"
+    assert cache.near_hits == 1
+
+
+def test_near_hit_requires_same_literals(cache):
+    cache.store("Top 5 customers by total spent", "fp", "SELECT 1")
+    assert cache.lookup("Top 10 customers by total spent", "fp") is None
+
+
+@pytest.mark.parametrize("stored, asked", [
+    ("Customers from 'USA'", "Customers from 'usa'"),
+    ('Tracks in the "Rock" genre', 'Tracks in the "Jazz" genre'),
+    ('Tracks in the "Rock" genre', "Tracks in the Rock genre"),
+])
+def test_quoted_literals_are_kept_as_written(cache, stored, asked):
+    cache.store(stored, "fp", "SELECT 1")
+    assert cache.lookup(asked, "fp") is None
+
+
+def test_apostrophes_are_not_literals(cache):
+    cache.store("Which employees don't have a manager", "fp", "SELECT 1")
+    assert cache.lookup("which employees don't have a manager?", "fp") == "SELECT 1"
+
+
+def test_default_path_is_private(tmp_path, monkeypatch):
+    import nl2sql_cache
+
+    path = tmp_path / "home" / ".cache" / "llm4sql" / "nl2sql_cache.sqlite"
+    monkeypatch.setattr(nl2sql_cache, "NL2SQL_CACHE_PATH", str(path))
+    nl2sql_cache.NL2SQLCache()
+    assert path.exists()
+    assert (path.parent.stat().st_mode & 0o777) == 0o700
@@ -0,0 +1,289 @@
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from connection_pool import MMAP_SIZE, default_pools
+from constrained_decoding import CONSTRAINED_DECODING
+from instrumentation import count, span, trace
+from model_registry import DEFAULT_MODEL_ID
+
+
+# Seconds between scheduled warm-ups after the first (0 warms once at start only)
+WARMUP_INTERVAL = float(os.environ.get("SQL_WARMUP_INTERVAL", 600))
+WARMUP_WORKERS = int(os.environ.get("SQL_WARMUP_WORKERS", 4))
+# Pooled connections opened ahead of traffic per database (capped by the pool size)
+WARMUP_CONNECTIONS = int(os.environ.get("SQL_WARMUP_CONNECTIONS", 2))
+# Bytes of each database file read into the OS page cache; defaults to what the connections mmap
+WARMUP_READ_BYTES = int(os.environ.get("SQL_WARMUP_READ_MB", MMAP_SIZE // 2**20)) * 2**20
+# Run one throwaway generation per database so the model, its buffers and the schema's prefix cache are hot
+WARMUP_GENERATE = os.environ.get("SQL_WARMUP_GENERATE", "1") == "1"
+WARMUP_QUESTION = "How many rows are there?"
+READ_BLOCK = 2**20
+
+PENDING, WARMING, READY, FAILED = "pending", "warming", "ready", "failed"
+
+
+def open_connections(db_path, connections=WARMUP_CONNECTIONS):
+    """
+    Open up to connections pooled connections to db_path at once and return them to the pool idle.
+    """
+    pool = default_pools.pool(db_path)
+    checked_out = []
+    try:
+        for _ in range(min(connections, pool.max_size)):
+            checked_out.append(default_pools.checkout(db_path))
+    finally:
+        for conn in checked_out:
+            default_pools.release(conn)
+    return len(checked_out)
+
+
+def preread_file(path, max_bytes=WARMUP_READ_BYTES):
+    """
+    Read the first max_bytes of path (and its WAL) so later queries find the pages in the OS page cache.
+
+    Returns the number of bytes read.
+    """
+    total = 0
+    buffer = bytearray(READ_BLOCK)
+    for file_path in (path, path + "-wal"):
+        if not os.path.isfile(file_path):
+            continue
+        with open(file_path, "rb", buffering=0) as f:
+            size = min(os.fstat(f.fileno()).st_size, max_bytes)
+            if size and hasattr(os, "posix_fadvise"):
+                # Lets the kernel read ahead in large requests while the loop below runs
+                os.posix_fadvise(f.fileno(), 0, size, os.POSIX_FADV_WILLNEED)
+            remaining = size
+            while remaining > 0:
+                read = f.readinto(buffer)
+                if not read:
+                    break
+                total += min(read, remaining)
+                remaining -= read
+    return total
+
+
+class DatabaseWarmth:
+    """
+    Warm-up progress of one database: its state, when it last finished and what each stage took.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.state = PENDING
+        self.runs = 0
+        self.warmed_at = None
+        self.seconds = None
+        self.stages = {}
+        self.error = None
+        self.generated_version = None
+
+    def as_dict(self):
+        return {"state": self.state, "runs": self.runs, "warmed_at": self.warmed_at, "seconds": self.seconds,
+                "stages": self.stages, "error": self.error}
+
+
+class Warmer:
+    """
+    Warms every database of a DatabaseRegistry on a background thread pool, at start and then
+    every interval seconds: opens pooled connections, loads the schema catalog, schema index and
+    prompt prefix (Database.warm), reads the file into the page cache and, with generate, runs one
+    throwaway generation, built exactly like a request's prompt, so the model is loaded and its
+    buffers and the schema's prefix cache exist. Every run generates at least once, which also
+    checks that the model still works.
+
+    ready() turns true once every database has been through a first warm-up and (when generate is
+    set) at least one warm-up generation has succeeded with none failing in that run, and turns
+    false again after a run where that no longer holds; a database that fails before generating
+    is reported in status() but doesn't hold readiness back.
+    """
+
+    def __init__(self, registry, model_id=DEFAULT_MODEL_ID, generate=WARMUP_GENERATE, constrained=CONSTRAINED_DECODING,
+                 interval=WARMUP_INTERVAL, workers=WARMUP_WORKERS, connections=WARMUP_CONNECTIONS,
+                 read_bytes=WARMUP_READ_BYTES):
+        self.registry = registry
+        self.model_id = model_id
+        self.generate = generate
+        self.constrained = constrained
+        self.interval = interval
+        self.workers = workers
+        self.connections = connections
+        self.read_bytes = read_bytes
+        self.model_state = PENDING if generate else READY
+        self.model_error = None
+        self._generated = 0
+        self._load_failed = False
+        self._generate_errors = []
+        self._databases = {name: DatabaseWarmth(name) for name in registry.names()}
+        self._executor = None
+        self._scheduler = None
+        self._stopped = threading.Event()
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Warm in the background now and then on schedule (once per Warmer; returns immediately).
+        """
+        with self._lock:
+            if self._scheduler is None:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="sql-warmup")
+                self._scheduler = threading.Thread(target=self._schedule, name="sql-warmup-scheduler", daemon=True)
+                self._scheduler.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._scheduler is not None:
+            self._scheduler.join()
+            self._executor.shutdown(wait=False)
+
+    def _schedule(self):
+        while not self._stopped.is_set():
+            self.run()
+            if self.interval <= 0 or self._stopped.wait(self.interval):
+                return
+
+    def run(self):
+        """
+        Warm every database once, concurrently, and wait for all of them.
+        """
+        executor = self._executor or ThreadPoolExecutor(self.workers, thread_name_prefix="sql-warmup")
+        self._load_failed = False
+        self._generate_errors = []
+        self._generated = 0
+        started = time.perf_counter()
+        try:
+            futures = [executor.submit(self.warm_database, name) for name in list(self._databases)]
+            for future in futures:
+                future.result()
+        finally:
+            if executor is not self._executor:
+                executor.shutdown()
+        if self.generate:
+            # Ready only once a warm-up generation has gone through; any failure this run (load, OOM...) fails it
+            if self._generate_errors:
+                self.model_state, self.model_error = FAILED, self._generate_errors[0]
+            else:
+                self.model_state = READY if self._generated else PENDING
+                self.model_error = None
+        if self.model_state == READY and all(warmth.runs for warmth in self._databases.values()):
+            self._ready.set()
+        else:
+            self._ready.clear()
+        print(f"Warm-up of {len(self._databases)} databases finished in {time.perf_counter() - started:.2f}s"
+              + (f" (model: {self.model_error})" if self.model_error else ""))
+
+    def warm_database(self, name):
+        """
+        One warm-up pass over a registered database; progress is kept in its DatabaseWarmth.
+        """
+        warmth = self._databases[name]
+        database = self.registry.get(name)
+        warmth.state = WARMING
+        started = time.perf_counter()
+        spans = []
+        try:
+            with trace(spans):
+                with span("warm_connections") as s:
+                    s.set(connections=open_connections(database.path, self.connections))
+                with span("warm_schema") as s:
+                    state = database.warm()
+                    if state is None:
+                        raise ValueError("no valid tables found (or the file is missing)")
+                    s.set(tables=len(state.table_info), prefix_chars=len(state.prompt_prefix))
+                with span("warm_pages") as s:
+                    paths = list(database.attached.values()) if database.attached else [database.path]
+                    s.set(bytes=sum(preread_file(path, self.read_bytes) for path in paths))
+                # Once per file version, and at least once per run; after a failed model load only the
+                # next scheduled run retries
+                if self.generate and not self._load_failed and (
+                        warmth.generated_version != state.file_version or not self._generated):
+                    with span("warm_generate"):
+                        self._generate(state)
+                    warmth.generated_version = state.file_version
+            warmth.state, warmth.error = READY, None
+        except Exception as e:
+            print(f"Warm-up of {name} failed: {e}")
+            warmth.state, warmth.error = FAILED, str(e)
+        warmth.stages = {s.name: round(s.seconds * 1000, 3) for s in spans if s.name.startswith("warm_")}
+        warmth.runs += 1
+        warmth.warmed_at = time.time()
+        warmth.seconds = round(time.perf_counter() - started, 3)
+        count("warmups", 1, state=warmth.state)
+
+    def _generate(self, state):
+        from generation_server import get_generation_server
+        from model_registry import default_registry
+        from sql_functions import SQL_PROMPT_TEMPLATE, generate_text, prompt_schema
+
+        try:
+            # The same model, batching server and decoding mode the jobs and the service use
+            lang_model = default_registry.get(self.model_id)
+            generator = get_generation_server(self.model_id)
+        except Exception as e:
+            self._load_failed = True
+            self._generate_errors.append(f"could not load {self.model_id}: {e}")
+            raise
+        # The schema text and prefix a request for this database builds (whole when prefix cached)
+        tables_summary, cache_prefix = prompt_schema(state.table_info, WARMUP_QUESTION, lang_model,
+                                                     schema_index=state.schema_index, generator=generator)
+        variables = {"tables_summary": tables_summary, "examples": "", "question": WARMUP_QUESTION}
+        try:
+            generate_text(lang_model, SQL_PROMPT_TEMPLATE, variables, state.table_info, generator=generator,
+                          constrained=self.constrained, stage="warm_generate_text", cache_prefix=cache_prefix)
+        except Exception as e:
+            self._generate_errors.append(f"warm-up generation failed: {e}")
+            raise
+        with self._lock:
+            self._generated += 1
+
+    def ready(self):
+        return self._ready.is_set()
+
+    def wait_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def status(self):
+        """
+        JSON-ready readiness report: overall, the model and each database.
+        """
+        return {"ready": self.ready(), "model_id": self.model_id, "model": self.model_state,
+                "model_error": self.model_error,
+                "databases": {name: warmth.as_dict() for name, warmth in self._databases.items()}}
+
+
+_warmer = None
+_warmer_lock = threading.Lock()
+
+
+def get_warmer(registry=None, **options):
+    """
+    Process-wide Warmer over registry (default: the apps' database registry), started on first use.
+    """
+    global _warmer
+    with _warmer_lock:
+        if _warmer is None:
+            if registry is None:
+                from db_registry import get_database_registry
+
+                registry = get_database_registry()
+            _warmer = Warmer(registry, **options).start()
+        return _warmer
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Warm the registered databases once and print the readiness report.")
+    parser.add_argument("--model-id", default=DEFAULT_MODEL_ID)
+    parser.add_argument("--no-generate", action="store_true", help="Skip the throwaway generation")
+    args = parser.parse_args()
+
+    from db_registry import get_database_registry
+
+    warmer = Warmer(get_database_registry(), model_id=args.model_id, generate=not args.no_generate)
+    warmer.run()
+    print(json.dumps(warmer.status(), indent=2))